@@ -1,6 +1,17 @@
 
 import flags_constants as fc
 from performance import Encoder
+from model_template import EquivalenceTemplate
+from telemetry import SolverTelemetry
+from termination import TerminationPolicy
+from forward_evaluation import ForwardEvaluator, load_layers
+from validation import validated_optimize
+from falsification import SamplingRegion, falsify, set_input_start
+from gradient_attack import pgd_attack
+from scheduler import Job, run_jobs
+from fs_queue import submit, collect
+from radius_search import search_radius
+from ledger import spec_hash
 from expression_encoding import create_gurobi_model
 import sys
 from timeit import default_timer as timer
@@ -13,8 +24,9 @@ import os.path
 examples = 'ExampleNNs/'
 
 
-def encode_equiv_radius(path1, path2, input_los, input_his, equiv_mode, center, radius, metric, name):
+def encode_equiv_radius(path1, path2, input_los, input_his, equiv_mode, center, radius, metric, name, cache=None):
     # accepts one_hot_partial_top_k as mode
+    # if a ModelCache is given, the model is loaded from the cache, if it was built before
 
     fc.use_asymmetric_bounds = True
     fc.use_context_groups = True
@@ -23,24 +35,37 @@ def encode_equiv_radius(path1, path2, input_los, input_his, equiv_mode, center,
     fc.manhattan_use_absolute_value = True
     fc.epsilon = 1e-4
 
-    enc = Encoder()
-    enc.encode_equivalence_from_file(path1, path2, input_los, input_his, equiv_mode, equiv_mode)
-    enc.add_input_radius(center, radius, metric)
+    k = int(equiv_mode.split('_')[-1])
 
-    enc.optimize_constraints()
+    def build():
+        enc = Encoder()
+        enc.encode_equivalence_from_file(path1, path2, input_los, input_his, equiv_mode, equiv_mode)
+        enc.add_input_radius(center, radius, metric)
 
-    k = int(equiv_mode.split('_')[-1])
+        enc.optimize_constraints()
+
+        model = create_gurobi_model(enc.get_vars(), enc.get_constraints(), name)
+        diff = model.getVarByName('E_diff_0_{num}'.format(num=k))
+        model.setObjective(diff, grb.GRB.MAXIMIZE)
+
+        return model, enc
+
+    if cache is None:
+        model, _ = build()
+    else:
+        config = {'mode': equiv_mode, 'input_los': input_los, 'input_his': input_his, 'center': center,
+                  'radius': radius, 'metric': metric, 'tightening': 'optimize_constraints'}
+        model = cache.get_or_build([path1, path2], config, build)
+        model.setAttr('ModelName', name)
 
-    model = create_gurobi_model(enc.get_vars(), enc.get_constraints(), name)
-    diff = model.getVarByName('E_diff_0_{num}'.format(num=k))
-    model.setObjective(diff, grb.GRB.MAXIMIZE)
     model.setParam('TimeLimit', 30 * 60)
 
     # maximum for diff should be greater 0
     return model
 
-def encode_equiv(path1, path2, input_los, input_his, mode, name):
+def encode_equiv(path1, path2, input_los, input_his, mode, name, cache=None):
     # accepts one_hot_partial_top_k
+    # if a ModelCache is given, the model is loaded from the cache, if it was built before
 
     fc.use_asymmetric_bounds = True
     fc.use_context_groups = True
@@ -49,25 +74,86 @@ def encode_equiv(path1, path2, input_los, input_his, mode, name):
     fc.manhattan_use_absolute_value = True
     fc.epsilon = 1e-4
 
-    enc = Encoder()
-    enc.encode_equivalence_from_file(path1, path2, input_los, input_his, mode, mode)
+    k = int(mode.split('_')[-1])
 
-    enc.optimize_constraints()
+    def build():
+        enc = Encoder()
+        enc.encode_equivalence_from_file(path1, path2, input_los, input_his, mode, mode)
 
-    k = int(mode.split('_')[-1])
+        enc.optimize_constraints()
+
+        model = create_gurobi_model(enc.get_vars(), enc.get_constraints(), name)
+        diff = model.getVarByName('E_diff_0_{num}'.format(num=k))
+        model.setObjective(diff, grb.GRB.MAXIMIZE)
+
+        return model, enc
+
+    if cache is None:
+        model, _ = build()
+    else:
+        config = {'mode': mode, 'input_los': input_los, 'input_his': input_his, 'tightening': 'optimize_constraints'}
+        model = cache.get_or_build([path1, path2], config, build)
+        model.setAttr('ModelName', name)
 
-    model = create_gurobi_model(enc.get_vars(), enc.get_constraints(), name)
-    diff = model.getVarByName('E_diff_0_{num}'.format(num=k))
-    model.setObjective(diff, grb.GRB.MAXIMIZE)
     model.setParam('TimeLimit', 30 * 60)
 
     # maximum for diff should be greater 0
     return model
 
 
+def encode_equiv_template(path1, path2, input_los, input_his, mode, center, radius, name):
+    # accepts one_hot_partial_top_k as mode
+    # template is encoded for the box around the center with the given radius and can be used for all smaller radii
+
+    fc.use_asymmetric_bounds = True
+    fc.use_context_groups = True
+    fc.use_grb_native = False
+    fc.use_eps_maximum = True
+    fc.manhattan_use_absolute_value = True
+    fc.epsilon = 1e-4
+
+    template_los = np.maximum(input_los, np.array(center) - radius)
+    template_his = np.minimum(input_his, np.array(center) + radius)
+
+    template = EquivalenceTemplate(path1, path2, template_los, template_his, mode, name)
+    template.model.setParam('TimeLimit', 30 * 60)
+
+    return template
+
+
+def clusters_suffix(clusters):
+    # dataframes of jobs evaluating only some clusters mustn't overwrite each other
+    if clusters is None:
+        return ''
+
+    return '_clusters_' + '_'.join(str(c) for c in clusters)
+
+
+def cluster_dataframe_file(testname, clusters=None):
+    # dataframe written by run_hierarchical_cluster_evaluation (relative to the working directory)
+    return 'df_' + testname + clusters_suffix(clusters) + '.pickle'
+
+
 def run_hierarchical_cluster_evaluation(testname, path1='mnist8x8_70p_retrain.h5', path2='mnist8x8_80p_retrain.h5',
                                         no_clusters=10, no_steps=3, metric='manhattan', logdir='FinalEvaluation',
-                                        obj_stop=20, timer_stop=1800, mode='one_hot_partial_top_3'):
+                                        obj_stop=20, timer_stop=1800, mode='one_hot_partial_top_3', use_template=False,
+                                        cache=None, falsify_samples=0, attack_steps=0, archive=None,
+                                        clusters=None):
+    '''
+    Templates, sampling and the gradient attack are disabled by default, so that the results of earlier sweeps are
+    reproduced, they have to be enabled explicitly.
+
+    :param use_template: if True, the model for each cluster is encoded and tightened only once for the largest
+        radius and then re-parameterized for the smaller radii, otherwise a new model is encoded for every radius
+    :param cache: ModelCache to load already built models from (only used, if use_template is False)
+    :param falsify_samples: number of samples evaluated before the MILP is solved, if a sample violates
+        equivalence by at least obj_stop, the MILP is skipped (0 disables sampling)
+    :param attack_steps: number of steps of the gradient attack run after unsuccessful sampling (0 disables it)
+    :param archive: CounterexampleArchive, the best archived point within the region is used as MIP start and
+        found counterexamples are added to it
+    :param clusters: indices of the clusters to evaluate (among the first no_clusters), all if None,
+        the dataframe is then saved with suffix _clusters_[indices]
+    '''
     path1 = examples + path1
     path2 = examples + path2
     inl = [0 for i in range(64)]
@@ -83,10 +169,17 @@ def run_hierarchical_cluster_evaluation(testname, path1='mnist8x8_70p_retrain.h5
     ins = []
 
     dict_list = []
+    templates = {}
+
+    top_k = int(mode.split('_')[-1])
+    evaluator = ForwardEvaluator(path1, path2)
 
     stdout = sys.stdout
     for s in steps[:no_steps]:
         for clno, cluster in enumerate(clusters_to_verify[:no_clusters]):
+            if clusters is not None and clno not in clusters:
+                continue
+
             teststart = timer()
 
             # manhattan distance
@@ -98,17 +191,91 @@ def run_hierarchical_cluster_evaluation(testname, path1='mnist8x8_70p_retrain.h5
             logfile = logdir + '/' + name + '.txt'
             sys.stdout = open(logfile, 'w')
 
-            model = encode_equiv_radius(path1, path2, inl, inh, mode, cluster.center, r, metric, name)
-            # stop optimization, if counterexample with at least 10 difference is found
-            model.setParam('BestObjStop', obj_stop)
-            model.setParam('TimeLimit', timer_stop)
+            region = SamplingRegion(inl, inh, cluster.center, r, metric)
+
+            falsification = None
+            if falsify_samples > 0:
+                falsification = falsify(path1, path2, region, top_k, obj_stop, falsify_samples, evaluator=evaluator)
+
+                if attack_steps > 0 and not falsification['falsified']:
+                    # refine by gradient ascent starting from the random restarts and the best sample
+                    attack = pgd_attack(path1, path2, region, mode, steps=attack_steps, starts=falsification['inputs'],
+                                        tolerance=obj_stop, layers=(evaluator.layers1, evaluator.layers2))
+                    if attack['violation'] > falsification['violation']:
+                        falsification = dict(falsification, falsified=attack['falsified'],
+                                             violation=attack['violation'], inputs=attack['inputs'])
+                    falsification['attack'] = attack
+
+            if falsification is not None and falsification['falsified']:
+                # counterexample found by sampling, no need to solve the MILP
+                sys.stdout = stdout
+                inputs = falsification['inputs']
+                ins.append(inputs)
+
+                if archive is not None:
+                    archive.add(path1, path2, mode, inputs, falsification['violation'],
+                                {'center': cluster.center, 'radius': r, 'metric': metric}, name)
+
+                fname = name + '.pickle'
+                with open(fname, 'wb') as fp:
+                    pickle.dump(inputs, fp)
+
+                now = timer()
+                print('### {name} falsified by sampling. Total time elapsed: {t}'.format(name=name, t=now - teststart))
+                print('    radius = {r}'.format(r=r))
+                print('    violation = {v}'.format(v=falsification['violation']))
+
+                eval_dict = {'testname': testname, 'cluster': clno, 'step': s, 'radius': r,
+                             'obj': falsification['violation'], 'time': now - teststart, 'logfile': logfile,
+                             'inputfile': fname, 'termination': 'falsified', 'falsification': falsification}
+                dict_list.append(eval_dict)
+                continue
+
+            if use_template:
+                if clno not in templates:
+                    r_max = max(steps[:no_steps]) * cluster.distance
+                    templates[clno] = encode_equiv_template(path1, path2, inl, inh, mode, cluster.center, r_max,
+                                                            testname + '_cluster_{cl}'.format(cl=clno))
+
+                template = templates[clno]
+                template.set_region(cluster.center, r, metric)
+                model = template.model
+            else:
+                model = encode_equiv_radius(path1, path2, inl, inh, mode, cluster.center, r, metric, name, cache)
+
+            # best sample as MIP start (templates use their previous solutions, if there are any in the region)
+            if falsification is not None and falsification['inputs'] is not None:
+                if not use_template or not any(template.contains(inc[1]) for inc in template.incumbents):
+                    set_input_start(model, falsification['inputs'])
+
+            # counterexamples of previous runs within the region as complete MIP start
+            if archive is not None:
+                archive.seed_mip_start(model, path1, path2, mode, (evaluator.layers1, evaluator.layers2), region)
+
+            # stop optimization, if counterexample with at least obj_stop difference is found or equivalence is proven
+            policy = TerminationPolicy.for_equivalence(obj_stop, timer_stop)
             models.append(model)
-            model.optimize()
+
+            telemetry = SolverTelemetry(model)
+            if use_template:
+                templates[clno].encoder.set_termination_policy(policy)
+                optimize = lambda m, callback: templates[clno].optimize(callback)
+            else:
+                # models from the cache have no encoder
+                optimize = policy.optimize
+            # templates and cached models are optimized again later, so spurious solutions are not cut off
+            validation = validated_optimize(model, (evaluator.layers1, evaluator.layers2), mode, 64,
+                                            callback=telemetry, optimize=optimize, cut=False)
+            telemetry.finalize(model)
 
             sys.stdout = stdout
             inputs = [model.getVarByName('i_0_{idx}'.format(idx=j)).X for j in range(64)]
             ins.append(inputs)
 
+            if archive is not None and model.SolCount > 0 and model.ObjVal > 0:
+                archive.add(path1, path2, mode, inputs, model.ObjVal,
+                            {'center': cluster.center, 'radius': r, 'metric': metric}, name)
+
             fname = name + '.pickle'
             with open(fname, 'wb') as fp:
                 pickle.dump(inputs, fp)
@@ -120,20 +287,26 @@ def run_hierarchical_cluster_evaluation(testname, path1='mnist8x8_70p_retrain.h5
             print('    ins = {i}'.format(i=str(inputs)))
 
             eval_dict = {'testname': testname, 'cluster': clno, 'step': s, 'radius': r, 'obj': model.ObjVal,
-                         'bound': model.ObjBound, 'time': now - teststart, 'logfile': logfile, 'inputfile': fname}
+                         'bound': model.ObjBound, 'time': now - teststart, 'logfile': logfile, 'inputfile': fname,
+                         'termination': policy.finalize(model), 'falsification': falsification,
+                         'validation': validation}
 
+            eval_dict['telemetry'] = telemetry.to_dict()
             dict_list.append(eval_dict)
 
     df = pd.DataFrame(dict_list)
-    df.to_pickle('df_' + testname + '.pickle')
+    df.to_pickle(cluster_dataframe_file(testname, clusters))
 
     return models, ins, dict_list
 
 
 def run_radius_optimization(testname, path1='mnist8x8_70p_retrain.h5', path2='mnist8x8_80p_retrain.h5',
                             no_clusters=10, metric='manhattan', logdir='FinalEvaluation/VariableRadius', timer_stop=1800,
-                            mode='one_hot_partial_top_3'):
+                            mode='one_hot_partial_top_3', clusters=None, fixed_radius_files=None):
     # returns empty lists, if no evaluation data was found
+    # clusters: indices of the clusters to evaluate, all of the first no_clusters if None
+    # fixed_radius_files: dataframes of run_hierarchical_cluster_evaluation, the bounds of the radius are taken from,
+    #   FinalEvaluation/FixedRadius/dataframes/df_[testname].pickle if None
     path1 = examples + path1
     path2 = examples + path2
     inl = [0 for i in range(64)]
@@ -141,9 +314,11 @@ def run_radius_optimization(testname, path1='mnist8x8_70p_retrain.h5', path2='mn
 
     # 10 most dense clusters in hierarchical manhattan clustering of mnist8x8 training data
     clusters_to_verify = pickle.load(open("to_verify.pickle", "rb"))
-    # TODO: remove hack
-    #df_fixed = pickle.load(open('FinalEvaluation/FixedRadius/dataframes/df_summary.pickle', 'rb'))
-    df_fixed = pickle.load(open('FinalEvaluation/FixedRadius/dataframes/df_' + testname + '.pickle', 'rb'))
+    if fixed_radius_files is None:
+        fixed_radius_files = ['FinalEvaluation/FixedRadius/dataframes/df_' + testname + '.pickle']
+    # jobs of single clusters write one dataframe each
+    df_fixed = pd.concat([pd.read_pickle(fname) for fname in fixed_radius_files], ignore_index=True)
+    layers = (load_layers(path1), load_layers(path2))
 
     models = []
     ins = []
@@ -151,6 +326,8 @@ def run_radius_optimization(testname, path1='mnist8x8_70p_retrain.h5', path2='mn
 
     stdout = sys.stdout
     for clno, cluster in enumerate(clusters_to_verify[:no_clusters]):
+        if clusters is not None and clno not in clusters:
+            continue
 
         radius_lo, radius_hi = find_radius(testname, clno, df_fixed)
 
@@ -168,7 +345,9 @@ def run_radius_optimization(testname, path1='mnist8x8_70p_retrain.h5', path2='mn
         enc, model = encode_r_opt(path1, path2, inl, inh, cluster.center, radius_lo,
                                   radius_hi, mode, time_limit=timer_stop)
         models.append(model)
-        model.optimize()
+        telemetry = SolverTelemetry(model)
+        validation = validated_optimize(model, layers, mode, 64, radius_mode=True, callback=telemetry)
+        telemetry.finalize(model)
 
         sys.stdout = stdout
 
@@ -208,17 +387,105 @@ def run_radius_optimization(testname, path1='mnist8x8_70p_retrain.h5', path2='mn
         else:
             eval_dict = {'testname': testname, 'cluster': clno}
 
+        eval_dict['validation'] = validation
+        eval_dict['telemetry'] = telemetry.to_dict()
         dict_list.append(eval_dict)
 
     df = pd.DataFrame(dict_list)
-    df.to_pickle(logdir + '/' + 'df_' + testname + '.pickle')
+    df.to_pickle(logdir + '/' + 'df_' + testname + clusters_suffix(clusters) + '.pickle')
 
     return models, ins, dict_list
 
 
+def run_radius_bisection(testname, path1='mnist8x8_70p_retrain.h5', path2='mnist8x8_80p_retrain.h5', no_clusters=10,
+                         metric='manhattan', logdir='FinalEvaluation/RadiusBisection', timer_stop=1800,
+                         mode='one_hot_partial_top_3', clusters=None, precision=0.1, probes=1, init_step=1/20,
+                         max_step=1/5, threads=None):
+    '''
+    Alternative to run_radius_optimization, brackets the radius of every cluster by fixed-radius queries on one
+    template per cluster (see radius_search) instead of solving the variable-radius MILP.
+
+    :param timer_stop: time limit of every fixed-radius query
+    :param precision: the search stops, when the bracket is smaller than precision
+    :param probes: number of radii queried in parallel in every round
+    :param init_step: the first radius queried is init_step * distance of the cluster
+    :param max_step: the template is encoded for radius max_step * distance of the cluster, larger radii are not
+        queried
+    :param threads: gurobi threads of the whole search (e.g. the threads of the job), split among the probes,
+        gurobi default if None
+    '''
+    path1 = examples + path1
+    path2 = examples + path2
+    inl = [0 for i in range(64)]
+    inh = [16 for i in range(64)]
+
+    fc.use_asymmetric_bounds = True
+    fc.use_context_groups = True
+    fc.use_grb_native = False
+    fc.use_eps_maximum = True
+    fc.manhattan_use_absolute_value = True
+    fc.epsilon = 1e-4
+
+    # 10 most dense clusters in hierarchical manhattan clustering of mnist8x8 training data
+    clusters_to_verify = pickle.load(open("to_verify.pickle", "rb"))
+
+    os.makedirs(logdir, exist_ok=True)
+
+    ins = []
+    dict_list = []
+
+    stdout = sys.stdout
+    for clno, cluster in enumerate(clusters_to_verify[:no_clusters]):
+        if clusters is not None and clno not in clusters:
+            continue
+
+        teststart = timer()
+
+        name = testname + '_' + metric + '_cluster_{cl}'.format(cl=clno)
+
+        logfile = logdir + '/' + name + '.txt'
+        sys.stdout = open(logfile, 'w')
+
+        res = search_radius(path1, path2, inl, inh, mode, cluster.center, metric, init_step * cluster.distance,
+                            max_step * cluster.distance, precision, probes, timer_stop, name=name,
+                            threads=None if threads is None else max(1, threads // probes))
+
+        sys.stdout = stdout
+
+        if res['inputs'] is not None:
+            inputs = res['inputs']
+        else:
+            inputs = 'No counterexample found for {}'.format(name)
+
+        ins.append(inputs)
+
+        fname = logdir + '/' + name + '.pickle'
+        with open(fname, 'wb') as fp:
+            pickle.dump(inputs, fp)
+
+        now = timer()
+        print('### {name} finished. Total time elapsed: {t}'.format(name=name, t=now - teststart))
+        print('    radius in [{lo}, {hi}] after {n} rounds'.format(lo=res['radius_lo'], hi=res['radius_hi'],
+                                                                  n=res['rounds']))
+
+        eval_dict = {'testname': testname, 'cluster': clno, 'radius': res['radius_lo'],
+                     'radius_lo': res['radius_lo'], 'radius_hi': res['radius_hi'], 'unknown': res['unknown'],
+                     'rounds': res['rounds'], 'queries': [dict(q, inputs=None) for q in res['queries']],
+                     'time': now - teststart, 'logfile': logfile, 'inputfile': fname}
+        dict_list.append(eval_dict)
+
+    df = pd.DataFrame(dict_list)
+    df.to_pickle(logdir + '/' + 'df_' + testname + clusters_suffix(clusters) + '.pickle')
+
+    return ins, dict_list
+
+
 def run_no_cluster_evaluation(testname, path1='mnist8x8_70p_retrain.h5', path2='mnist8x8_80p_retrain.h5',
                               logdir='FinalEvaluation', obj_stop=20, timer_stop=1800,
-                              mode='one_hot_partial_top_3'):
+                              mode='one_hot_partial_top_3', cache=None, falsify_samples=0):
+    # the best of falsify_samples samples is used as MIP start, if it violates equivalence by at least obj_stop,
+    # the termination policy stops the optimization right after the start is accepted (disabled by default, as
+    # in earlier sweeps)
     path1 = examples + path1
     path2 = examples + path2
     inl = [0 for i in range(64)]
@@ -230,11 +497,22 @@ def run_no_cluster_evaluation(testname, path1='mnist8x8_70p_retrain.h5', path2='
     logfile = logdir + '/' + testname + '.txt'
     sys.stdout = open(logfile, 'w')
 
-    model = encode_equiv(path1, path2, inl, inh, mode, testname)
-    # stop optimization, if counterexample with at least obj_stop difference is found
-    model.setParam('BestObjStop', obj_stop)
-    model.setParam('TimeLimit', timer_stop)
-    model.optimize()
+    falsification = None
+    if falsify_samples > 0:
+        falsification = falsify(path1, path2, SamplingRegion(inl, inh), int(mode.split('_')[-1]), obj_stop,
+                                falsify_samples)
+
+    model = encode_equiv(path1, path2, inl, inh, mode, testname, cache)
+    if falsification is not None and falsification['inputs'] is not None:
+        set_input_start(model, falsification['inputs'])
+
+    # stop optimization, if counterexample with at least obj_stop difference is found or equivalence is proven
+    policy = TerminationPolicy.for_equivalence(obj_stop, timer_stop)
+    telemetry = SolverTelemetry(model)
+    # cached models are optimized again later, so spurious solutions are not cut off
+    validation = validated_optimize(model, (load_layers(path1), load_layers(path2)), mode, 64, callback=telemetry,
+                                    optimize=policy.optimize, cut=cache is None)
+    telemetry.finalize(model)
 
     sys.stdout = stdout
     inputs = [model.getVarByName('i_0_{idx}'.format(idx=j)).X for j in range(64)]
@@ -250,6 +528,7 @@ def run_no_cluster_evaluation(testname, path1='mnist8x8_70p_retrain.h5', path2='
 
     eval_dict = {'testname': testname, 'obj': model.ObjVal, 'bound': model.ObjBound,
                  'time': now - teststart, 'logfile': logfile, 'inputfile': fname,
+                 'termination': policy.finalize(model), 'falsification': falsification, 'validation': validation,
                  'model_name': model.getAttr('ModelName'),
                  'BoundVio': model.getAttr('BoundVio'),
                  'BoundVioIndex': model.getAttr('BoundVioIndex'),
@@ -263,7 +542,8 @@ def run_no_cluster_evaluation(testname, path1='mnist8x8_70p_retrain.h5', path2='
                  'MaxCoeff': model.getAttr('MaxCoeff'),
                  'MaxRHS': model.getAttr('MaxRHS'),
                  'MinBound': model.getAttr('MinBound'),
-                 'MinCoeff': model.getAttr('MinCoeff')}
+                 'MinCoeff': model.getAttr('MinCoeff'),
+                 'telemetry': telemetry.to_dict()}
 
     with open(logdir + '/dict_' + testname + '.pickle', 'wb') as fp:
         pickle.dump(eval_dict, fp)
@@ -477,6 +757,8 @@ def evaluate_hierarchical_cluster(testname, path1='mnist8x8_70p_retrain.h5', pat
     # 10 most dense clusters in hierarchical manhattan clustering of mnist8x8 training data
     clusters_to_verify = pickle.load(open("to_verify.pickle", "rb"))
 
+    layers = (load_layers(path1), load_layers(path2))
+
     dims = 64
     steps = [1/2, 1/4, 1/5, 1/10, 1/20]
     #steps = [1/2, 1/30, 1/40]
@@ -501,11 +783,11 @@ def evaluate_hierarchical_cluster(testname, path1='mnist8x8_70p_retrain.h5', pat
 
         model = encode_equiv_radius(path1, path2, inl, inh, mode, cluster.center, r, metric, name)
 
-        model.setParam('BestObjStop', obj_stop)
-        model.setParam('BestBdStop', bd_stop)
-        model.setParam('TimeLimit', timer_stop)
+        policy = TerminationPolicy(counterexample_tol=obj_stop, equivalence_bound=bd_stop, time_budget=timer_stop)
         models.append(model)
-        model.optimize()
+        telemetry = SolverTelemetry(model)
+        validation = validated_optimize(model, layers, mode, 64, callback=telemetry, optimize=policy.optimize)
+        telemetry.finalize(model)
 
         sys.stdout = stdout
         inputs = [model.getVarByName('i_0_{idx}'.format(idx=j)).X for j in range(64)]
@@ -522,7 +804,9 @@ def evaluate_hierarchical_cluster(testname, path1='mnist8x8_70p_retrain.h5', pat
         print('    ins = {i}'.format(i=str(inputs)))
 
         eval_dict = {'testname': testname, 'cluster': clno, 'step': s, 'radius': r, 'obj': model.ObjVal,
-                     'bound': model.ObjBound, 'time': now - teststart, 'logfile': logfile, 'inputfile': fname}
+                     'bound': model.ObjBound, 'time': now - teststart, 'logfile': logfile, 'inputfile': fname,
+                     'termination': policy.finalize(model), 'validation': validation}
+        eval_dict['telemetry'] = telemetry.to_dict()
         dict_list.append(eval_dict)
 
         # only check radius from above, until nns no longer different
@@ -611,7 +895,10 @@ def evaluate_radius_optimization(testname, radius_lo, radius_hi, path1='mnist8x8
         model.update()
 
     models.append(model)
-    model.optimize()
+    telemetry = SolverTelemetry(model)
+    validation = validated_optimize(model, (load_layers(path1), load_layers(path2)), mode, 64, radius_mode=True,
+                                    callback=telemetry)
+    telemetry.finalize(model)
 
     sys.stdout = stdout
 
@@ -651,6 +938,8 @@ def evaluate_radius_optimization(testname, radius_lo, radius_hi, path1='mnist8x8
     else:
         eval_dict = {'testname': testname, 'cluster': clno}
 
+    eval_dict['validation'] = validation
+    eval_dict['telemetry'] = telemetry.to_dict()
     dict_list.append(eval_dict)
 
     df = pd.DataFrame(dict_list)
@@ -781,4 +1070,118 @@ def run_additional_evaluation_radius_opt(time_limit=60*60*5, testrun=False, k_st
     df = pd.DataFrame(dicts_list)
     df.to_pickle(directory + df_name + '.pickle')
 
-    return model_list, ins_list, dicts_list, empty_tests
\ No newline at end of file
+    return model_list, ins_list, dicts_list, empty_tests
+
+
+def expand_sweep(driver, ks=(1, 2, 3), nns=None, pairs=None, clusters=None, testrun=False, threads=1,
+                 depends_on=None, job_timeout=None, **kwargs):
+    '''
+    Expands a sweep over k, pairs of nns and clusters into independent jobs.
+
+    :param driver: clusters (run_hierarchical_cluster_evaluation), no_clusters (run_no_cluster_evaluation),
+        radius_opt (run_radius_optimization) or radius_bisection (run_radius_bisection)
+    :param ks: values of k for one_hot_partial_top_k
+    :param nns: names of the nns in ExampleNNs
+    :param pairs: list of index pairs (i, j) into nns, all (i, j) with i < j if None
+    :param clusters: indices of the clusters, one job per cluster (not for no_clusters), one job for all clusters
+        of a pair if None
+    :param testrun: if True, the time limit of every optimization is 20s instead of 30mins
+    :param threads: gurobi threads of every job
+    :param depends_on: list of jobs, every job waits for the jobs in depends_on with the same testname
+        (e.g. radius_opt jobs for the clusters jobs, whose results they use), radius_opt jobs then read the
+        dataframes of the clusters jobs in depends_on instead of FinalEvaluation/FixedRadius/dataframes
+    :param job_timeout: time in seconds, after which a job is killed (and retried in the next run with a ledger)
+    :param kwargs: additional keyword arguments for the driver
+    :return: list of Jobs
+    '''
+    drivers = {'clusters': run_hierarchical_cluster_evaluation, 'no_clusters': run_no_cluster_evaluation,
+               'radius_opt': run_radius_optimization, 'radius_bisection': run_radius_bisection}
+    if driver not in drivers:
+        raise ValueError('Driver {d} is not supported!\nSupported drivers are: \n\t{s}'.format(
+            d=driver, s=', '.join(drivers.keys())))
+
+    if nns is None:
+        nns = ['mnist8x8_lin.h5', 'mnist8x8_student_18_18_10.h5', 'mnist8x8_student_30_10.h5',
+               'mnist8x8_70p_retrain.h5', 'mnist8x8_50p_retrain.h5', 'mnist8x8_20p_retrain.h5']
+
+    if pairs is None:
+        pairs = [(i, j) for i in range(len(nns)) for j in range(i + 1, len(nns))]
+
+    if driver == 'no_clusters' or clusters is None:
+        cluster_jobs = [None]
+    else:
+        cluster_jobs = [[c] for c in clusters]
+
+    # 30mins time limit for each optimization
+    timer_stop = 20 if testrun else 60*30
+
+    jobs = []
+    for k in ks:
+        mode = 'one_hot_partial_top_{}'.format(k)
+        for i, j in pairs:
+            # [:-3] to exclude .h5 from name
+            testname = '{}_vs_{}_{}'.format(nns[i][:-3], nns[j][:-3], mode)
+            for cl in cluster_jobs:
+                job_kwargs = dict({'testname': testname, 'path1': nns[i], 'path2': nns[j], 'mode': mode,
+                                   'timer_stop': timer_stop}, **kwargs)
+                name = driver + '_' + testname
+                if cl is not None:
+                    job_kwargs['clusters'] = cl
+                    name += clusters_suffix(cl)
+                if driver == 'radius_bisection':
+                    # the probes of the search run in their own processes, which don't inherit the threads of the job
+                    job_kwargs.setdefault('threads', threads)
+
+                depends = [] if depends_on is None else \
+                    [job for job in depends_on if job.kwargs['testname'] == testname]
+                fixed_radius_files = [cluster_dataframe_file(testname, job.kwargs.get('clusters')) for job in depends
+                                      if job.func == run_hierarchical_cluster_evaluation]
+                if driver == 'radius_opt' and fixed_radius_files:
+                    job_kwargs.setdefault('fixed_radius_files', fixed_radius_files)
+                jobs.append(Job(name, drivers[driver], job_kwargs, threads, [job.name for job in depends],
+                                job_timeout))
+
+    return jobs
+
+
+def run_final_evaluation_parallel(jobs, cores=None, logdir='FinalEvaluation/Jobs', df_name='df_parallel',
+                                  ledger=None, store=None, queue_dir=None):
+    '''
+    Runs the jobs (e.g. from expand_sweep) in parallel, the evaluation dicts are saved as dataframe in
+    logdir/df_name.pickle after every finished job. With a ResultsStore, they are also appended to the store
+    together with the name and spec hash of the job (results of jobs cached in the ledger are only added once).
+
+    With a queue_dir, the jobs are not run locally, but submitted to the shared queue and run by the workers
+    started on the nodes (see fs_queue), the ledger is not used then, as the queue keeps the finished jobs itself.
+
+    Instead of restarting a sweep with k_start, nn1start, ... after a crash, the same sweep can just be run again
+    with the same ledger (e.g. Ledger(logdir + '/ledger.sqlite')): finished jobs are skipped (their results are
+    still included in the dataframe), failed and timed out jobs are retried according to the RetryPolicy.
+
+    :return: list of results of run_jobs (in the order the jobs finished)
+    '''
+    results = []
+    dict_list = []
+    jobs_by_name = {job.name: job for job in jobs}
+    if queue_dir is None:
+        job_results = run_jobs(jobs, cores, logdir, ledger=ledger)
+    else:
+        os.makedirs(logdir, exist_ok=True)
+        submit(queue_dir, jobs)
+        job_results = collect(queue_dir, [job.name for job in jobs])
+
+    for res in job_results:
+        results.append(res)
+
+        if res['status'] == 'finished':
+            dicts = res['result'] if isinstance(res['result'], list) else [res['result']]
+            dict_list += [dict(d, job=res['name']) for d in dicts]
+
+            if store is not None:
+                job = jobs_by_name[res['name']]
+                store.append(dicts, job=job.name, spec_hash=spec_hash(job.func, job.kwargs))
+
+            df = pd.DataFrame(dict_list)
+            df.to_pickle(logdir + '/' + df_name + '.pickle')
+
+    return results
@@ -1,5 +1,6 @@
 from expression import Expression, Variable, ffp
 from expression_encoding import flatten, encode_NN_from_file, interval_arithmetic
+from forward_evaluation import ForwardEvaluator
 import gurobipy as grb
 import numpy as np
 import matplotlib.pyplot as plt
@@ -70,19 +71,23 @@ def check_outputs(nn_file, ins, sort=True, printing=True):
     return outs
 
 
-def calculate_violation(ins, path1, path2, top_k=1):
-    outs1 = check_outputs(path1, ins, sort=False, printing=False)
-    outs2 = check_outputs(path2, ins, sort=False, printing=False)
+def calculate_violation(ins, path1, path2, top_k=1, evaluator=None):
+    return calculate_violations([ins], path1, path2, top_k, evaluator)[0]
 
-    a_idx = np.argmax([a.lo for a in outs1])
-    b_atop = outs2[a_idx]
 
-    outs1 = sorted(outs1, key=lambda x: -x.lo)
-    outs2 = sorted(outs2, key=lambda x: -x.lo)
-
-    b_k = outs2[top_k - 1]
+def calculate_violations(ins_list, path1, path2, top_k=1, evaluator=None):
+    """
+    Calculates the top-k violation for a batch of inputs, a violation > 0 means that the NNs are not
+    top-k equivalent for that input.
 
-    return b_k.lo - b_atop.lo
+    :param ins_list: list or array of shape (N, d) of inputs
+    :param evaluator: ForwardEvaluator of the NNs, loaded from path1, path2 if None (pass it, when calculating
+        violations for the same NNs repeatedly, to load them only once)
+    :return: array of shape (N,) with the violations
+    """
+    if evaluator is None:
+        evaluator = ForwardEvaluator(path1, path2)
+    return evaluator.violations(np.array(ins_list, dtype=float), top_k)
 
 def compare_outputs(nn1, nn2, ins, sort=False):
     outs1 = check_outputs(nn1, ins, sort, printing=False)
@@ -287,6 +292,36 @@ def update_dict_from_log(dict, logfile=None, added_dirs=''):
     return dict
 
 
+def get_telemetry_table(telemetry, res_name=''):
+    '''
+    :param telemetry: dict of SolverTelemetry.to_dict()
+    :return: DataFrame with columns time, incumbent, bound, gap, nodes, solutions
+    '''
+    table = pd.DataFrame(telemetry['series'])
+
+    if not res_name == '':
+        table.name = res_name
+
+    return table
+
+
+def update_dict_from_telemetry(dict, telemetry=None):
+    """
+    Adds the sizes and final results of the solve recorded by a SolverTelemetry to dict
+    (replaces update_dict_from_log for runs with telemetry).
+
+    :param dict: dictionary with field telemetry
+    :param telemetry: dict of SolverTelemetry.to_dict(), if None dict['telemetry'] is used
+    :return: updated dict
+    """
+    if telemetry is None:
+        telemetry = dict['telemetry']
+
+    dict.update(telemetry['info'])
+
+    return dict
+
+
 def update_dict_split_testname(dict):
     """
     Adds fields nn1, nn2, top_k to dict by splitting field testname.
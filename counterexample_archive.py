@@ -0,0 +1,176 @@
+'''
+Archive of counterexamples found in previous runs, used to seed MIP starts.
+
+Counterexamples are stored per pair of NNs (sha256 hash of the NN files) and equivalence mode in
+    archive_dir/key.pickle - list of entries {'inputs', 'value', 'region', 'source'}
+Before a solve, all archived points within the current input region are evaluated with the vectorized forward
+evaluation and the best one is passed as MIP start. Several processes may add to the same archive, the pickle of a
+key is only rewritten while holding the lock file key.lock.
+'''
+from forward_evaluation import forward
+from gradient_attack import objective
+from falsification import set_input_start
+import numpy as np
+import hashlib
+import socket
+import pickle
+import fcntl
+import os
+
+
+def complete_start(model, inputs, time_limit=1):
+    '''
+    Completes values for the input variables i_0_j to values for all variables of the model by fixing the inputs
+    in a copy of the model and optimizing it (the values of the NN variables are then determined by presolve).
+
+    The forward evaluation only yields the values of the neurons, but not of the other variables of the encoding
+    (ReLU indicators, big-M deltas, the ordering and permutation variables of the top-k comparison, ...), whose names
+    and semantics depend on the encoding flags. Therefore the remaining values are obtained by a solve, which stops
+    at the first solution, as the fixed inputs determine the objective.
+
+    :param model: gurobi model
+    :param inputs: values of the input variables
+    :param time_limit: time limit in seconds for the completion
+    :return: tuple (dict of variable names and values, objective value) or (None, None), if the inputs can't be
+        completed (e.g. they lie outside of the region of the model)
+    '''
+    model.update()
+    m = model.copy()
+    m.setParam('OutputFlag', 0)
+    m.setParam('TimeLimit', time_limit)
+    m.setParam('SolutionLimit', 1)
+
+    for j, val in enumerate(inputs):
+        v = m.getVarByName('i_0_{idx}'.format(idx=j))
+        val = min(max(val, v.LB), v.UB)
+        v.LB = val
+        v.UB = val
+
+    m.optimize()
+    if m.SolCount == 0:
+        return None, None
+
+    grb_vars = m.getVars()
+    values = dict(zip(m.getAttr('VarName', grb_vars), m.getAttr('X', grb_vars)))
+    return values, m.ObjVal
+
+
+class CounterexampleArchive:
+
+    def __init__(self, archive_dir='CounterexampleArchive'):
+        self.archive_dir = archive_dir
+        os.makedirs(archive_dir, exist_ok=True)
+
+    def get_key(self, path1, path2, mode):
+        h = hashlib.sha256()
+        for path in [path1, path2]:
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        h.update(mode.encode())
+        return h.hexdigest()
+
+    def get_file(self, key):
+        return os.path.join(self.archive_dir, key + '.pickle')
+
+    def read_entries(self, fname):
+        if not os.path.exists(fname):
+            return []
+
+        with open(fname, 'rb') as fp:
+            return pickle.load(fp)
+
+    def get_entries(self, path1, path2, mode):
+        return self.read_entries(self.get_file(self.get_key(path1, path2, mode)))
+
+    def add(self, path1, path2, mode, inputs, value=None, region=None, source=None):
+        '''
+        Adds a counterexample to the archive.
+
+        :param inputs: input values of the counterexample
+        :param value: objective value of the counterexample
+        :param region: dict describing the region, the counterexample was found in (e.g. center, radius, metric)
+        :param source: name of the run or file, the counterexample originates from
+        '''
+        key = self.get_key(path1, path2, mode)
+        fname = self.get_file(key)
+        tmp = '{f}.{h}_{p}.tmp'.format(f=fname, h=socket.gethostname(), p=os.getpid())
+
+        # readers don't need the lock, as the pickle is replaced atomically
+        with open(os.path.join(self.archive_dir, key + '.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = self.read_entries(fname)
+                entries.append({'inputs': np.array(inputs, dtype=float), 'value': value, 'region': region,
+                                'source': source})
+
+                with open(tmp, 'wb') as fp:
+                    pickle.dump(entries, fp)
+                os.replace(tmp, fname)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def add_from_pickle(self, path1, path2, mode, pickle_file, region=None):
+        '''
+        Imports the inputs pickled by the evaluation drivers (e.g. FinalEvaluation/*/inputs/*.pickle).
+        Files not containing a list of numbers (e.g. 'No Solution found for ...') are skipped.
+        :return: True, if the inputs were added
+        '''
+        with open(pickle_file, 'rb') as fp:
+            inputs = pickle.load(fp)
+
+        if isinstance(inputs, str):
+            return False
+
+        self.add(path1, path2, mode, inputs, region=region, source=pickle_file)
+        return True
+
+    def get_best(self, path1, path2, mode, layers, region):
+        '''
+        :param layers: tuple of layer lists of both NNs
+        :param region: SamplingRegion (or any object with contains(X)) of the current query
+        :return: tuple (inputs, objective value) of the best archived point within the region or (None, None)
+        '''
+        entries = self.get_entries(path1, path2, mode)
+        if not entries:
+            return None, None
+
+        X = np.array([e['inputs'] for e in entries])
+        X = X[region.contains(X, 1e-6)]
+        if len(X) == 0:
+            return None, None
+
+        values, _, _ = objective(forward(layers[0], X), forward(layers[1], X), mode)
+        idx = np.argmax(values)
+        return X[idx], values[idx]
+
+    def seed_mip_start(self, model, path1, path2, mode, layers, region, complete=False, printing=True):
+        '''
+        Sets the best archived point within the region as MIP start.
+
+        :param complete: if True, the point is completed to all variables of the model by complete_start, otherwise
+            only the input variables are set and gurobi completes the partial MIP start within the solve
+        :return: objective value of the MIP start (the forward evaluation, if not completed) or None, if no
+            archived point could be used
+        '''
+        inputs, value = self.get_best(path1, path2, mode, layers, region)
+        if inputs is None:
+            return None
+
+        if not complete:
+            set_input_start(model, inputs)
+            if printing:
+                print('### partial MIP start from archive: forward evaluation = {v}'.format(v=value))
+            return value
+
+        start, obj = complete_start(model, inputs)
+        if start is None:
+            return None
+
+        grb_vars = model.getVars()
+        model.setAttr('Start', grb_vars, [start[v.VarName] for v in grb_vars])
+        model.update()
+
+        if printing:
+            print('### MIP start from archive: objective = {o} (forward evaluation: {v})'.format(o=obj, v=value))
+
+        return obj
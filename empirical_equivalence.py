@@ -0,0 +1,136 @@
+'''
+Empirical equivalence of NNs on a dataset.
+
+Every NN is evaluated once on the whole dataset with the vectorized forward evaluation (the logits are cached on
+disk), afterwards pairwise top-k disagreement rates, confusion between the predictions of two NNs and
+violation statistics per cluster are calculated from the cached logits. This shows which pairs of NNs and
+which clusters are worth formal verification.
+'''
+from forward_evaluation import load_layers, forward, top_k_violation
+from timeit import default_timer as timer
+import numpy as np
+import pandas as pd
+import itertools as itt
+import hashlib
+import os
+
+
+def load_digits_data():
+    '''
+    :return: tuple (inputs of shape (1797, 64) with values in [0, 16], labels) of the sklearn digits dataset
+    '''
+    from sklearn.datasets import load_digits
+
+    digits = load_digits()
+    return digits.data, digits.target
+
+
+class LogitCache:
+
+    def __init__(self, cache_dir='LogitCache'):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, path, X):
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            h.update(hashlib.sha256(f.read()).digest())
+        h.update(np.ascontiguousarray(X, dtype=float).tobytes())
+        return h.hexdigest()
+
+    def get_logits(self, path, X):
+        '''
+        :return: outputs of the NN at path for all rows of X, loaded from the cache if available
+        '''
+        fname = os.path.join(self.cache_dir, self.get_key(path, X) + '.npy')
+        if os.path.exists(fname):
+            return np.load(fname)
+
+        logits = forward(load_layers(path), X)
+        np.save(fname + '.tmp.npy', logits)
+        os.replace(fname + '.tmp.npy', fname)
+        return logits
+
+
+def nearest_cluster(X, clusters):
+    '''
+    :param clusters: list of cluster centers or ClusterTrees
+    :return: index of the nearest cluster center (manhattan distance) for every row of X
+    '''
+    centers = np.array([c.center if hasattr(c, 'center') else c for c in clusters], dtype=float)
+    dists = np.abs(X[:, None, :] - centers[None, :, :]).sum(axis=2)
+    return np.argmin(dists, axis=1)
+
+
+def empirical_report(paths, X, y=None, top_k=1, clusters=None, cache=None, printing=True):
+    '''
+    :param paths: paths to the NNs
+    :param X: dataset of shape (N, d)
+    :param y: labels of the dataset, if given, the accuracy of every NN is reported
+    :param top_k: k of top-k equivalence
+    :param clusters: list of cluster centers or ClusterTrees, if given, violations are also reported per cluster
+        (every sample is assigned to its nearest cluster center)
+    :param cache: LogitCache, logits are not cached if None
+    :param printing: if True, the tables are printed
+    :return: dict with fields
+        disagreement - DataFrame with the rate of inputs, for which the top-1 class of the NN of the row is not in
+                       the top-k classes of the NN of the column
+        confusion    - dict of (name1, name2) and DataFrames counting inputs with top-1 class i for NN 1 and j for NN 2
+        clusters     - DataFrame with number of samples, violation rate, mean and max violation per pair and cluster
+        accuracy     - dict of NN names and their accuracy (if y is given)
+        time         - total time in seconds
+    '''
+    start = timer()
+    X = np.asarray(X, dtype=float)
+    names = [os.path.basename(p).rsplit('.', 1)[0] for p in paths]
+
+    logits = {}
+    for name, path in zip(names, paths):
+        logits[name] = cache.get_logits(path, X) if cache is not None else forward(load_layers(path), X)
+
+    predictions = {name: np.argmax(l, axis=1) for name, l in logits.items()}
+
+    disagreement = pd.DataFrame(0.0, index=names, columns=names)
+    confusion = {}
+    violations = {}
+    for n1, n2 in itt.permutations(names, 2):
+        violations[(n1, n2)] = top_k_violation(logits[n1], logits[n2], top_k)
+        disagreement.loc[n1, n2] = np.mean(violations[(n1, n2)] > 0)
+
+    for n1, n2 in itt.combinations(names, 2):
+        num_classes = max(logits[n1].shape[1], logits[n2].shape[1])
+        counts = np.zeros((num_classes, num_classes), dtype=int)
+        np.add.at(counts, (predictions[n1], predictions[n2]), 1)
+        confusion[(n1, n2)] = pd.DataFrame(counts)
+
+    report = {'disagreement': disagreement, 'confusion': confusion}
+
+    if clusters is not None:
+        assignment = nearest_cluster(X, clusters)
+        rows = []
+        for (n1, n2), vio in violations.items():
+            for clno in range(len(clusters)):
+                v = vio[assignment == clno]
+                if len(v) == 0:
+                    continue
+                rows.append({'nn1': n1, 'nn2': n2, 'cluster': clno, 'samples': len(v),
+                             'violation_rate': np.mean(v > 0), 'mean_violation': np.mean(v),
+                             'max_violation': np.max(v)})
+        report['clusters'] = pd.DataFrame(rows)
+
+    if y is not None:
+        report['accuracy'] = {name: np.mean(pred == y) for name, pred in predictions.items()}
+
+    report['time'] = timer() - start
+
+    if printing:
+        print('### top-{k} disagreement rates (top-1 of row not in top-{k} of column):'.format(k=top_k))
+        print(disagreement.round(4))
+        if y is not None:
+            print('### accuracy: {a}'.format(a=report['accuracy']))
+        if clusters is not None and len(report['clusters']) > 0:
+            print('### clusters with highest violation rates:')
+            print(report['clusters'].sort_values('violation_rate', ascending=False).head(10))
+        print('### Total Time elapsed: {t}'.format(t=report['time']))
+
+    return report
@@ -1,8 +1,10 @@
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from numpy import format_float_positional
+import threading
 import numbers
 import flags_constants as fc
-import gurobipy as grb
+import milp_backend as mb
 
 
 
@@ -39,6 +41,113 @@ def makeGt(lhs, rhs):
     return makeLt(rhs, lhs)
 
 
+class SmtlibTermTable:
+    '''
+    Table of sums, that are serialized more than once when the SMT-LIB representation of an encoding is built.
+
+    In a first pass over the constraints, the number of serializations of each sum, that is part of the
+    encoding, is counted. In the second pass every sum counted more than once is emitted once as
+    (define-fun t_k () Sort (+ ...)) and referenced by its name t_k afterwards.
+    The definitions collected while serializing a constraint have to be emitted before the constraint.
+    '''
+
+    def __init__(self, constraints):
+        self.candidates = {}
+        for c in constraints:
+            self.collect_sums(c)
+
+        self.counting = True
+        self.counts = {}
+        self.names = {}
+        self.pending = []
+
+    def collect_sums(self, expr):
+        # only sums, that are part of the encoding are considered, temporary sums created during
+        # serialization could get the id of an already garbage collected sum
+        for v in vars(expr).values():
+            children = v if isinstance(v, list) else [v]
+            for child in children:
+                if isinstance(child, Expression) and not isinstance(child, (Variable, Constant)):
+                    if isinstance(child, Sum):
+                        if id(child) in self.candidates:
+                            continue
+                        self.candidates[id(child)] = child
+                    self.collect_sums(child)
+
+    def finish_counting(self):
+        self.counting = False
+
+    def has_shared_terms(self):
+        return any(count > 1 for count in self.counts.values())
+
+    def pop_definitions(self):
+        definitions = self.pending
+        self.pending = []
+        return definitions
+
+    def to_smtlib(self, sum_expr):
+        key = id(sum_expr)
+        if key not in self.candidates:
+            return sum_expr.serialize_smtlib()
+
+        if self.counting:
+            self.counts[key] = self.counts.get(key, 0) + 1
+            return sum_expr.serialize_smtlib()
+
+        if key in self.names:
+            return self.names[key]
+
+        if self.counts.get(key, 0) < 2:
+            return sum_expr.serialize_smtlib()
+
+        # definitions of nested shared terms are added to pending during serialization of the body
+        body = sum_expr.serialize_smtlib()
+        name = 't_' + str(len(self.names))
+        self.names[key] = name
+        self.pending.append('(define-fun ' + name + ' () ' + smtlib_sort(sum_expr) + ' ' + body + ')')
+
+        return name
+
+
+# term table of the thread, set only while constraints are serialized with shared terms (never across the yields
+# of iter_smtlib, s.t. other serializations in between aren't affected)
+_smtlib_state = threading.local()
+
+
+def get_smtlib_terms():
+    return getattr(_smtlib_state, 'terms', None)
+
+
+@contextmanager
+def use_smtlib_terms(table):
+    previous = get_smtlib_terms()
+    _smtlib_state.terms = table
+    try:
+        yield table
+    finally:
+        _smtlib_state.terms = previous
+
+
+def smtlib_sort(expr):
+    if isinstance(expr, Variable):
+        return expr.type
+    elif isinstance(expr, Constant):
+        return 'Int' if isinstance(expr.value, numbers.Integral) else 'Real'
+    elif isinstance(expr, Sum):
+        children = expr.children
+    elif isinstance(expr, Neg):
+        children = [expr.input]
+    elif isinstance(expr, Multiplication):
+        children = [expr.constant, expr.variable]
+    else:
+        return 'Real'
+
+    if all(smtlib_sort(c) == 'Int' for c in children):
+        return 'Int'
+    else:
+        return 'Real'
+
+
 class Expression(ABC):
 
     def __init__(self, net, layer, row):
@@ -162,8 +271,8 @@ class Variable(Expression):
         return bounds
 
     def register_to_gurobi(self, model):
-        lower = - grb.GRB.INFINITY
-        upper = grb.GRB.INFINITY
+        lower = - mb.INFINITY
+        upper = mb.INFINITY
         var_type = None
         if self.hasHi:
             upper = self.hi
@@ -172,9 +281,9 @@ class Variable(Expression):
         # only types used are Int and Real
         # for Int only 0-1 are used -> Binary for gurobi
         if self.type == 'Int':
-            var_type = grb.GRB.BINARY
+            var_type = mb.BINARY
         else:
-            var_type = grb.GRB.CONTINUOUS
+            var_type = mb.CONTINUOUS
 
         self.grb_var = model.addVar(lb=lower, ub=upper, vtype=var_type, name=self.name)
         self.has_grb_var = True
@@ -214,6 +323,13 @@ class Sum(Expression):
         super(Sum, self).update_bounds(l, h)
 
     def to_smtlib(self):
+        terms = get_smtlib_terms()
+        if terms is not None:
+            return terms.to_smtlib(self)
+
+        return self.serialize_smtlib()
+
+    def serialize_smtlib(self):
         sum = '(+'
         for term in self.children:
             sum += ' ' + term.to_smtlib()
@@ -222,7 +338,7 @@ class Sum(Expression):
         return sum
 
     def to_gurobi(self, model):
-        return grb.quicksum([t.to_gurobi(model) for t in self.children])
+        return model.quicksum([t.to_gurobi(model) for t in self.children])
 
     def __repr__(self):
         sum = '(' + str(self.children[0])
@@ -378,7 +494,7 @@ class Relu(Expression):
             # relu must be inactive
             ret_constr = model.addConstr(self.output.to_gurobi(model) == 0, name=c_name)
         elif fc.use_grb_native:
-            ret_constr = model.addConstr(self.output.to_gurobi(model) == grb.max_(self.input.to_gurobi(model), 0), name=c_name)
+            ret_constr = model.addConstr(self.output.to_gurobi(model) == model.max_(self.input.to_gurobi(model), 0), name=c_name)
         elif fc.use_asymmetric_bounds:
             model.addConstr(self.output.to_gurobi(model) >= 0, name=c_name + '_a')
             model.addConstr(self.output.to_gurobi(model) >= self.input.to_gurobi(model), name=c_name + '_b')
@@ -471,7 +587,7 @@ class Max(Expression):
         return enc
 
     def to_gurobi(self, model):
-        return model.addConstr(self.output.to_gurobi(model) == grb.max_(self.in_a.to_gurobi(model), self.in_b.to_gurobi(model)))
+        return model.addConstr(self.output.to_gurobi(model) == model.max_(self.in_a.to_gurobi(model), self.in_b.to_gurobi(model)))
 
     def __repr__(self):
         return str(self.output) +  ' = max(' + str(self.in_a) + ', ' + str(self.in_b) + ')'
@@ -665,6 +781,79 @@ class Gt_Int(Expression):
         return str(self.lhs) + ' > ' + str(self.rhs) + ' <==> ' + str(self.delta) + ' = 1'
 
 
+class Xor(Expression):
+    # returns 1, iff exactly one of the binary inputs in_a, in_b is 1, 0 otherwise
+    # the output is implied to be integral by the four inequalities, if in_a and in_b are binary,
+    # so it doesn't need to be an integer variable itself
+
+    def __init__(self, in_a, in_b, output):
+        net, layer, row = output.getIndex()
+        super(Xor, self).__init__(net, layer, row)
+        self.in_a = in_a
+        self.in_b = in_b
+        self.output = output
+        self.output.setLo(0)
+        self.output.setHi(1)
+        self.lo = 0
+        self.hi = 1
+
+    def tighten_interval(self):
+        la = self.in_a.getLo()
+        ha = self.in_a.getHi()
+        lb = self.in_b.getLo()
+        hb = self.in_b.getHi()
+
+        if la == ha and lb == hb:
+            # both inputs fixed
+            l = abs(la - lb)
+            h = l
+        elif ha <= 0:
+            # a = 0 -> output = b
+            l = lb
+            h = hb
+        elif la >= 1:
+            # a = 1 -> output = 1 - b
+            l = 1 - hb
+            h = 1 - lb
+        elif hb <= 0:
+            l = la
+            h = ha
+        elif lb >= 1:
+            l = 1 - ha
+            h = 1 - la
+        else:
+            l = 0
+            h = 1
+
+        self.output.update_bounds(l, h)
+        super(Xor, self).update_bounds(l, h)
+
+    def to_smtlib(self):
+        enc = makeGeq(self.output.to_smtlib(), Sum([self.in_a, Neg(self.in_b)]).to_smtlib())
+        enc += '\n' + makeGeq(self.output.to_smtlib(), Sum([self.in_b, Neg(self.in_a)]).to_smtlib())
+        enc += '\n' + makeLeq(self.output.to_smtlib(), Sum([self.in_a, self.in_b]).to_smtlib())
+        enc += '\n' + makeLeq(Sum([self.output, self.in_a, self.in_b]).to_smtlib(), '2')
+
+        return enc
+
+    def to_gurobi(self, model):
+        c_name = 'Xor_{net}_{layer}_{row}'.format(net=self.net, layer=self.layer, row=self.row)
+
+        out = self.output.to_gurobi(model)
+        a = self.in_a.to_gurobi(model)
+        b = self.in_b.to_gurobi(model)
+
+        model.addConstr(out >= a - b, name=c_name + '_a')
+        model.addConstr(out >= b - a, name=c_name + '_b')
+        model.addConstr(out <= a + b, name=c_name + '_c')
+        ret_constr = model.addConstr(out <= 2 - a - b, name=c_name + '_d')
+
+        return ret_constr
+
+    def __repr__(self):
+        return str(self.output) + ' = ' + str(self.in_a) + ' XOR ' + str(self.in_b)
+
+
 class Geq(Expression):
     # TODO: no return value as no real expression, just a constraint (better idea where to put it?)
     # could return 0/1 but would need more complicated delta stmt instead of just proxy for printing geq
@@ -982,7 +1171,7 @@ class Abs(Expression):
             # inputs is negative
             ret_constr = model.addConstr(self.output.to_gurobi(model) == - self.input.to_gurobi(model), name=c_name)
         elif fc.use_grb_native:
-            ret_constr = model.addConstr(self.output.to_gurobi(model) == grb.abs_(self.input.to_gurobi(model)), name=c_name)
+            ret_constr = model.addConstr(self.output.to_gurobi(model) == model.abs_(self.input.to_gurobi(model)), name=c_name)
         else:
             out_bound = max(abs(self.input.getLo()), abs(self.input.getHi()))
             bigM1 = out_bound + self.input.getHi()
@@ -1,10 +1,13 @@
 
 from expression import Variable, Linear, Relu, Max, Multiplication, Constant, Sum, Neg, One_hot, Greater_Zero, \
-    Geq, BinMult, Gt_Int, Impl, IndicatorToggle, TopKGroup, ExtremeGroup, Abs
+    Geq, BinMult, Gt_Int, Impl, IndicatorToggle, TopKGroup, ExtremeGroup, Abs, Xor
+import expression
 from keras_loader import KerasLoader
 from onnx_loader import OnnxLoader
-import gurobipy as grb
+import milp_backend as mb
 import datetime
+import gzip
+from timeit import default_timer as timer
 import flags_constants as fc
 
 def flatten(collection):
@@ -404,6 +407,23 @@ def encode_equivalence_layer(outs1, outs2, mode='diff_zero'):
         elif desired == 'equal':
             desired_result = 0
 
+        if fc.use_xor_one_hot_comparison:
+            # one xor indicator per index, s.t. only coefficients of 1 are needed
+            # instead of weighting index i by 2^i
+            for i, (a, b) in enumerate(zip(oh1, oh2)):
+                xor = Variable(i, row, net, 'dx')
+                oh_constraints.append(Xor(a, b, xor))
+                oh_deltas.append(xor)
+
+            if desired == 'different':
+                # at least one index, where the vectors differ
+                oh_constraints.append(Geq(Sum(oh_deltas), Constant(1, net, layer, row)))
+            else:
+                # no index, where the vectors differ
+                oh_constraints.append(Geq(Constant(0, net, layer, row), Sum(oh_deltas)))
+
+            return oh_deltas, oh_diffs, oh_constraints
+
         terms = []
         x = 1
         for i, (oh1, oh2) in enumerate(zip(oh1, oh2)):
@@ -886,11 +906,14 @@ def pretty_print(vars, constraints):
         print(c)
 
 
-def print_to_smtlib(vars, constraints):
-    preamble = '(set-option :produce-models true)\n(set-logic AUFLIRA)'
-    suffix = '(check-sat)\n(get-model)'
-    decls = '; ### Variable declarations ###'
-    bounds = '; ### Variable bounds ###'
+def iter_smtlib(vars, constraints, assertions=None):
+    '''
+    Generator for the SMT-LIB representation of the encoding, yields the preamble, declarations, bounds and
+    asserts one after another, s.t. the whole file never has to be held in memory.
+    :param assertions: additional SMT-LIB asserts (strings) added before (check-sat), e.g. the negation of the
+        equivalence property
+    '''
+    yield '(set-option :produce-models true)\n(set-logic AUFLIRA)'
 
     def is_input_or_delta(var_name):
         # distinguish deltas, inputs and other intermediate vars
@@ -898,32 +921,110 @@ def print_to_smtlib(vars, constraints):
         # and only inputs contain i
         return 'd' in var_name or 'i' in var_name
 
+    yield '\n; ### Variable declarations ###'
+    for var in flatten(vars):
+        yield '\n' + var.get_smtlib_decl()
+
+    yield '\n; ### Variable bounds ###'
     for var in flatten(vars):
-        decls += '\n' + var.get_smtlib_decl()
         bound = var.get_smtlib_bounds()
         if not bound == '':
             if fc.hide_non_deltas:
                 # TODO: find better way to exclude non-delta and input bounds
                 # independent of string representation
                 if is_input_or_delta(var.to_smtlib()):
-                    bounds += '\n' + var.get_smtlib_bounds()
+                    yield '\n' + bound
             else:
-                bounds += '\n' + var.get_smtlib_bounds()
+                yield '\n' + bound
+
+    yield '\n; ### Constraints ###'
+    table = None
+    if fc.smtlib_share_terms:
+        table = expression.SmtlibTermTable(flatten(constraints))
+        with expression.use_smtlib_terms(table):
+            for c in flatten(constraints):
+                c.to_smtlib()
+
+        table.finish_counting()
+        if not table.has_shared_terms():
+            # nothing to define, the table is dropped and the constraints are streamed as without sharing
+            table = None
+
+    if table is not None:
+        for c in flatten(constraints):
+            with expression.use_smtlib_terms(table):
+                enc = c.to_smtlib()
+            for definition in table.pop_definitions():
+                yield '\n' + definition
+            yield '\n' + enc
+    else:
+        for c in flatten(constraints):
+            yield '\n' + c.to_smtlib()
 
-    consts = '; ### Constraints ###'
+    if assertions:
+        for a in assertions:
+            yield '\n' + a
 
-    for c in flatten(constraints):
-        consts += '\n' + c.to_smtlib()
+    yield '\n(check-sat)\n(get-model)'
+
+
+def print_to_smtlib(vars, constraints):
+    return ''.join(iter_smtlib(vars, constraints))
+
+
+def write_smtlib(vars, constraints, path, chunk_size=2**20, printing=True, assertions=None):
+    '''
+    Writes the SMT-LIB representation of the encoding to a file in chunks, if path ends with .gz the file is
+    compressed.
+    :param vars: variables of the encoding
+    :param constraints: constraints of the encoding
+    :param path: path of the file
+    :param chunk_size: number of characters collected before they are written to the file
+    :param printing: if True, the number of bytes written and the time needed are printed
+    :param assertions: additional SMT-LIB asserts added before (check-sat)
+    :return: tuple (number of uncompressed bytes written, time needed for writing)
+    '''
+    start = timer()
+    num_bytes = 0
+
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'wt')
+    else:
+        f = open(path, 'w')
+
+    with f:
+        chunk = []
+        chunk_len = 0
+        for s in iter_smtlib(vars, constraints, assertions):
+            chunk.append(s)
+            chunk_len += len(s)
+            if chunk_len >= chunk_size:
+                num_bytes += f.write(''.join(chunk))
+                chunk = []
+                chunk_len = 0
+
+        num_bytes += f.write(''.join(chunk))
 
-    return preamble + '\n' + decls + '\n' + bounds + '\n' + consts + '\n' + suffix
+    now = timer()
+    if printing:
+        print('### {p} written: {b} bytes in {t} s'.format(p=path, b=num_bytes, t=now - start))
 
+    return num_bytes, now - start
 
-def create_gurobi_model(vars, constraints, name='NN_model'):
+
+def create_gurobi_model(vars, constraints, name='NN_model', backend=None):
+    '''
+    :param vars: variables of the encoding
+    :param constraints: constraints of the encoding
+    :param name: name of the model
+    :param backend: MILP backend ('gurobi' or 'highs'), if None fc.milp_backend is used
+    :return: model of the specified backend
+    '''
     if name == 'NN_model':
         date = datetime.datetime.now().strftime("%d_%m_%Y_%H_%M_%S")
         name += '_' + date
 
-    model = grb.Model(name)
+    model = mb.create_model(name, backend)
 
     for var in flatten(vars):
         var.register_to_gurobi(model)
@@ -951,6 +1052,6 @@ def encode_optimize_equivalence(path1, path2, input_lower_bounds, input_upper_bo
     # assumes unique var E_diff_0_i for differences
     model = create_gurobi_model(vars, constraints)
     diff = model.getVarByName('E_diff_0_{index}'.format(index=target_output))
-    model.setObjective(diff, grb.GRB.MAXIMIZE)
+    model.setObjective(diff, mb.MAXIMIZE)
 
     return model, vars, constraints
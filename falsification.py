@@ -0,0 +1,212 @@
+'''
+Sampling-based falsification of top-k equivalence.
+
+Before an equivalence query is encoded as MILP, the input region is sampled in large batches and both NNs are
+evaluated on the samples with the vectorized forward evaluation. If a sample violates top-k equivalence by more
+than the tolerance, the query is answered without solving the MILP, otherwise the best sample can be used as
+MIP start.
+'''
+import flags_constants as fc
+from forward_evaluation import ForwardEvaluator
+from timeit import default_timer as timer
+import numpy as np
+
+
+class SamplingRegion:
+
+    def __init__(self, lo, hi, center=None, radius=None, metric=None, halfspaces=None):
+        '''
+        Input region as intersection of the box [lo, hi], the ball of radius around center according to metric
+        (manhattan or chebyshev) and the halfspaces factors * x + constant <= 0 (e.g. the boundaries of the
+        voronoi region of a cluster calculated by cluster_boundary_halfspace).
+
+        :param lo: lower bounds of the inputs
+        :param hi: upper bounds of the inputs
+        :param center: center of the ball (also used as starting point for sampling within the halfspaces)
+        :param radius: radius of the ball, None for the whole box
+        :param metric: manhattan or chebyshev
+        :param halfspaces: list of tuples (factors, constant)
+        '''
+        self.lo = np.array(lo, dtype=float)
+        self.hi = np.array(hi, dtype=float)
+        self.center = None if center is None else np.array(center, dtype=float)
+        self.radius = radius
+        self.metric = metric
+        self.halfspaces = halfspaces if halfspaces is not None else []
+
+        if self.radius is not None and metric not in ['manhattan', 'chebyshev']:
+            raise ValueError('Metric {} is not supported!'.format(metric))
+
+        self.dim = len(self.lo)
+
+        # a chebyshev ball is just a smaller box
+        self.box_lo = self.lo
+        self.box_hi = self.hi
+        if self.radius is not None and metric == 'chebyshev':
+            self.box_lo = np.maximum(self.lo, self.center - radius)
+            self.box_hi = np.minimum(self.hi, self.center + radius)
+
+        if self.halfspaces:
+            self.A = np.array([f for f, _ in self.halfspaces], dtype=float)
+            self.b = np.array([c for _, c in self.halfspaces], dtype=float)
+
+    def contains(self, X, tolerance=1e-9):
+        '''
+        :param X: array of shape (N, d)
+        :return: boolean array of shape (N,), True for samples within the region
+        '''
+        mask = np.all((X >= self.box_lo - tolerance) & (X <= self.box_hi + tolerance), axis=1)
+
+        if self.radius is not None and self.metric == 'manhattan':
+            mask &= np.abs(X - self.center).sum(axis=1) <= self.radius + tolerance
+
+        if self.halfspaces:
+            mask &= np.all(X @ self.A.T + self.b <= tolerance, axis=1)
+
+        return mask
+
+    def sample_ball(self, n, rng, boundary_fraction):
+        if self.radius is None or self.metric == 'chebyshev':
+            X = rng.uniform(self.box_lo, self.box_hi, (n, self.dim))
+
+            # vertices of the box
+            num_vertices = int(n * boundary_fraction)
+            vertices = rng.random((num_vertices, self.dim)) < 0.5
+            X[:num_vertices] = np.where(vertices, self.box_hi, self.box_lo)
+            return X
+
+        # uniform samples in the l1 ball via normalized exponentials, boundary samples on the sphere
+        E = rng.exponential(size=(n, self.dim + 1))
+        num_boundary = int(n * boundary_fraction)
+        E[:num_boundary, -1] = 0
+        directions = E[:, :-1] / E.sum(axis=1, keepdims=True)
+        signs = np.where(rng.random((n, self.dim)) < 0.5, -1.0, 1.0)
+
+        # clipping to the box only moves samples towards the center
+        X = self.center + self.radius * signs * directions
+        return np.clip(X, self.lo, self.hi)
+
+    def sample_polytope(self, n, rng, steps=10):
+        # hit-and-run within box and halfspaces starting at the center, one chain per sample
+        mid = (self.box_lo + self.box_hi) / 2
+        start = mid
+        if self.center is not None:
+            # the center often lies on the boundary of the box (e.g. pixels with value 0), where
+            # almost all directions are blocked, therefore the chains start slightly towards the middle of the box
+            start = self.center
+            for shift in [0.1, 0.01, 0.001]:
+                shifted = self.center + shift * (mid - self.center)
+                if self.contains(shifted.reshape(1, -1))[0]:
+                    start = shifted
+                    break
+
+        X = np.tile(start, (n, 1))
+
+        for _ in range(steps):
+            D = rng.normal(size=(n, self.dim))
+            D /= np.linalg.norm(D, axis=1, keepdims=True)
+
+            # box: lo <= x + t * d <= hi
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t1 = (self.box_lo - X) / D
+                t2 = (self.box_hi - X) / D
+            t_lo = np.nanmax(np.where(D == 0, -np.inf, np.minimum(t1, t2)), axis=1)
+            t_hi = np.nanmin(np.where(D == 0, np.inf, np.maximum(t1, t2)), axis=1)
+
+            # halfspaces: a * (x + t * d) + b <= 0
+            slack = -(X @ self.A.T + self.b)
+            rate = D @ self.A.T
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = slack / rate
+            t_hi = np.minimum(t_hi, np.where(rate > 0, t, np.inf).min(axis=1))
+            t_lo = np.maximum(t_lo, np.where(rate < 0, t, -np.inf).max(axis=1))
+
+            t_lo = np.minimum(t_lo, 0)
+            t_hi = np.maximum(t_hi, 0)
+            X = X + (t_lo + (t_hi - t_lo) * rng.random(n))[:, None] * D
+
+        return X
+
+    def sample(self, n, rng, boundary_fraction=0.2):
+        '''
+        :param n: number of samples
+        :param rng: numpy random Generator
+        :param boundary_fraction: fraction of samples on the boundary of box or ball
+            (not used for regions with halfspaces)
+        :return: array of shape (N, d) with N <= n samples within the region
+        '''
+        if self.halfspaces:
+            X = self.sample_polytope(n, rng)
+        else:
+            X = self.sample_ball(n, rng, boundary_fraction)
+
+        return X[self.contains(X)]
+
+
+def falsify(path1, path2, region, top_k=1, tolerance=None, num_samples=10**5, batch_size=10**4, seed=None,
+            evaluator=None, printing=True):
+    '''
+    Samples the region and evaluates both NNs on the samples until a violation of top-k equivalence greater than
+    tolerance is found or num_samples samples were evaluated.
+
+    :param path1: path to the reference NN
+    :param path2: path to the NN to compare against
+    :param region: SamplingRegion
+    :param top_k: k of top-k equivalence
+    :param tolerance: violations > tolerance falsify equivalence, fc.not_equiv_tolerance if None
+    :param num_samples: maximum number of samples drawn (including the ones rejected by the region)
+    :param batch_size: number of samples evaluated at once
+    :param seed: seed for the random number generator
+    :param evaluator: ForwardEvaluator of the NNs, loaded from path1, path2 if None
+    :param printing: if True, the result is printed
+    :return: dict with fields falsified (True, if violation > tolerance), violation (best violation found),
+        inputs (sample with the best violation), samples (number of evaluated samples) and time
+    '''
+    if tolerance is None:
+        tolerance = fc.not_equiv_tolerance
+
+    if evaluator is None:
+        evaluator = ForwardEvaluator(path1, path2)
+
+    rng = np.random.default_rng(seed)
+    start = timer()
+
+    best_violation = -np.inf
+    best_inputs = None
+    # samples rejected by the region count towards num_samples, but are not evaluated
+    drawn = 0
+    samples = 0
+    while drawn < num_samples and best_violation <= tolerance:
+        n = min(batch_size, num_samples - drawn)
+        X = region.sample(n, rng)
+        drawn += n
+        samples += len(X)
+        if len(X) == 0:
+            continue
+
+        violations = evaluator.violations(X, top_k)
+        idx = np.argmax(violations)
+        if violations[idx] > best_violation:
+            best_violation = violations[idx]
+            best_inputs = X[idx]
+
+    now = timer()
+    result = {'falsified': bool(best_violation > tolerance), 'violation': float(best_violation),
+              'inputs': None if best_inputs is None else best_inputs.tolist(), 'samples': samples,
+              'time': now - start}
+
+    if printing:
+        print('### falsification: violation = {v} after {s} samples, time = {t}'.format(v=best_violation, s=samples,
+                                                                                       t=now - start))
+
+    return result
+
+
+def set_input_start(model, inputs):
+    '''
+    Sets the values of the input variables i_0_j as (partial) MIP start, gurobi completes the remaining values.
+    '''
+    for j, val in enumerate(inputs):
+        model.getVarByName('i_0_{idx}'.format(idx=j)).Start = val
+
+    model.update()
@@ -33,3 +33,20 @@ use_eps_maximum = True
 
 # Whether to use absolute value in encoding of manhattan distance or directly use (2**(n+1)) inequalities
 manhattan_use_absolute_value = True
+
+# encode manhattan distance by splitting (input - center) into positive and negative part
+# (no binaries needed), takes precedence over manhattan_use_absolute_value
+manhattan_use_split_variables = True
+
+# compare one-hot vectors via one xor indicator per index instead of weighting index i by 2^i
+# and comparing the weighted sums (avoids large coefficients and bigMs for many outputs)
+use_xor_one_hot_comparison = True
+
+# MILP backend used for models created from the encoding:
+# 'gurobi' - gurobipy (needs a gurobi license for larger models)
+# 'highs' - open-source HiGHS solver via scipy.optimize.milp
+milp_backend = 'gurobi'
+
+# in SMT-LIB output, sums that are serialized more than once are emitted once via define-fun
+# and referenced by name afterwards (costs an additional serialization pass over all constraints)
+smtlib_share_terms = False
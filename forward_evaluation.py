@@ -0,0 +1,110 @@
+'''
+Vectorized evaluation of loaded NNs on batches of concrete inputs.
+
+Works directly on the (activation, num_neurons, weights) layer lists of KerasLoader/OnnxLoader, where weights
+contains the weight matrix with the bias as last row, s.t. a batch of N inputs is evaluated with one matrix
+multiplication per layer.
+'''
+from keras_loader import KerasLoader
+from onnx_loader import OnnxLoader
+import numpy as np
+
+
+def load_layers(file_name):
+    '''
+    :param file_name: path to .h5 or .onnx file
+    :return: list of (activation, num_neurons, weights) for the layers of the NN
+    '''
+    suffix = file_name.split('.')[-1]
+    if suffix == 'h5':
+        loader = KerasLoader()
+    elif suffix == 'onnx':
+        loader = OnnxLoader()
+    else:
+        raise ValueError('File type .{} is not supported!'.format(suffix))
+    loader.load(file_name)
+
+    return loader.getHiddenLayers()
+
+
+def forward(layers, inputs):
+    '''
+    :param layers: list of (activation, num_neurons, weights)
+    :param inputs: array of shape (N, d) or single input of shape (d,)
+    :return: outputs of the NN of shape (N, m) or (m,) for a single input
+    '''
+    x = np.asarray(inputs, dtype=float)
+    single = x.ndim == 1
+    if single:
+        x = x.reshape(1, -1)
+
+    for activation, num_neurons, weights in layers:
+        x = x @ weights[:-1] + weights[-1]
+
+        if activation == 'relu':
+            np.maximum(x, 0, out=x)
+        elif not activation == 'linear':
+            raise ValueError('Activation {} is not supported for forward evaluation!'.format(activation))
+
+    return x[0] if single else x
+
+
+def top_k_indices(outputs, k):
+    '''
+    :param outputs: array of shape (N, m)
+    :return: array of shape (N, k) with the indices of the k largest outputs in descending order
+    '''
+    top = np.argpartition(-outputs, k - 1, axis=1)[:, :k]
+    top_vals = np.take_along_axis(outputs, top, axis=1)
+    order = np.argsort(-top_vals, axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def top_k_violation(outs1, outs2, top_k=1):
+    '''
+    Violation of top-k equivalence as in analysis.calculate_violation: the k-th largest output of NN 2 minus the
+    output of NN 2 for the class that NN 1 ranked highest. The NNs are not top-k equivalent for an input,
+    if the violation is > 0.
+
+    :param outs1: outputs of NN 1 of shape (N, m)
+    :param outs2: outputs of NN 2 of shape (N, m)
+    :return: array of shape (N,) with the violation for every input
+    '''
+    a_idx = np.argmax(outs1, axis=1)
+    b_atop = outs2[np.arange(len(outs2)), a_idx]
+
+    m = outs2.shape[1]
+    b_k = np.partition(outs2, m - top_k, axis=1)[:, m - top_k]
+
+    return b_k - b_atop
+
+
+class ForwardEvaluator:
+
+    def __init__(self, path1, path2):
+        self.layers1 = load_layers(path1)
+        self.layers2 = load_layers(path2)
+
+    def outputs(self, inputs):
+        '''
+        :param inputs: array of shape (N, d)
+        :return: tuple of outputs of NN 1 and NN 2, each of shape (N, m)
+        '''
+        return forward(self.layers1, inputs), forward(self.layers2, inputs)
+
+    def violations(self, inputs, top_k=1):
+        '''
+        :param inputs: array of shape (N, d)
+        :return: array of shape (N,) with the top-k violation for every input
+        '''
+        outs1, outs2 = self.outputs(np.atleast_2d(inputs))
+        return top_k_violation(outs1, outs2, top_k)
+
+    def evaluate(self, inputs, top_k=1):
+        '''
+        :param inputs: array of shape (N, d)
+        :return: dict with outputs of both NNs, their top-k indices and the violations
+        '''
+        outs1, outs2 = self.outputs(np.atleast_2d(inputs))
+        return {'outs1': outs1, 'outs2': outs2, 'top1': top_k_indices(outs1, top_k),
+                'top2': top_k_indices(outs2, top_k), 'violations': top_k_violation(outs1, outs2, top_k)}
@@ -0,0 +1,380 @@
+'''
+Distribution of evaluation jobs over several nodes by a queue in a shared directory.
+
+The queue directory contains
+    - pending/name.job      pickled jobs, that are not claimed yet
+    - claimed/name.job      jobs claimed by a worker, claimed/name.hb is touched by the worker while the job runs
+    - done/name.result      pickled result dicts of finished jobs
+    - failed/name.result    pickled result dicts of failed, timed out and skipped jobs
+    - logs/                 logs of the jobs (see scheduler.run_job)
+All files are written to a temporary file first and then renamed, a worker claims a job by renaming it from pending
+to claimed. As renames are atomic (also on NFS), every job is claimed by only one worker without any locking
+service. Jobs, whose heartbeat is older than heartbeat_timeout (e.g. the node crashed), are moved back to pending
+by requeue_stale, which is called by the workers and by collect. The clocks of the nodes have to be synchronized
+up to a fraction of heartbeat_timeout. A worker only writes the result of a job, as long as it owns the claim
+(its id is in the heartbeat file), the runs of requeued jobs are stopped.
+
+Jobs are submitted and their results collected by
+    submit(queue_dir, jobs)
+    for res in collect(queue_dir, [job.name for job in jobs]): ...
+while on every node a worker is started with
+    python -c "from fs_queue import run_worker; run_worker('/shared/queue', cores=16)"
+'''
+from scheduler import run_job
+from timeit import default_timer as timer
+from queue import Empty
+import multiprocessing
+import socket
+import pickle
+import time
+import os
+
+
+DIRS = ['pending', 'claimed', 'done', 'failed', 'logs']
+
+
+def job_file(queue_dir, state, name):
+    return os.path.join(queue_dir, state, name + ('.result' if state in ['done', 'failed'] else '.job'))
+
+
+def heartbeat_file(queue_dir, name):
+    return os.path.join(queue_dir, 'claimed', name + '.hb')
+
+
+def write_atomic(fname, obj):
+    tmp = '{f}.{h}_{p}.tmp'.format(f=fname, h=socket.gethostname(), p=os.getpid())
+    with open(tmp, 'wb') as fp:
+        pickle.dump(obj, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.rename(tmp, fname)
+
+
+def read_pickle(fname):
+    '''
+    :return: the unpickled content of the file or None, if it was removed (e.g. claimed by another worker)
+    '''
+    try:
+        with open(fname, 'rb') as fp:
+            return pickle.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def list_names(queue_dir, state):
+    ext = '.result' if state in ['done', 'failed'] else '.job'
+    return sorted(f[:-len(ext)] for f in os.listdir(os.path.join(queue_dir, state)) if f.endswith(ext))
+
+
+def init_queue(queue_dir):
+    for d in DIRS:
+        os.makedirs(os.path.join(queue_dir, d), exist_ok=True)
+
+
+def submit(queue_dir, jobs):
+    '''
+    Adds the jobs to the queue, their functions have to be importable on all nodes (module level functions).
+    Jobs, that are already finished or still in the queue (e.g. when resubmitting an interrupted sweep), are not
+    added again, failed jobs are.
+
+    :param queue_dir: shared directory of the queue
+    :param jobs: list of scheduler.Jobs, dependencies have to be in the list or already in the queue
+    :return: list of names of the added jobs
+    '''
+    init_queue(queue_dir)
+
+    names = [job.name for job in jobs]
+    if not len(set(names)) == len(names):
+        raise ValueError('Names of jobs have to be unique!')
+
+    known = set(names)
+    for state in DIRS[:-1]:
+        known.update(list_names(queue_dir, state))
+
+    for job in jobs:
+        for dep in job.depends:
+            if dep not in known:
+                raise ValueError('Dependency {d} of job {j} is not a job!'.format(d=dep, j=job.name))
+
+    queued = set(list_names(queue_dir, 'done') + list_names(queue_dir, 'pending') + list_names(queue_dir, 'claimed'))
+    added = []
+    for job in jobs:
+        if job.name in queued:
+            continue
+
+        try:
+            os.remove(job_file(queue_dir, 'failed', job.name))
+        except FileNotFoundError:
+            pass
+        write_atomic(job_file(queue_dir, 'pending', job.name), {'job': job, 'attempts': 0})
+        added.append(job.name)
+
+    return added
+
+
+def owns_claim(queue_dir, name, worker_id):
+    '''
+    :return: True, if the heartbeat file of the claimed job contains the id of the worker (it is removed, when the
+        job is requeued, and rewritten by the next worker claiming it)
+    '''
+    try:
+        with open(heartbeat_file(queue_dir, name)) as fp:
+            return fp.read() == worker_id
+    except FileNotFoundError:
+        return False
+
+
+def finish(queue_dir, name, status, result, time, worker_id=None):
+    '''
+    Writes the result of the job and removes its claim.
+
+    :param worker_id: id of the worker, that ran the job, if it doesn't own the claim anymore (the job was requeued
+        in the meantime), nothing is written, as the result is left to the worker running the job now
+    :return: True, if the result was written
+    '''
+    if worker_id is not None and not owns_claim(queue_dir, name, worker_id):
+        return False
+
+    state = 'done' if status == 'finished' else 'failed'
+    write_atomic(job_file(queue_dir, state, name), {'name': name, 'status': status, 'result': result,
+                                                    'time': time, 'cached': False})
+    for fname in [job_file(queue_dir, 'claimed', name), heartbeat_file(queue_dir, name)]:
+        try:
+            os.remove(fname)
+        except FileNotFoundError:
+            pass
+
+    return True
+
+
+def requeue_stale(queue_dir, heartbeat_timeout=60, max_attempts=3):
+    '''
+    Moves claimed jobs without heartbeat for heartbeat_timeout seconds back to pending, jobs that were claimed
+    max_attempts times are marked as failed instead.
+
+    :return: list of names of the requeued jobs
+    '''
+    requeued = []
+    now = time.time()
+    for name in list_names(queue_dir, 'claimed'):
+        claimed = job_file(queue_dir, 'claimed', name)
+        try:
+            # the heartbeat is created right after the claim, until then the claim itself counts
+            last = os.path.getmtime(heartbeat_file(queue_dir, name))
+        except FileNotFoundError:
+            try:
+                last = os.path.getmtime(claimed)
+            except FileNotFoundError:
+                continue
+
+        if now - last < heartbeat_timeout:
+            continue
+
+        entry = read_pickle(claimed)
+        if entry is None:
+            continue
+
+        if entry['attempts'] >= max_attempts:
+            finish(queue_dir, name, 'failed', 'Heartbeat lost in {a} attempts'.format(a=entry['attempts']), None)
+            continue
+
+        # the heartbeat is moved away before the job is pending again, as afterwards it could already be claimed
+        # by another worker, whose heartbeat mustn't be removed
+        hb = heartbeat_file(queue_dir, name)
+        stale = '{f}.{h}_{p}.stale'.format(f=hb, h=socket.gethostname(), p=os.getpid())
+        try:
+            os.rename(hb, stale)
+            last = os.path.getmtime(stale)
+        except FileNotFoundError:
+            stale = None
+            try:
+                last = os.path.getmtime(claimed)
+            except FileNotFoundError:
+                continue
+
+        if time.time() - last < heartbeat_timeout:
+            # requeued and claimed again by another worker since the check above
+            if stale is not None:
+                os.rename(stale, hb)
+            continue
+
+        try:
+            os.rename(claimed, job_file(queue_dir, 'pending', name))
+            requeued.append(name)
+        except FileNotFoundError:
+            # requeued by someone else or finished in the meantime
+            pass
+        finally:
+            if stale is not None:
+                os.remove(stale)
+
+    return requeued
+
+
+def claim(queue_dir, name, worker_id):
+    '''
+    :return: the claimed job entry or None, if another worker was faster
+    '''
+    pending = job_file(queue_dir, 'pending', name)
+    claimed = job_file(queue_dir, 'claimed', name)
+    try:
+        # the rename keeps the modification time, which counts as heartbeat until the heartbeat file exists
+        os.utime(pending, None)
+        os.rename(pending, claimed)
+    except FileNotFoundError:
+        return None
+
+    entry = read_pickle(claimed)
+    entry['attempts'] += 1
+    write_atomic(claimed, entry)
+    with open(heartbeat_file(queue_dir, name), 'w') as fp:
+        fp.write(worker_id)
+
+    return entry
+
+
+def run_worker(queue_dir, cores=None, poll_interval=1, heartbeat_timeout=60, max_attempts=3, exit_when_empty=True,
+               printing=True):
+    '''
+    Claims and runs jobs from the queue until it is empty, respecting dependencies and the number of cores as
+    run_jobs. The heartbeat files of all running jobs are touched every poll_interval seconds.
+
+    :param queue_dir: shared directory of the queue
+    :param cores: number of cores of this node to use, number of cpus if None
+    :param poll_interval: time in seconds between heartbeats and checks for new jobs
+    :param heartbeat_timeout: time in seconds without heartbeat, after which jobs of other workers are requeued
+    :param max_attempts: maximum number of claims of a job, before it is failed by requeue_stale
+    :param exit_when_empty: if True, the worker returns, when there are no pending or claimed jobs left,
+        otherwise it waits for new jobs
+    :param printing: if True, every finished job is printed
+    :return: number of jobs run by this worker
+    '''
+    if cores is None:
+        cores = multiprocessing.cpu_count()
+
+    init_queue(queue_dir)
+    worker_id = '{h}_{p}'.format(h=socket.gethostname(), p=os.getpid())
+    logdir = os.path.join(queue_dir, 'logs')
+    results = multiprocessing.Queue()
+    running = {}
+    free = cores
+    count = 0
+
+    while True:
+        requeue_stale(queue_dir, heartbeat_timeout, max_attempts)
+        done = set(list_names(queue_dir, 'done'))
+        failed = set(list_names(queue_dir, 'failed'))
+
+        for name in list_names(queue_dir, 'pending'):
+            if name in done:
+                # finished and requeued at the same time
+                try:
+                    os.remove(job_file(queue_dir, 'pending', name))
+                except FileNotFoundError:
+                    pass
+                continue
+
+            entry = read_pickle(job_file(queue_dir, 'pending', name))
+            if entry is None:
+                continue
+
+            job = entry['job']
+            skip = any(dep in failed for dep in job.depends)
+            if not skip and (not all(dep in done for dep in job.depends) or job.threads > free):
+                continue
+
+            entry = claim(queue_dir, name, worker_id)
+            if entry is None:
+                continue
+
+            if skip:
+                finish(queue_dir, name, 'skipped', None, 0, worker_id)
+                if printing:
+                    print('### job {n} skipped, as a dependency did not finish'.format(n=name))
+                continue
+
+            proc = multiprocessing.Process(target=run_job, args=(job, logdir, results))
+            proc.start()
+            running[name] = (job, proc, timer())
+            free -= job.threads
+
+        if not running and exit_when_empty and not list_names(queue_dir, 'pending') and \
+                not list_names(queue_dir, 'claimed'):
+            break
+
+        finished = []
+        try:
+            finished.append(results.get(timeout=poll_interval))
+        except Empty:
+            for name, (job, proc, start) in running.items():
+                if not proc.is_alive() and results.empty():
+                    finished.append((name, 'failed', 'Process terminated with exit code {c}'.format(
+                        c=proc.exitcode), timer() - start))
+
+        for name, (job, proc, start) in running.items():
+            if job.timeout is not None and timer() - start > job.timeout and \
+                    not any(name == f[0] for f in finished):
+                proc.terminate()
+                finished.append((name, 'timed_out', 'Job exceeded timeout of {t} s'.format(t=job.timeout),
+                                 timer() - start))
+
+        for name, job_status, result, duration in finished:
+            if name not in running:
+                # result of a job, that was stopped after it was requeued
+                continue
+
+            job, proc, start = running.pop(name)
+            proc.join()
+            free += job.threads
+            count += 1
+            if not finish(queue_dir, name, job_status, result, duration, worker_id):
+                job_status = 'discarded, as it was requeued,'
+
+            if printing:
+                print('### job {n} {s} after {t} s on {w}'.format(n=name, s=job_status, t=duration, w=worker_id))
+
+        for name in list(running):
+            if not owns_claim(queue_dir, name, worker_id):
+                # requeued by another worker (e.g. the heartbeat was delayed), the job is run again by the worker
+                # claiming it next, so it is stopped here
+                job, proc, start = running.pop(name)
+                proc.terminate()
+                proc.join()
+                free += job.threads
+                if printing:
+                    print('### job {n} stopped, as it was requeued'.format(n=name))
+                continue
+
+            try:
+                os.utime(heartbeat_file(queue_dir, name), None)
+            except FileNotFoundError:
+                pass
+
+    return count
+
+
+def collect(queue_dir, names, poll_interval=1, heartbeat_timeout=60, max_attempts=3, printing=True):
+    '''
+    Waits for the results of the jobs, requeueing jobs of crashed workers.
+
+    :param queue_dir: shared directory of the queue
+    :param names: names of the jobs
+    :return: generator of result dicts as run_jobs (fields name, status, result, time and cached), in the order
+        the jobs finish
+    '''
+    remaining = set(names)
+    while remaining:
+        for name in requeue_stale(queue_dir, heartbeat_timeout, max_attempts):
+            if printing:
+                print('### job {n} requeued, as the heartbeat of its worker was lost'.format(n=name))
+
+        for state in ['done', 'failed']:
+            for name in sorted(remaining.intersection(list_names(queue_dir, state))):
+                res = read_pickle(job_file(queue_dir, state, name))
+                remaining.remove(name)
+                if printing:
+                    print('### job {n} {s}, remaining = {r}'.format(n=name, s=res['status'], r=len(remaining)))
+                yield res
+
+        if remaining:
+            time.sleep(poll_interval)
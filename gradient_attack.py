@@ -0,0 +1,206 @@
+'''
+Projected gradient ascent (PGD) on the equivalence objective of two ReLU NNs.
+
+The NNs are evaluated on the NumPy layer lists of KerasLoader/OnnxLoader, gradients are calculated by manual
+backpropagation through the piecewise linear layers. All restarts are run as one batch.
+
+Objectives (to be maximized):
+    one_hot_partial_top_k - top-k violation (k-th largest output of NN 2 minus output of NN 2 for the top class
+                            of NN 1), the gradient is taken of the k-th largest output of NN 2 among all classes
+                            except the top class of NN 1, which is identical, if the violation is > 0
+    optimize_diff_manhattan, optimize_diff_chebyshev - norm of the difference of the outputs
+'''
+import flags_constants as fc
+from forward_evaluation import load_layers, top_k_violation
+from timeit import default_timer as timer
+import numpy as np
+
+
+def forward_with_activations(layers, X):
+    '''
+    :return: tuple (outputs, list of pre-activation values of every layer)
+    '''
+    pre_activations = []
+    for activation, num_neurons, weights in layers:
+        X = X @ weights[:-1] + weights[-1]
+        pre_activations.append(X)
+
+        if activation == 'relu':
+            X = np.maximum(X, 0)
+        elif not activation == 'linear':
+            raise ValueError('Activation {} is not supported for gradient calculation!'.format(activation))
+
+    return X, pre_activations
+
+
+def backward(layers, pre_activations, grad_out):
+    '''
+    :param grad_out: gradient of the objective w.r.t. the outputs of shape (N, m)
+    :return: gradient of the objective w.r.t. the inputs of shape (N, d)
+    '''
+    grad = grad_out
+    for (activation, num_neurons, weights), z in zip(reversed(layers), reversed(pre_activations)):
+        if activation == 'relu':
+            grad = grad * (z > 0)
+        grad = grad @ weights[:-1].T
+
+    return grad
+
+
+def objective(outs1, outs2, mode):
+    '''
+    :return: tuple (true objective of shape (N,), gradient of the surrogate objective w.r.t. outs1, outs2)
+    '''
+    n, m = outs1.shape
+    rows = np.arange(n)
+    grad1 = np.zeros_like(outs1)
+    grad2 = np.zeros_like(outs2)
+
+    if mode.startswith('one_hot_partial_top_'):
+        k = int(mode.split('_')[-1])
+        values = top_k_violation(outs1, outs2, k)
+
+        a_idx = np.argmax(outs1, axis=1)
+        others = outs2.copy()
+        others[rows, a_idx] = -np.inf
+        # k-th largest among the other classes
+        b_idx = np.argsort(-others, axis=1)[:, k - 1]
+
+        grad2[rows, b_idx] += 1
+        grad2[rows, a_idx] -= 1
+    elif mode == 'optimize_diff_manhattan':
+        diff = outs1 - outs2
+        values = np.abs(diff).sum(axis=1)
+        grad1 = np.sign(diff)
+        grad2 = -grad1
+    elif mode == 'optimize_diff_chebyshev':
+        diff = outs1 - outs2
+        idx = np.argmax(np.abs(diff), axis=1)
+        values = np.abs(diff[rows, idx])
+        grad1[rows, idx] = np.sign(diff[rows, idx])
+        grad2 = -grad1
+    else:
+        raise ValueError('Mode {} is not supported!\nSupported modes are: \n\toptimize_diff_[manhattan | chebyshev]'
+                         '\n\tone_hot_partial_top_[k]'.format(mode))
+
+    return values, grad1, grad2
+
+
+def project_l1_ball(X, center, radius):
+    '''
+    Euclidean projection of every row of X onto the l1 ball around center (Duchi et al., 2008).
+    '''
+    V = X - center
+    norms = np.abs(V).sum(axis=1)
+    outside = norms > radius
+    if not np.any(outside):
+        return X
+
+    U = np.abs(V[outside])
+    S = -np.sort(-U, axis=1)
+    cumsum = np.cumsum(S, axis=1)
+    ks = np.arange(1, U.shape[1] + 1)
+    rho = np.count_nonzero(S * ks > cumsum - radius, axis=1)
+    theta = (cumsum[np.arange(len(U)), rho - 1] - radius) / rho
+
+    X = X.copy()
+    X[outside] = center + np.sign(V[outside]) * np.maximum(U - theta[:, None], 0)
+    return X
+
+
+def project(X, region):
+    '''
+    Projects the rows of X into the region (SamplingRegion without halfspaces). For the l1 ball the projection
+    onto the ball is followed by clipping to the box, which keeps the points in the ball, as the center
+    lies within the box.
+    '''
+    if region.radius is not None and region.metric == 'manhattan':
+        X = project_l1_ball(X, region.center, region.radius)
+
+    return np.clip(X, region.box_lo, region.box_hi)
+
+
+def pgd_attack(path1, path2, region, mode, restarts=100, steps=100, step_size=0.1, starts=None, tolerance=None,
+               seed=None, layers=None, printing=True):
+    '''
+    Maximizes the equivalence objective over the region by projected gradient ascent from several starting points.
+
+    :param path1: path to the reference NN
+    :param path2: path to the NN to compare against
+    :param region: SamplingRegion (box, l1 or linf ball, halfspaces are not supported)
+    :param mode: one_hot_partial_top_k or optimize_diff_[manhattan | chebyshev]
+    :param restarts: number of random starting points sampled from the region
+    :param steps: number of gradient steps
+    :param step_size: initial step size relative to the radius (l1 ball) or the width of the box, decays linearly
+    :param starts: additional starting points, e.g. the best samples of falsify
+    :param tolerance: objective values > tolerance falsify equivalence, fc.not_equiv_tolerance if None
+        (the attack stops as soon as this is reached)
+    :param seed: seed for the random number generator
+    :param layers: tuple of layer lists of both NNs, loaded from path1, path2 if None
+    :param printing: if True, the result is printed
+    :return: dict with fields falsified, violation (best objective value), inputs (best input), steps and time
+    '''
+    if region.halfspaces:
+        raise ValueError('Regions with halfspaces are not supported by the gradient attack!')
+
+    if tolerance is None:
+        tolerance = fc.not_equiv_tolerance
+
+    if layers is None:
+        layers = (load_layers(path1), load_layers(path2))
+    layers1, layers2 = layers
+
+    rng = np.random.default_rng(seed)
+    start = timer()
+
+    X = region.sample(restarts, rng)
+    if starts is not None:
+        X = np.vstack([np.atleast_2d(np.array(starts, dtype=float)), X])
+    if len(X) == 0:
+        # all samples were rejected by the region, start from its center (or the center of the box)
+        center = region.center if region.center is not None else (region.box_lo + region.box_hi) / 2
+        X = np.atleast_2d(np.array(center, dtype=float))
+    X = project(X, region)
+
+    if region.radius is not None and region.metric == 'manhattan':
+        scale = region.radius
+        use_sign = False
+    else:
+        scale = region.box_hi - region.box_lo
+        use_sign = True
+
+    best_value = -np.inf
+    best_inputs = None
+    step = 0
+    for step in range(steps + 1):
+        outs1, pre1 = forward_with_activations(layers1, X)
+        outs2, pre2 = forward_with_activations(layers2, X)
+        values, grad1, grad2 = objective(outs1, outs2, mode)
+
+        idx = np.argmax(values)
+        if values[idx] > best_value:
+            best_value = values[idx]
+            best_inputs = X[idx].copy()
+
+        if best_value > tolerance or step == steps:
+            break
+
+        grad = backward(layers1, pre1, grad1) + backward(layers2, pre2, grad2)
+        alpha = step_size * (1 - step / steps)
+        if use_sign:
+            X = X + alpha * scale * np.sign(grad)
+        else:
+            norms = np.linalg.norm(grad, axis=1, keepdims=True)
+            X = X + alpha * scale * grad / np.maximum(norms, 1e-12)
+
+        X = project(X, region)
+
+    now = timer()
+    result = {'falsified': bool(best_value > tolerance), 'violation': float(best_value),
+              'inputs': None if best_inputs is None else best_inputs.tolist(), 'steps': step, 'time': now - start}
+
+    if printing:
+        print('### gradient attack: objective = {v} after {s} steps, time = {t}'.format(v=best_value, s=step,
+                                                                                       t=now - start))
+
+    return result
@@ -0,0 +1,257 @@
+'''
+Branch and bound over the input space for top-k equivalence.
+
+The input region (box, or manhattan/chebyshev ball intersected with the box) is recursively split in half along
+its most influential dimension. Every subregion is first checked cheaply:
+    - interval bounds of both NNs prove equivalence, if the top class of NN 1 is always in the top-k of NN 2
+    - random samples falsify equivalence, if one of them violates it by more than the tolerance
+Only subregions, that are still unresolved at max_depth, are encoded as MILP. The subregions are processed by
+worker processes sharing a task queue, as soon as one of them finds a counterexample, all workers are terminated.
+'''
+import flags_constants as fc
+from forward_evaluation import load_layers, forward, top_k_violation
+from falsification import SamplingRegion
+from performance import Encoder
+from expression_encoding import interval_arithmetic
+from termination import TerminationPolicy
+from timeit import default_timer as timer
+import numpy as np
+from queue import Empty
+import multiprocessing
+import traceback
+
+
+def interval_forward(layers, lo, hi):
+    '''
+    :return: tuple (lower bounds, upper bounds) of the outputs of the NN for inputs in the box [lo, hi]
+    '''
+    for activation, num_neurons, weights in layers:
+        W = weights[:-1]
+        W_pos = np.maximum(W, 0)
+        W_neg = np.minimum(W, 0)
+        lo, hi = lo @ W_pos + hi @ W_neg + weights[-1], hi @ W_pos + lo @ W_neg + weights[-1]
+
+        if activation == 'relu':
+            lo = np.maximum(lo, 0)
+            hi = np.maximum(hi, 0)
+        elif not activation == 'linear':
+            raise ValueError('Activation {} is not supported for interval evaluation!'.format(activation))
+
+    return lo, hi
+
+
+def interval_proves_equivalence(lo1, hi1, lo2, hi2, top_k):
+    '''
+    :return: True, if for every class, that may be the top class of NN 1, less than k classes may have a greater
+        output than that class for NN 2
+    '''
+    candidates = np.nonzero(hi1 >= np.max(lo1))[0]
+    for a in candidates:
+        competitors = np.count_nonzero(hi2 > lo2[a]) - (1 if hi2[a] > lo2[a] else 0)
+        if competitors >= top_k:
+            return False
+
+    return True
+
+
+_state = {}
+
+
+def worker_loop(path1, path2, config, tasks, results, stop):
+    _state['layers'] = (load_layers(path1), load_layers(path2))
+    _state['paths'] = (path1, path2)
+    _state['config'] = config
+
+    while not stop.is_set():
+        lo, hi, depth, seed = tasks.get()
+        try:
+            res = process_region(lo, hi, depth, seed)
+        except Exception:
+            # the region is reported as unknown, otherwise the search would wait for it forever
+            res = {'status': 'unknown', 'method': 'error', 'error': traceback.format_exc()}
+        results.put((depth, res))
+
+
+def solve_milp(lo, hi):
+    config = _state['config']
+    enc = Encoder()
+    enc.encode_equiv(_state['paths'][0], _state['paths'][1], lo, hi, config['mode'])
+    if config['metric'] == 'manhattan':
+        enc.add_input_radius(config['center'], config['radius'], 'manhattan')
+    interval_arithmetic(enc.get_constraints())
+
+    model = enc.create_gurobi_model(backend='gurobi')
+    model.setParam('OutputFlag', 0)
+    model.setParam('Threads', 1)
+
+    enc.set_termination_policy(TerminationPolicy.for_equivalence(config['tolerance'], config['milp_time']))
+    reason = enc.optimize(model)
+
+    if model.SolCount > 0 and model.ObjVal > config['tolerance']:
+        inputs = [model.getVarByName('i_0_{idx}'.format(idx=j)).X for j in range(len(lo))]
+        return 'not_equivalent', inputs, model.ObjVal
+    elif reason == 'equivalent' or model.Status == 2:
+        return 'equivalent', None, None
+
+    return 'unknown', None, None
+
+
+def process_region(lo, hi, depth, seed):
+    '''
+    :return: dict with field status (equivalent, not_equivalent, unknown or split) and inputs, violation for
+        counterexamples, children (list of (lo, hi)) for split regions
+        (worker_loop reports exceptions as status unknown with method error and the traceback in field error)
+    '''
+    config = _state['config']
+    layers1, layers2 = _state['layers']
+    region = SamplingRegion(lo, hi, config['center'], config['radius'], config['metric'])
+
+    # manhattan ball doesn't intersect the box
+    if config['metric'] == 'manhattan':
+        dist = np.sum(np.maximum(0, np.maximum(region.box_lo - region.center, region.center - region.box_hi)))
+        if dist > config['radius']:
+            return {'status': 'equivalent', 'method': 'empty'}
+
+    lo1, hi1 = interval_forward(layers1, region.box_lo, region.box_hi)
+    lo2, hi2 = interval_forward(layers2, region.box_lo, region.box_hi)
+    if interval_proves_equivalence(lo1, hi1, lo2, hi2, config['top_k']):
+        return {'status': 'equivalent', 'method': 'interval'}
+
+    X = region.sample(config['num_samples'], np.random.default_rng(seed))
+    if len(X) > 0:
+        violations = top_k_violation(forward(layers1, X), forward(layers2, X), config['top_k'])
+        idx = np.argmax(violations)
+        if violations[idx] > config['tolerance']:
+            return {'status': 'not_equivalent', 'method': 'sampling', 'inputs': X[idx].tolist(),
+                    'violation': float(violations[idx])}
+
+    if depth >= config['max_depth']:
+        status, inputs, violation = solve_milp(region.box_lo, region.box_hi)
+        return {'status': status, 'method': 'milp', 'inputs': inputs, 'violation': violation}
+
+    # split the most influential dimension (width times weight of the dimension in the first layers)
+    influence = np.abs(layers1[0][2][:-1]).sum(axis=1) + np.abs(layers2[0][2][:-1]).sum(axis=1)
+    dim = np.argmax((region.box_hi - region.box_lo) * influence)
+    mid = (region.box_lo[dim] + region.box_hi[dim]) / 2
+
+    hi_left = region.box_hi.copy()
+    hi_left[dim] = mid
+    lo_right = region.box_lo.copy()
+    lo_right[dim] = mid
+
+    return {'status': 'split', 'children': [(region.box_lo, hi_left), (lo_right, region.box_hi)]}
+
+
+def verify_region(path1, path2, lo, hi, mode='one_hot_partial_top_1', center=None, radius=None, metric=None,
+                  workers=None, max_depth=16, num_samples=256, milp_time=60, tolerance=None, seed=0,
+                  poll_interval=1, printing=True):
+    '''
+    Checks top-k equivalence of two NNs within the region by branch and bound over the input space.
+
+    :param path1: path to the reference NN
+    :param path2: path to the NN to compare against
+    :param lo: lower bounds of the inputs
+    :param hi: upper bounds of the inputs
+    :param mode: one_hot_partial_top_k
+    :param center: center of the ball, None for the whole box
+    :param radius: radius of the ball
+    :param metric: manhattan or chebyshev
+    :param workers: number of worker processes, number of cpus if None
+    :param max_depth: depth of the split tree, at which unresolved regions are encoded as MILP
+    :param num_samples: number of samples checked in every region
+    :param milp_time: time limit in seconds for the MILPs of the leaves
+    :param tolerance: violations > tolerance are counterexamples, fc.not_equiv_tolerance if None
+    :param seed: seed for the random number generator
+    :param poll_interval: time in seconds between checks, whether the workers are still alive
+    :param printing: if True, the result is printed
+    :return: dict with fields result (equivalent, not_equivalent or unknown), inputs and violation of the
+        counterexample, stats (number of regions resolved by each method), unknown (regions not resolved by
+        the MILP in time or failed with an exception), errors (tracebacks of the failed regions) and time
+    '''
+    if not mode.startswith('one_hot_partial_top_'):
+        raise ValueError('Mode {} is not supported!\nSupported mode is: \n\tone_hot_partial_top_[k]'.format(mode))
+
+    if tolerance is None:
+        tolerance = fc.not_equiv_tolerance
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    config = {'mode': mode, 'top_k': int(mode.split('_')[-1]), 'center': center, 'radius': radius,
+              'metric': metric, 'max_depth': max_depth, 'num_samples': num_samples, 'milp_time': milp_time,
+              'tolerance': tolerance}
+
+    lo = np.array(lo, dtype=float)
+    hi = np.array(hi, dtype=float)
+    if center is not None:
+        # both balls are contained in the box of width 2 * radius around the center
+        lo = np.maximum(lo, np.array(center, dtype=float) - radius)
+        hi = np.minimum(hi, np.array(center, dtype=float) + radius)
+
+    start = timer()
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    procs = [multiprocessing.Process(target=worker_loop, args=(path1, path2, config, tasks, results, stop),
+                                     daemon=True) for i in range(workers)]
+    for p in procs:
+        p.start()
+
+    queue = [(lo, hi, 0)]
+    in_flight = 0
+    stats = {'empty': 0, 'interval': 0, 'sampling': 0, 'milp': 0, 'split': 0, 'error': 0}
+    unknown = []
+    errors = []
+    result = {'result': 'equivalent', 'inputs': None, 'violation': None}
+    count = 0
+
+    try:
+        while queue or in_flight > 0:
+            # keep the workers busy, but process the regions depth first
+            while queue and in_flight < 2 * workers:
+                r_lo, r_hi, depth = queue.pop()
+                tasks.put((r_lo, r_hi, depth, seed + count))
+                in_flight += 1
+                count += 1
+
+            try:
+                depth, res = results.get(timeout=poll_interval)
+            except Empty:
+                if not any(p.is_alive() for p in procs):
+                    raise RuntimeError('All workers of the input splitting terminated unexpectedly!')
+                continue
+
+            in_flight -= 1
+            if res['status'] == 'split':
+                stats['split'] += 1
+                queue += [(c_lo, c_hi, depth + 1) for c_lo, c_hi in res['children']]
+                continue
+
+            stats[res['method']] += 1
+            if res['status'] == 'not_equivalent':
+                result.update({'result': 'not_equivalent', 'inputs': res['inputs'], 'violation': res['violation']})
+                break
+            elif res['status'] == 'unknown':
+                unknown.append(depth)
+                if res['method'] == 'error':
+                    errors.append(res['error'])
+                    if printing:
+                        print('### region at depth {d} failed:\n{e}'.format(d=depth, e=res['error']))
+    finally:
+        # kills running MILPs after a counterexample was found
+        stop.set()
+        for p in procs:
+            p.terminate()
+            p.join()
+
+    if result['result'] == 'equivalent' and unknown:
+        result['result'] = 'unknown'
+
+    result.update({'stats': stats, 'unknown': len(unknown), 'errors': errors, 'time': timer() - start})
+
+    if printing:
+        print('### input splitting: {r} after {n} regions, time = {t}'.format(r=result['result'], n=count,
+                                                                              t=result['time']))
+        print('    resolved by: {s}'.format(s=stats))
+
+    return result
@@ -0,0 +1,136 @@
+'''
+Persistent ledger of evaluation jobs for resuming long sweeps.
+
+Every job is identified by the hash of its spec (function and keyword arguments) and stored in an sqlite database
+with its status, number of attempts, result (pickled), error and artifacts (files written by the job). Restarting
+a sweep with the same ledger skips jobs, that already finished, and retries failed, timed out or interrupted jobs
+according to a RetryPolicy.
+
+The ledger is only accessed by the process scheduling the jobs. Jobs still marked as running, when a ledger is
+opened, were interrupted (e.g. by preemption) and are marked as such.
+'''
+import numpy as np
+import hashlib
+import sqlite3
+import pickle
+import json
+import time
+import os
+
+
+def canonical(obj):
+    '''
+    :return: json serializable representation of obj, objects without one are represented by their type
+        (memory addresses in their repr would change the hash on every run)
+    '''
+    if isinstance(obj, dict):
+        return {str(k): canonical(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [canonical(v) for v in obj]
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, (np.integer, np.floating)):
+        return obj.item()
+    elif obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+
+    return '<{t}>'.format(t=type(obj).__name__)
+
+
+def spec_hash(func, kwargs):
+    spec = {'func': func.__module__ + '.' + func.__name__, 'kwargs': canonical(kwargs)}
+    return hashlib.sha256(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+
+def find_artifacts(result):
+    '''
+    :return: paths of the existing files referenced by logfile and inputfile of the evaluation dicts in result
+    '''
+    dicts = result if isinstance(result, list) else [result]
+    files = [d[key] for d in dicts if isinstance(d, dict) for key in ['logfile', 'inputfile'] if key in d]
+    return [f for f in files if isinstance(f, str) and os.path.exists(f)]
+
+
+class RetryPolicy:
+
+    def __init__(self, max_attempts=3, retry=('failed', 'timed_out', 'interrupted')):
+        '''
+        :param max_attempts: maximum number of attempts of a job over all runs
+        :param retry: statuses of jobs, that are run again
+        '''
+        self.max_attempts = max_attempts
+        self.retry = retry
+
+    def should_run(self, status, attempts):
+        return status is None or (status in self.retry and attempts < self.max_attempts)
+
+
+class Ledger:
+
+    def __init__(self, db_file='ledger.sqlite', policy=None):
+        self.db_file = db_file
+        self.policy = policy if policy is not None else RetryPolicy()
+
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs (spec_hash TEXT PRIMARY KEY, name TEXT, spec TEXT, '
+                          'status TEXT, attempts INTEGER, result BLOB, error TEXT, artifacts TEXT, '
+                          'started REAL, finished REAL)')
+        self.conn.execute("UPDATE jobs SET status = 'interrupted' WHERE status = 'running'")
+        self.conn.commit()
+
+    def get(self, job):
+        '''
+        :return: dict with fields name, status, attempts, result, error, artifacts, started and finished of the job
+            or None, if the job is not in the ledger
+        '''
+        row = self.conn.execute('SELECT name, status, attempts, result, error, artifacts, started, finished '
+                                'FROM jobs WHERE spec_hash = ?', (spec_hash(job.func, job.kwargs),)).fetchone()
+        if row is None:
+            return None
+
+        name, status, attempts, result, error, artifacts, started, finished = row
+        return {'name': name, 'status': status, 'attempts': attempts,
+                'result': None if result is None else pickle.loads(result), 'error': error,
+                'artifacts': json.loads(artifacts) if artifacts else [], 'started': started, 'finished': finished}
+
+    def should_run(self, job):
+        entry = self.get(job)
+        if entry is None:
+            return True
+
+        return self.policy.should_run(entry['status'], entry['attempts'])
+
+    def start(self, job):
+        key = spec_hash(job.func, job.kwargs)
+        spec = json.dumps({'func': job.func.__module__ + '.' + job.func.__name__, 'kwargs': canonical(job.kwargs)},
+                          sort_keys=True)
+        self.conn.execute('INSERT OR IGNORE INTO jobs (spec_hash, name, spec, attempts) VALUES (?, ?, ?, 0)',
+                          (key, job.name, spec))
+        self.conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, started = ?, "
+                          "finished = NULL WHERE spec_hash = ?", (time.time(), key))
+        self.conn.commit()
+
+    def finish(self, job, status, result=None, artifacts=None):
+        '''
+        :param status: finished, failed or timed_out
+        :param result: result of the job, for failed jobs the error message
+        :param artifacts: paths of files written by the job
+        '''
+        if status == 'finished':
+            blob, error = pickle.dumps(result), None
+        else:
+            blob, error = None, None if result is None else str(result)
+
+        self.conn.execute('UPDATE jobs SET status = ?, result = ?, error = ?, artifacts = ?, finished = ? '
+                          'WHERE spec_hash = ?', (status, blob, error, json.dumps(artifacts or []), time.time(),
+                                                  spec_hash(job.func, job.kwargs)))
+        self.conn.commit()
+
+    def summary(self):
+        '''
+        :return: dict of status and number of jobs
+        '''
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+
+    def close(self):
+        self.conn.close()
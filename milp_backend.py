@@ -0,0 +1,667 @@
+'''
+Backends for the MILP models generated from the expression tree.
+
+Expression.to_gurobi(model) only uses the interface shared by both backends:
+    model.addVar, model.addConstr (linear, indicator and general constraints), model.quicksum, model.max_,
+    model.abs_, model.setObjective, model.setParam, model.optimize, model.getVarByName
+and the attributes ObjVal, ObjBound, Status, SolCount of the model and X of its variables.
+
+The constants are chosen to be equal to the ones in gurobipy.GRB, s.t. they can be used interchangeably.
+'''
+import flags_constants as fc
+import numpy as np
+from timeit import default_timer as timer
+
+try:
+    import gurobipy as grb
+except ImportError:
+    grb = None
+
+try:
+    from scipy.optimize import milp, Bounds, LinearConstraint
+    from scipy.sparse import csr_matrix
+except ImportError:
+    milp = None
+
+
+BINARY = 'B'
+CONTINUOUS = 'C'
+INFINITY = 1e100
+
+MINIMIZE = 1
+MAXIMIZE = -1
+
+LOADED = 1
+OPTIMAL = 2
+INFEASIBLE = 3
+INF_OR_UNBD = 4
+UNBOUNDED = 5
+TIME_LIMIT = 9
+
+
+def create_model(name, backend=None):
+    '''
+    :param name: name of the model
+    :param backend: 'gurobi' or 'highs', if None fc.milp_backend is used
+    :return: empty model of the specified backend
+    '''
+    if backend is None:
+        backend = fc.milp_backend
+
+    if backend == 'gurobi':
+        return GurobiModel(name)
+    elif backend == 'highs':
+        return HighsModel(name)
+    else:
+        raise ValueError('MILP backend {b} is not supported!'.format(b=backend))
+
+
+class GurobiModel:
+    '''
+    Thin wrapper around a gurobipy model, every attribute and method not defined here is passed on to the
+    gurobi model.
+    '''
+
+    def __init__(self, name, model=None):
+        '''
+        :param name: name of the model
+        :param model: existing gurobipy model to wrap (e.g. read from a file), a new model is created if None
+        '''
+        if grb is None:
+            raise ImportError('gurobipy is needed for the gurobi backend!')
+
+        if model is None:
+            model = grb.Model(name)
+
+        self.__dict__['model'] = model
+
+    def __getattr__(self, item):
+        return getattr(self.model, item)
+
+    def __setattr__(self, key, value):
+        setattr(self.model, key, value)
+
+    @staticmethod
+    def quicksum(terms):
+        return grb.quicksum(terms)
+
+    @staticmethod
+    def max_(*args, **kwargs):
+        return grb.max_(*args, **kwargs)
+
+    @staticmethod
+    def abs_(arg):
+        return grb.abs_(arg)
+
+
+def as_lin_expr(x):
+    if isinstance(x, HighsLinExpr):
+        return x
+    elif isinstance(x, HighsVar):
+        return HighsLinExpr({x.index: 1.0}, 0.0)
+    else:
+        return HighsLinExpr({}, float(x))
+
+
+class HighsLinExpr:
+    '''
+    Linear expression sum(coeffs[i] * x_i) + constant over the variables of a HighsModel.
+    '''
+
+    # numpy scalars on the left hand side of an operation should use the operators defined here
+    __array_ufunc__ = None
+
+    def __init__(self, coeffs, constant):
+        self.coeffs = coeffs
+        self.constant = constant
+
+    def copy(self):
+        return HighsLinExpr(dict(self.coeffs), self.constant)
+
+    def add(self, other, factor=1.0):
+        # adds factor * other to self in place
+        other = as_lin_expr(other)
+        for i, c in other.coeffs.items():
+            self.coeffs[i] = self.coeffs.get(i, 0.0) + factor * c
+        self.constant += factor * other.constant
+        return self
+
+    def bounds(self, model):
+        '''
+        :return: lower and upper bound of the expression calculated by interval arithmetic over variable bounds
+        '''
+        lo = self.constant
+        hi = self.constant
+        for i, c in self.coeffs.items():
+            if c >= 0:
+                lo += c * model.lbs[i]
+                hi += c * model.ubs[i]
+            else:
+                lo += c * model.ubs[i]
+                hi += c * model.lbs[i]
+
+        return lo, hi
+
+    def getValue(self):
+        raise ValueError('Value of expression can only be retrieved via model.getValue(expr)!')
+
+    def __add__(self, other):
+        return self.copy().add(other)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return self.copy().add(other, -1.0)
+
+    def __rsub__(self, other):
+        return as_lin_expr(other).copy().add(self, -1.0)
+
+    def __mul__(self, other):
+        if isinstance(other, (HighsLinExpr, HighsVar)):
+            raise ValueError('Only linear expressions are supported by the HiGHS backend!')
+
+        factor = float(other)
+        return HighsLinExpr({i: factor * c for i, c in self.coeffs.items()}, factor * self.constant)
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return self * -1.0
+
+    def __le__(self, other):
+        return HighsTempConstr(self - other, '<')
+
+    def __ge__(self, other):
+        return HighsTempConstr(self - other, '>')
+
+    def __eq__(self, other):
+        if isinstance(other, HighsGenExpr):
+            return HighsGenConstr(self, other)
+        return HighsTempConstr(self - other, '=')
+
+    __hash__ = object.__hash__
+
+
+class HighsVar:
+
+    __array_ufunc__ = None
+
+    def __init__(self, model, index):
+        self.model = model
+        self.index = index
+
+    @property
+    def VarName(self):
+        return self.model.names[self.index]
+
+    @property
+    def VType(self):
+        return self.model.vtypes[self.index]
+
+    @property
+    def LB(self):
+        return self.model.lbs[self.index]
+
+    @LB.setter
+    def LB(self, val):
+        self.model.lbs[self.index] = float(val)
+
+    @property
+    def UB(self):
+        return self.model.ubs[self.index]
+
+    @UB.setter
+    def UB(self, val):
+        self.model.ubs[self.index] = float(val)
+
+    @property
+    def X(self):
+        if self.model.solution is None:
+            raise AttributeError('Unable to retrieve attribute X, no solution available!')
+        return self.model.solution[self.index]
+
+    def __add__(self, other):
+        return as_lin_expr(self) + other
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return as_lin_expr(self) - other
+
+    def __rsub__(self, other):
+        return as_lin_expr(other) - self
+
+    def __mul__(self, other):
+        return as_lin_expr(self) * other
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return as_lin_expr(self) * -1.0
+
+    def __le__(self, other):
+        return as_lin_expr(self) <= other
+
+    def __ge__(self, other):
+        return as_lin_expr(self) >= other
+
+    def __eq__(self, other):
+        return as_lin_expr(self) == other
+
+    __hash__ = object.__hash__
+
+    def __repr__(self):
+        return '<HighsVar {}>'.format(self.VarName)
+
+
+class HighsTempConstr:
+    '''
+    Linear constraint expr sense 0 with sense in ['<', '>', '='].
+    '''
+
+    def __init__(self, expr, sense):
+        self.expr = expr
+        self.sense = sense
+
+    def __rshift__(self, other):
+        # (binvar == value) >> constr
+        if not self.sense == '=' or not len(self.expr.coeffs) == 1:
+            raise ValueError('Left hand side of indicator constraint must be of form (binvar == value)!')
+
+        (index, coeff), = self.expr.coeffs.items()
+        value = -self.expr.constant / coeff
+
+        return HighsIndicatorConstr(index, value, other)
+
+
+class HighsIndicatorConstr:
+
+    def __init__(self, binvar_index, value, constr):
+        self.binvar_index = binvar_index
+        self.value = value
+        self.constr = constr
+
+
+class HighsGenExpr:
+
+    def __init__(self, func, args, constant=None):
+        self.func = func
+        self.args = args
+        self.constant = constant
+
+
+class HighsGenConstr:
+
+    def __init__(self, resvar, genexpr):
+        self.resvar = resvar
+        self.genexpr = genexpr
+
+
+class HighsConstr:
+
+    def __init__(self, name, rows):
+        self.ConstrName = name
+        # indices of the linear rows, that the constraint was translated to
+        self.rows = rows
+
+
+class HighsModel:
+    '''
+    MILP model solved by HiGHS via scipy.optimize.milp.
+
+    Indicator and general constraints (max_, abs_) are linearised with bigM constraints calculated from
+    the variable bounds, therefore all variables occurring in such constraints need finite bounds.
+
+    Only the parameters in PARAMS can be set, as scipy passes only these on to HiGHS. Setting any other
+    gurobi parameter (e.g. BestObjStop, IntFeasTol, MIPFocus) raises an error instead of silently solving
+    under different settings than the gurobi backend.
+    '''
+
+    PARAMS = ['OutputFlag', 'TimeLimit', 'MIPGap', 'Presolve', 'NodeLimit', 'Threads', 'LogFile']
+
+    def __init__(self, name):
+        if milp is None:
+            raise ImportError('scipy >= 1.9 is needed for the HiGHS backend!')
+
+        self.ModelName = name
+
+        self.names = []
+        self.lbs = []
+        self.ubs = []
+        self.vtypes = []
+        self.vars = []
+        self.var_dict = {}
+
+        # each row is a tuple (coeffs, lo, hi) for lo <= coeffs * x <= hi
+        self.rows = []
+        self.constrs = []
+        # number of indicator and general constraints before linearisation (as counted by gurobi)
+        self.num_gen_constrs = 0
+
+        self.objective = HighsLinExpr({}, 0.0)
+        self.ModelSense = MINIMIZE
+
+        self.params = {}
+
+        self.solution = None
+        self.Status = LOADED
+        self.ObjVal = None
+        self.ObjBound = None
+        self.Runtime = 0
+        self.NodeCount = 0
+
+    @property
+    def NumVars(self):
+        return len(self.vars)
+
+    @property
+    def NumConstrs(self):
+        return len(self.rows)
+
+    @property
+    def NumBinVars(self):
+        return self.vtypes.count(BINARY)
+
+    @property
+    def NumIntVars(self):
+        return self.NumBinVars
+
+    @property
+    def NumNZs(self):
+        return sum(len(coeffs) for coeffs, _, _ in self.rows)
+
+    @property
+    def NumGenConstrs(self):
+        return self.num_gen_constrs
+
+    @property
+    def SolCount(self):
+        return 0 if self.solution is None else 1
+
+    def addVar(self, lb=0.0, ub=INFINITY, obj=0.0, vtype=CONTINUOUS, name=''):
+        index = len(self.vars)
+        if name == '':
+            name = 'C{}'.format(index)
+
+        if vtype == BINARY:
+            lb = max(lb, 0)
+            ub = min(ub, 1)
+
+        var = HighsVar(self, index)
+        self.names.append(name)
+        self.lbs.append(float(lb))
+        self.ubs.append(float(ub))
+        self.vtypes.append(vtype)
+        self.vars.append(var)
+        self.var_dict[name] = var
+
+        if not obj == 0:
+            self.objective.add(var, obj)
+
+        return var
+
+    def add_row(self, expr, sense, name=''):
+        expr = as_lin_expr(expr)
+        lo = -INFINITY
+        hi = INFINITY
+        if sense in ['<', '=']:
+            hi = -expr.constant
+        if sense in ['>', '=']:
+            lo = -expr.constant
+
+        self.rows.append((expr.coeffs, lo, hi))
+        return len(self.rows) - 1
+
+    def get_bigM_bounds(self, expr, name):
+        lo, hi = expr.bounds(self)
+        if lo <= -INFINITY or hi >= INFINITY:
+            raise ValueError('Constraint {n} needs finite variable bounds for bigM linearisation!'.format(n=name))
+
+        return lo, hi
+
+    def add_indicator(self, constr, name):
+        # binvar == value --> expr sense 0
+        binvar = self.vars[constr.binvar_index]
+        # inactive = 0, iff indicator is triggered
+        if constr.value >= 0.5:
+            inactive = 1 - binvar
+        else:
+            inactive = as_lin_expr(binvar)
+
+        expr = constr.constr.expr
+        lo, hi = self.get_bigM_bounds(expr, name)
+
+        rows = []
+        if constr.constr.sense in ['<', '=']:
+            rows.append(self.add_row(expr - hi * inactive, '<'))
+        if constr.constr.sense in ['>', '=']:
+            rows.append(self.add_row(expr - lo * inactive, '>'))
+
+        return rows
+
+    def add_max(self, resvar, genexpr, name):
+        # resvar = max(args) <=> resvar >= arg_i for all i and resvar <= arg_i for the selected i
+        args = [as_lin_expr(a) for a in genexpr.args]
+        if genexpr.constant is not None:
+            args.append(as_lin_expr(genexpr.constant))
+
+        res_lo, res_hi = self.get_bigM_bounds(resvar, name)
+
+        rows = []
+        deltas = []
+        for i, arg in enumerate(args):
+            rows.append(self.add_row(resvar - arg, '>'))
+
+            arg_lo, _ = self.get_bigM_bounds(arg, name)
+            delta = self.addVar(vtype=BINARY, name='{n}_max_delta_{i}'.format(n=name, i=i))
+            rows.append(self.add_row(resvar - arg - (res_hi - arg_lo) * (1 - delta), '<'))
+            deltas.append(delta)
+
+        rows.append(self.add_row(self.quicksum(deltas) - 1, '='))
+        return rows
+
+    def add_abs(self, resvar, genexpr, name):
+        # resvar = |arg| <=> resvar >= arg, resvar >= -arg and resvar <= arg or resvar <= -arg
+        arg = as_lin_expr(genexpr.args[0])
+        arg_lo, arg_hi = self.get_bigM_bounds(arg, name)
+        bigM = 2 * max(abs(arg_lo), abs(arg_hi))
+
+        delta = self.addVar(vtype=BINARY, name='{n}_abs_delta'.format(n=name))
+        rows = [self.add_row(resvar - arg, '>'),
+                self.add_row(resvar + arg, '>'),
+                self.add_row(resvar - arg - bigM * (1 - delta), '<'),
+                self.add_row(resvar + arg - bigM * delta, '<')]
+
+        return rows
+
+    def addConstr(self, constr, name=''):
+        if name == '':
+            name = 'R{}'.format(len(self.constrs))
+
+        if isinstance(constr, HighsTempConstr):
+            rows = [self.add_row(constr.expr, constr.sense)]
+        elif isinstance(constr, HighsIndicatorConstr):
+            rows = self.add_indicator(constr, name)
+            self.num_gen_constrs += 1
+        elif isinstance(constr, HighsGenConstr):
+            self.num_gen_constrs += 1
+            resvar = as_lin_expr(constr.resvar)
+            if constr.genexpr.func == 'max':
+                rows = self.add_max(resvar, constr.genexpr, name)
+            else:
+                rows = self.add_abs(resvar, constr.genexpr, name)
+        else:
+            raise ValueError('Constraint {n} of type {t} is not supported!'.format(n=name, t=type(constr)))
+
+        c = HighsConstr(name, rows)
+        self.constrs.append(c)
+        return c
+
+    @staticmethod
+    def quicksum(terms):
+        expr = HighsLinExpr({}, 0.0)
+        for t in terms:
+            expr.add(t)
+        return expr
+
+    @staticmethod
+    def max_(*args, constant=None):
+        if len(args) == 1 and isinstance(args[0], (list, tuple)):
+            args = args[0]
+
+        vars = [a for a in args if isinstance(a, (HighsVar, HighsLinExpr))]
+        constants = [float(a) for a in args if not isinstance(a, (HighsVar, HighsLinExpr))]
+        if constant is not None:
+            constants.append(float(constant))
+
+        if constants:
+            constant = max(constants)
+
+        return HighsGenExpr('max', vars, constant)
+
+    @staticmethod
+    def abs_(arg):
+        return HighsGenExpr('abs', [arg])
+
+    def setObjective(self, expr, sense=None):
+        self.objective = as_lin_expr(expr).copy()
+        if sense is not None:
+            self.ModelSense = sense
+
+    def setParam(self, name, value):
+        if name not in self.PARAMS:
+            raise ValueError('Parameter {p} is not supported by the HiGHS backend!\nSupported parameters are: '
+                             '\n\t{s}'.format(p=name, s=', '.join(self.PARAMS)))
+
+        # the MIP solver of HiGHS in scipy is single threaded, LogFile is ignored (output only goes to stdout)
+        if name == 'Threads' and value > 1:
+            raise ValueError('The HiGHS backend only supports Threads = 1!')
+
+        self.params[name] = value
+
+    def getVarByName(self, name):
+        return self.var_dict.get(name)
+
+    def getVars(self):
+        return self.vars[:]
+
+    def getConstrs(self):
+        return self.constrs[:]
+
+    def getAttr(self, name, objs=None):
+        '''
+        :return: attribute of the model, if objs is None, otherwise list of the attribute of the objs
+        '''
+        if objs is None:
+            return getattr(self, name)
+
+        return [getattr(o, name) for o in objs]
+
+    def setAttr(self, name, objs, values):
+        for o, v in zip(objs, values):
+            setattr(o, name, v)
+
+    def getValue(self, expr):
+        expr = as_lin_expr(expr)
+        return expr.constant + sum(c * self.solution[i] for i, c in expr.coeffs.items())
+
+    def update(self):
+        pass
+
+    def get_options(self):
+        options = {'disp': bool(self.params.get('OutputFlag', 1))}
+        if 'TimeLimit' in self.params:
+            options['time_limit'] = self.params['TimeLimit']
+        if 'MIPGap' in self.params:
+            options['mip_rel_gap'] = self.params['MIPGap']
+        if 'Presolve' in self.params:
+            options['presolve'] = not self.params['Presolve'] == 0
+        if 'NodeLimit' in self.params:
+            options['node_limit'] = int(self.params['NodeLimit'])
+
+        return options
+
+    def get_matrices(self):
+        '''
+        :return: objective vector c, constraint matrix A (scipy.sparse CSR), row bounds row_lo <= A * x <= row_hi,
+            variable bounds lb <= x <= ub and integrality vector (1 for binary variables) of the model,
+            infinite bounds are given as +/- np.inf
+        '''
+        def inf(vals):
+            vals = np.array(vals, dtype=float)
+            vals[vals >= INFINITY] = np.inf
+            vals[vals <= -INFINITY] = -np.inf
+            return vals
+
+        n = len(self.vars)
+
+        c = np.zeros(n)
+        for i, coeff in self.objective.coeffs.items():
+            c[i] = coeff
+
+        data = []
+        indices = []
+        indptr = [0]
+        for coeffs, _, _ in self.rows:
+            indices += list(coeffs.keys())
+            data += list(coeffs.values())
+            indptr.append(len(indices))
+
+        A = csr_matrix((data, indices, indptr), shape=(len(self.rows), n))
+        row_lo = inf([r[1] for r in self.rows])
+        row_hi = inf([r[2] for r in self.rows])
+
+        integrality = np.array([1 if t == BINARY else 0 for t in self.vtypes])
+
+        return c, A, row_lo, row_hi, inf(self.lbs), inf(self.ubs), integrality
+
+    def get_row_names(self):
+        '''
+        :return: list of names of the linear rows, rows of constraints translated to multiple rows get the
+            constraint name with a suffix _i
+        '''
+        names = [None] * len(self.rows)
+        for constr in self.constrs:
+            if len(constr.rows) == 1:
+                names[constr.rows[0]] = constr.ConstrName
+            else:
+                for i, r in enumerate(constr.rows):
+                    names[r] = '{n}_{i}'.format(n=constr.ConstrName, i=i)
+
+        return names
+
+    def optimize(self, callback=None):
+        if callback is not None:
+            raise ValueError('Callbacks are not supported by the HiGHS backend!')
+
+        c, A, row_lo, row_hi, lb, ub, integrality = self.get_matrices()
+        # scipy always minimizes
+        c *= self.ModelSense
+
+        constraints = []
+        if self.rows:
+            constraints.append(LinearConstraint(A, row_lo, row_hi))
+
+        start = timer()
+        res = milp(c, integrality=integrality, bounds=Bounds(lb, ub), constraints=constraints,
+                   options=self.get_options())
+        self.Runtime = timer() - start
+
+        if res.x is not None:
+            self.solution = res.x
+            self.ObjVal = self.ModelSense * res.fun + self.objective.constant
+        else:
+            self.solution = None
+            self.ObjVal = None
+
+        bound = getattr(res, 'mip_dual_bound', None)
+        if bound is None and res.status == 0:
+            bound = res.fun
+
+        if bound is None:
+            self.ObjBound = -self.ModelSense * INFINITY
+        else:
+            self.ObjBound = self.ModelSense * bound + self.objective.constant
+
+        self.NodeCount = getattr(res, 'mip_node_count', 0)
+        self.Status = {0: OPTIMAL, 1: TIME_LIMIT, 2: INFEASIBLE, 3: UNBOUNDED}.get(res.status, LOADED)
@@ -0,0 +1,134 @@
+'''
+Content-addressed cache for built equivalence models.
+
+The key of a model is the sha256 hash over the bytes of the NN files, the encoding configuration (mode, input
+region, tightening, ...) and all settings in flags_constants. A cached model consists of
+    key.mps.gz - the compressed model
+    key.json   - sidecar with the configuration, the variables of the model (name, type, bounds) and the
+                 tightened bounds of the encoder variables (for inspection, loaded models have no encoder)
+'''
+import flags_constants as fc
+import milp_backend as mb
+from expression_encoding import flatten
+from timeit import default_timer as timer
+import numpy as np
+import hashlib
+import socket
+import json
+import os
+
+
+def get_flags():
+    '''
+    :return: dict of all settings in flags_constants
+    '''
+    return {k: v for k, v in vars(fc).items()
+            if not k.startswith('_') and isinstance(v, (bool, int, float, str, list, tuple))}
+
+
+def to_json(obj):
+    # numpy arrays and scalars in configurations
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    elif isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj)))
+
+
+class ModelCache:
+
+    def __init__(self, cache_dir='ModelCache'):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, paths, config):
+        '''
+        :param paths: paths to the NN files
+        :param config: dict of the encoding configuration (mode, center, radius, bounds, tightening, ...)
+        :return: hex digest identifying the model
+        '''
+        h = hashlib.sha256()
+        for path in paths:
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+
+        h.update(json.dumps({'config': config, 'flags': get_flags()}, sort_keys=True, default=to_json).encode())
+        return h.hexdigest()
+
+    def get_files(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.mps.gz', base + '.json'
+
+    def contains(self, key):
+        return all(os.path.exists(f) for f in self.get_files(key))
+
+    def load(self, key):
+        '''
+        :param key: key of the model
+        :return: tuple (gurobi model, sidecar dict) or None, if the model is not in the cache
+        '''
+        if not self.contains(key):
+            return None
+
+        model_file, sidecar_file = self.get_files(key)
+        with open(sidecar_file) as f:
+            sidecar = json.load(f)
+
+        model = mb.GurobiModel(sidecar['model_name'], mb.grb.read(model_file))
+        model.setAttr('ModelName', sidecar['model_name'])
+
+        return model, sidecar
+
+    def store(self, key, model, encoder=None, config=None):
+        '''
+        Stores a gurobi model and (optionally) the bounds of the variables of its encoder in the cache.
+        Files are first written to temporary files and then renamed, s.t. concurrent readers never see
+        partially written files.
+        '''
+        model_file, sidecar_file = self.get_files(key)
+        model.update()
+
+        grb_vars = model.getVars()
+        sidecar = {'key': key, 'model_name': model.getAttr('ModelName'), 'config': config, 'flags': get_flags(),
+                   'model_vars': [[v.VarName, v.VType, v.LB, v.UB] for v in grb_vars]}
+
+        if encoder is not None:
+            sidecar['bounds'] = {v.name: [v.getLo(), v.getHi(), v.hasLo, v.hasHi]
+                                 for v in flatten(encoder.get_vars())}
+
+        # temporary files per process, as several processes may store the same model at once
+        suffix = '.{h}_{p}.tmp'.format(h=socket.gethostname(), p=os.getpid())
+        tmp_model_file = model_file[:-len('.mps.gz')] + suffix + '.mps.gz'
+        model.write(tmp_model_file)
+        os.replace(tmp_model_file, model_file)
+
+        tmp_sidecar_file = sidecar_file + suffix
+        with open(tmp_sidecar_file, 'w') as f:
+            json.dump(sidecar, f, default=to_json)
+        os.replace(tmp_sidecar_file, sidecar_file)
+
+    def get_or_build(self, paths, config, build, printing=True):
+        '''
+        Loads the model from the cache or builds and stores it, if it is not cached yet.
+        :param paths: paths to the NN files
+        :param config: dict of the encoding configuration
+        :param build: function without arguments returning tuple (model, encoder)
+        :param printing: if True, cache hits and misses are printed
+        :return: the gurobi model
+        '''
+        key = self.get_key(paths, config)
+
+        start = timer()
+        cached = self.load(key)
+        if cached is not None:
+            model, _ = cached
+            if printing:
+                print('### model {k} loaded from cache in {t} s'.format(k=key, t=timer() - start))
+            return model
+
+        model, encoder = build()
+        self.store(key, model, encoder, config)
+        if printing:
+            print('### model {k} built and stored in cache in {t} s'.format(k=key, t=timer() - start))
+
+        return model
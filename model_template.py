@@ -0,0 +1,212 @@
+from performance import Encoder
+from expression_encoding import interval_arithmetic
+import gurobipy as grb
+import numpy as np
+
+
+class EquivalenceTemplate:
+    '''
+    Gurobi model of the equivalence of two NNs, that is encoded and tightened once for an enclosing input region.
+    Afterwards it can be re-parameterized in place for every (center, radius, metric, halfspaces) query within
+    that region, instead of loading, encoding, tightening and building the model again for every query.
+
+    Only the bounds of the input variables and the right-hand sides of the radius constraints change between
+    queries, the bounds of the NN variables stay the ones calculated for the enclosing region.
+    '''
+
+    def __init__(self, path1, path2, input_lower_bounds, input_upper_bounds, mode, name='NN_Template',
+                 tighten_bounds=True, max_incumbents=10):
+        '''
+        :param path1: path to the reference NN
+        :param path2: path to the NN to compare against
+        :param input_lower_bounds: lower bounds of the enclosing input region
+        :param input_upper_bounds: upper bounds of the enclosing input region
+        :param mode: one_hot_partial_top_k or optimize_diff_[manhattan | chebyshev]
+        :param name: name of the gurobi model
+        :param tighten_bounds: if True, bounds are tightened via optimize_constraints otherwise only via
+            interval arithmetic
+        :param max_incumbents: number of previously found solutions, that are kept for use as MIP starts
+        '''
+        self.encoder = Encoder()
+        self.encoder.encode_equiv(path1, path2, input_lower_bounds, input_upper_bounds, mode)
+
+        if tighten_bounds:
+            self.encoder.optimize_constraints()
+        else:
+            interval_arithmetic(self.encoder.get_constraints())
+
+        # re-parameterization relies on gurobi attributes (RHS, Start, Xn)
+        self.model = self.encoder.create_gurobi_model(backend='gurobi')
+        self.model.setAttr('ModelName', name)
+
+        invars = self.encoder.input_layer.get_outvars()
+        self.dim = len(invars)
+        self.box_lo = np.array([v.getLo() for v in invars], dtype=float)
+        self.box_hi = np.array([v.getHi() for v in invars], dtype=float)
+        self.grb_invars = [self.model.getVarByName(str(v)) for v in invars]
+
+        # i - c = p - n with p, n >= 0, sum(p + n) <= r
+        # center and radius only appear on the right-hand side of these constraints
+        spread = self.box_hi - self.box_lo
+        self.pos_vars = [self.model.addVar(lb=0, ub=spread[i], name='t_pos_0_{}'.format(i)) for i in range(self.dim)]
+        self.neg_vars = [self.model.addVar(lb=0, ub=spread[i], name='t_neg_0_{}'.format(i)) for i in range(self.dim)]
+        self.center_constrs = [self.model.addConstr(x - p + n == 0, name='t_center_0_{}'.format(i))
+                               for i, (x, p, n) in enumerate(zip(self.grb_invars, self.pos_vars, self.neg_vars))]
+        self.radius_constr = self.model.addConstr(grb.quicksum(self.pos_vars + self.neg_vars) <= spread.sum(),
+                                                  name='t_radius_0_0')
+        self.halfspace_constrs = []
+        self.model.update()
+
+        self.center = None
+        self.radius = None
+        self.metric = None
+        self.halfspaces = []
+        self.lo = self.box_lo.copy()
+        self.hi = self.box_hi.copy()
+
+        self.max_incumbents = max_incumbents
+        # list of (objective value, inputs, values of all model vars)
+        self.incumbents = []
+
+    def set_region(self, center, radius, metric='manhattan', halfspaces=None):
+        '''
+        Restricts the inputs of the model to a ball of specified radius around the center according to the
+        metric and (optionally) to a polytope given as halfspaces. The query region is intersected with the
+        enclosing region of the template.
+
+        If one of the previously found solutions lies within the new region, it is set as MIP start.
+
+        :param center: center of the ball
+        :param radius: radius of the ball
+        :param metric: either chebyshev OR manhattan is supported
+        :param halfspaces: list of tuples (factors, constant) for halfspaces factors * x + constant <= 0
+            (e.g. as calculated by cluster_boundary_halfspace)
+        '''
+        if not metric in ['manhattan', 'chebyshev']:
+            raise ValueError('Metric {m} is not supported!'.format(m=metric))
+
+        if not len(center) == self.dim:
+            raise ValueError('Center has dimension {cdim}, but input has dimension {idim}'.format(cdim=len(center),
+                                                                                                idim=self.dim))
+
+        if halfspaces is None:
+            halfspaces = []
+
+        center = np.array(center, dtype=float)
+        lo = np.maximum(self.box_lo, center - radius)
+        hi = np.minimum(self.box_hi, center + radius)
+
+        if np.any(lo > hi):
+            raise ValueError('Region around center with radius {r} does not intersect the template region'.format(
+                r=radius))
+
+        self.model.setAttr('LB', self.grb_invars, lo.tolist())
+        self.model.setAttr('UB', self.grb_invars, hi.tolist())
+        self.model.setAttr('UB', self.pos_vars, np.maximum(0, hi - center).tolist())
+        self.model.setAttr('UB', self.neg_vars, np.maximum(0, center - lo).tolist())
+        self.model.setAttr('RHS', self.center_constrs, center.tolist())
+
+        if metric == 'manhattan':
+            self.radius_constr.setAttr('RHS', float(radius))
+        else:
+            # box bounds already are the chebyshev ball, radius constraint is never binding
+            self.radius_constr.setAttr('RHS', float(np.maximum(0, hi - center).sum() + np.maximum(0, center - lo).sum()))
+
+        for constr in self.halfspace_constrs:
+            self.model.remove(constr)
+
+        self.halfspace_constrs = []
+        for i, (factors, constant) in enumerate(halfspaces):
+            expr = grb.LinExpr([float(f) for f in factors], self.grb_invars)
+            self.halfspace_constrs.append(self.model.addConstr(expr + float(constant) <= 0,
+                                                               name='t_halfspace_0_{}'.format(i)))
+
+        self.center = center
+        self.radius = radius
+        self.metric = metric
+        self.halfspaces = halfspaces
+        self.lo = lo
+        self.hi = hi
+
+        self.set_incumbent_start()
+        self.model.update()
+
+    def contains(self, inputs, tolerance=1e-6):
+        '''
+        :param inputs: input values
+        :param tolerance: absolute tolerance for every constraint of the region
+        :return: True, if inputs lie within the current region of the template
+        '''
+        inputs = np.array(inputs, dtype=float)
+
+        if np.any(inputs < self.lo - tolerance) or np.any(inputs > self.hi + tolerance):
+            return False
+
+        if self.metric == 'manhattan' and np.abs(inputs - self.center).sum() > self.radius + tolerance:
+            return False
+
+        for factors, constant in self.halfspaces:
+            if np.dot(factors, inputs) + constant > tolerance:
+                return False
+
+        return True
+
+    def set_incumbent_start(self):
+        '''
+        Sets the best stored solution, that lies within the current region, as MIP start.
+        Values of the positive and negative part of (input - center) are recalculated for the current center.
+        '''
+        grb_vars = self.model.getVars()
+        self.model.setAttr('Start', grb_vars, [grb.GRB.UNDEFINED] * len(grb_vars))
+
+        feasible = [inc for inc in self.incumbents if self.contains(inc[1])]
+        if not feasible:
+            return
+
+        if self.model.ModelSense == grb.GRB.MAXIMIZE:
+            _, inputs, values = max(feasible, key=lambda inc: inc[0])
+        else:
+            _, inputs, values = min(feasible, key=lambda inc: inc[0])
+
+        centered = inputs - self.center
+        start = dict(zip(self.model.getAttr('VarName', grb_vars), values))
+        start.update({p.VarName: v for p, v in zip(self.pos_vars, np.maximum(0, centered))})
+        start.update({n.VarName: v for n, v in zip(self.neg_vars, np.maximum(0, -centered))})
+
+        self.model.setAttr('Start', grb_vars, [start[v.VarName] for v in grb_vars])
+
+    def store_incumbents(self):
+        '''
+        Stores all solutions of the last optimization run for later use as MIP starts.
+        '''
+        grb_vars = self.model.getVars()
+
+        for s in range(self.model.SolCount):
+            self.model.setParam('SolutionNumber', s)
+            values = self.model.getAttr('Xn', grb_vars)
+            inputs = np.array(self.model.getAttr('Xn', self.grb_invars))
+            self.incumbents.append((self.model.PoolObjVal, inputs, values))
+
+        reverse = self.model.ModelSense == grb.GRB.MAXIMIZE
+        self.incumbents = sorted(self.incumbents, key=lambda inc: inc[0], reverse=reverse)[:self.max_incumbents]
+
+    def optimize(self, callback=None):
+        '''
+        Optimizes the model for the current region and stores the found solutions. The termination policy set
+        via self.encoder.set_termination_policy is applied.
+        :param callback: gurobi callback passed on to model.optimize
+        :return: the optimized gurobi model
+        '''
+        if self.center is None:
+            raise ValueError('No region specified! Call set_region before optimizing.')
+
+        self.encoder.optimize(self.model, callback)
+        self.store_incumbents()
+
+        return self.model
+
+    def get_inputs(self):
+        '''
+        :return: values of the input variables in the current solution
+        '''
+        return [v.X for v in self.grb_invars]
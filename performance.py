@@ -8,7 +8,8 @@ import numpy as np
 from expression_encoding import encode_equivalence, interval_arithmetic, hasLinear, encode_linear_layer, \
     encode_relu_layer, encode_one_hot, encode_ranking_layer, encode_equivalence_layer, create_gurobi_model, pretty_print, \
     encode_partial_layer, encode_sort_one_hot_layer, flatten
-import gurobipy as grb
+import milp_backend as mb
+from termination import TerminationPolicy
 
 
 class Layer(ABC):
@@ -101,6 +102,25 @@ class ReLULayer(Layer):
         return self.lin_layer.get_optimization_constraints()
 
 
+def cluster_boundary_halfspace(c1, c2, epsilon):
+    '''
+    Calculates the halfspace factors * x + constant <= 0 that contains the points, which are closer to cluster-center
+    c1 than to cluster-center c2 (up until epsilon / 2 of the distance between the centers).
+    :param c1: the cluster-center of the current cluster
+    :param c2: the cluster-center of the neighbouring cluster
+    :param epsilon: ratio of how close to the boundary of the voronoi region the halfspace should be
+    :return: tuple (factors, constant) of the halfspace
+    '''
+    c1 = np.array(c1)
+    c2 = np.array(c2)
+
+    factors = c2 - c1
+    constant = (epsilon / 2) * np.linalg.norm(c2 - c1)**2
+    constant += (np.linalg.norm(c1)**2 - np.linalg.norm(c2)**2) / 2
+
+    return factors, constant
+
+
 class Encoder:
 
     def __init__(self):
@@ -112,11 +132,46 @@ class Encoder:
         self.equiv_mode = None
         self.radius_mode = None
 
+        self.nn_paths = None
+        self.nn_layers = None
+
         self.opt_timeout = 20
+        self.termination_policy = None
 
     def set_opt_timeout(self, new_val):
         self.opt_timeout = new_val
 
+    def set_termination_policy(self, policy=None, time_budget=None):
+        '''
+        Sets the TerminationPolicy used by optimize.
+
+        :param policy: TerminationPolicy, if None a default policy according to the encoded property is used
+            (stop on counterexample or proof of equivalence for equivalence modes, on radius known up to
+            fc.epsilon for variable radius)
+        :param time_budget: time budget in seconds for the default policy
+        '''
+        if policy is None:
+            if self.radius_mode == 'variable':
+                policy = TerminationPolicy.for_radius(fc.epsilon, time_budget)
+            else:
+                policy = TerminationPolicy.for_equivalence(time_budget=time_budget)
+
+        self.termination_policy = policy
+
+    def optimize(self, model, callback=None):
+        '''
+        Optimizes a model created by create_gurobi_model, applying the termination policy if one is set.
+
+        :param model: the model
+        :param callback: additional gurobi callback
+        :return: reason for termination by the policy or None
+        '''
+        if self.termination_policy is None:
+            model.optimize(callback)
+            return None
+
+        return self.termination_policy.optimize(model, callback)
+
     def encode_inputs(self, lower_bounds, upper_bounds, netPrefix=''):
         vars = []
         for i, (l, h) in enumerate(zip(lower_bounds, upper_bounds)):
@@ -131,11 +186,12 @@ class Encoder:
     def pretty_print(self):
         pretty_print(self.get_vars(), self.get_constraints())
 
-    def create_gurobi_model(self):
+    def create_gurobi_model(self, backend=None):
         """
         Creates gurobi model as specified by constraints added through the methods encode_equivalence or
         encode_equivalence_from_file and add_input_radius.
 
+        :param backend: MILP backend ('gurobi' or 'highs'), if None fc.milp_backend is used
         :return: A gurobi model of the equivalence property encoded
         """
         if not self.equiv_mode:
@@ -145,18 +201,18 @@ class Encoder:
         if not self.radius_mode:
             r_str = ''
 
-        model = create_gurobi_model(self.get_vars(), self.get_constraints())
+        model = create_gurobi_model(self.get_vars(), self.get_constraints(), backend=backend)
 
         if r_str == 'variable':
             r = model.getVarByName('r_0_0')
-            model.setObjective(r, grb.GRB.MINIMIZE)
+            model.setObjective(r, mb.MINIMIZE)
         elif self.equiv_mode.startswith('one_hot_partial_top_'):
             k = self.equiv_mode.split('_')[-1]
             diff = model.getVarByName('E_diff_0_' + k)
-            model.setObjective(diff, grb.GRB.MAXIMIZE)
+            model.setObjective(diff, mb.MAXIMIZE)
         elif self.equiv_mode.startswith('optimize_diff_'):
             diff = model.getVarByName('E_norm_1_0')
-            model.setObjective(diff, grb.GRB.MAXIMIZE)
+            model.setObjective(diff, mb.MAXIMIZE)
 
         return model
 
@@ -210,6 +266,33 @@ class Encoder:
 
             return ineqs, additional_vars
 
+        def add_split_variable_constraints(radius, dimension, netPrefix, invars, center):
+            # i - c = p - n with p, n >= 0 and sum(p + n) <= r
+            # exact for the l1-ball, as the ball is convex and the sum only needs an upper bound
+            # -> no binaries needed
+            ineqs = []
+            additional_vars = []
+
+            pos_vars = [Variable(0, i, netPrefix, 'pos') for i in range(dimension)]
+            neg_vars = [Variable(0, i, netPrefix, 'neg') for i in range(dimension)]
+            for i, (invar, p, n) in enumerate(zip(invars, pos_vars, neg_vars)):
+                p.update_bounds(0, max(0, invar.getHi() - center[i]))
+                n.update_bounds(0, max(0, center[i] - invar.getLo()))
+
+                center_i = Constant(float(center[i]), netPrefix, 0, i)
+                ineqs.append(Linear(Sum([center_i, p, Neg(n)]), invar))
+                # p, n >= 0 also as constraints, as the bounds of non-delta variables are not exported to SMT-LIB
+                # with fc.hide_non_deltas
+                ineqs.append(Geq(p, Constant(0, netPrefix, 0, i)))
+                ineqs.append(Geq(n, Constant(0, netPrefix, 0, i)))
+
+            ineqs.append(Geq(radius, Sum(pos_vars + neg_vars)))
+
+            additional_vars.append(pos_vars)
+            additional_vars.append(neg_vars)
+
+            return ineqs, additional_vars
+
         def add_direct_constraints(radius, dimension, centered_inputs):
             ineqs = []
             for i in range(2 ** dimension):
@@ -263,7 +346,12 @@ class Encoder:
                 additional_ineqs.append(Geq(invar, Sum([center_i, Neg(r)])))
                 additional_ineqs.append(Geq(Sum([center_i, r]), invar))
 
-        if metric == 'manhattan':
+        if metric == 'manhattan' and fc.manhattan_use_split_variables:
+            ineqs, constraint_vars = add_split_variable_constraints(r, dim, netPrefix, invars, center)
+
+            additional_vars += constraint_vars
+            additional_ineqs += ineqs
+        elif metric == 'manhattan':
             centered_inputs = []
 
             for i in range(dim):
@@ -280,12 +368,7 @@ class Encoder:
         self.input_layer.add_input_constraints(additional_ineqs, additional_vars)
 
     def calc_cluster_boundary(self, c1, c2, epsilon):
-        c1 = np.array(c1)
-        c2 = np.array(c2)
-
-        factors = c2 - c1
-        constant = (epsilon / 2) * np.linalg.norm(c2 - c1)**2
-        constant += (np.linalg.norm(c1)**2 - np.linalg.norm(c2)**2) / 2
+        factors, constant = cluster_boundary_halfspace(c1, c2, epsilon)
 
         invars = self.input_layer.get_outvars()
         netPrefix, _, _ = invars[0].getIndex()
@@ -580,16 +663,32 @@ class Encoder:
             loader.load(path)
             layers.append(loader.getHiddenLayers())
 
+        # copies, as encode_equivalence appends the comparison layers to the layer lists
+        self.nn_paths = paths
+        self.nn_layers = [list(l) for l in layers]
         self.encode_equivalence(layers[0], layers[1], input_lower_bounds, input_upper_bounds, compared, comparator)
 
+    def seed_mip_start(self, model, archive, region):
+        '''
+        Sets the best counterexample of the archive within the region as MIP start.
+        Requires the NNs to be encoded via encode_equivalence_from_file or encode_equiv.
+
+        :param model: model created by create_gurobi_model
+        :param archive: CounterexampleArchive
+        :param region: SamplingRegion of the inputs encoded in the model
+        :return: objective value of the MIP start or None, if no archived point could be used
+        '''
+        return archive.seed_mip_start(model, self.nn_paths[0], self.nn_paths[1], self.equiv_mode, self.nn_layers,
+                                      region)
+
     def optimize_variable(self, var, opt_vars, opt_constraints):
         model_ub = create_gurobi_model(opt_vars, opt_constraints,
                                        name='{vname} upper bound optimization'.format(vname=str(var)))
-        model_ub.setObjective(var.to_gurobi(model_ub), grb.GRB.MAXIMIZE)
+        model_ub.setObjective(var.to_gurobi(model_ub), mb.MAXIMIZE)
 
         model_lb = create_gurobi_model(opt_vars, opt_constraints,
                                        name='{vname} lower bound optimization'.format(vname=str(var)))
-        model_lb.setObjective(var.to_gurobi(model_lb), grb.GRB.MINIMIZE)
+        model_lb.setObjective(var.to_gurobi(model_lb), mb.MINIMIZE)
 
         model_ub.setParam('TimeLimit', self.opt_timeout)
         model_lb.setParam('TimeLimit', self.opt_timeout)
@@ -0,0 +1,200 @@
+'''
+Solves copies of the same gurobi model with different parameter configurations concurrently.
+
+Every configuration runs in its own thread on a copy of the model with a share of the available threads.
+As soon as one configuration proves optimality or finds a counterexample with objective above a threshold,
+all other configurations are terminated.
+'''
+import gurobipy as grb
+from timeit import default_timer as timer
+import itertools as itt
+import multiprocessing
+import threading
+
+
+def set_branch_priorities(model, s, delta, pi):
+    for v in model.getVars():
+        if 's' in v.varName:
+            v.setAttr('BranchPriority', s)
+        elif 'pi' in v.varName:
+            v.setAttr('BranchPriority', pi)
+        elif 'd' in v.varName and 'diff' not in v.varName:
+            v.setAttr('BranchPriority', delta)
+        else:
+            v.setAttr('BranchPriority', 0)
+
+    model.update()
+
+
+class SolverConfig:
+
+    def __init__(self, name, params=None, branch_priorities=None):
+        '''
+        :param name: name of the configuration used for logging
+        :param params: dict of gurobi parameters
+        :param branch_priorities: tuple (s, delta, pi) of branch priorities for the sum, delta and pi variables
+        '''
+        self.name = name
+        self.params = params if params is not None else {}
+        self.branch_priorities = branch_priorities
+
+    def apply(self, model):
+        for param, value in self.params.items():
+            model.setParam(param, value)
+
+        if self.branch_priorities is not None:
+            set_branch_priorities(model, *self.branch_priorities)
+
+        model.update()
+
+    def __repr__(self):
+        return self.name
+
+
+def default_configs():
+    return [SolverConfig('default'),
+            SolverConfig('MIPFocus=1', {'MIPFocus': 1}),
+            SolverConfig('MIPFocus=2', {'MIPFocus': 2}),
+            SolverConfig('MIPFocus=3', {'MIPFocus': 3})]
+
+
+def branching_configs(values=(0, 1, 2)):
+    '''
+    :return: configurations for all combinations of branch priorities for sum, delta and pi variables
+        (as evaluated sequentially in evaluate_branching)
+    '''
+    return [SolverConfig('s={s}_delta={d}_pi={p}'.format(s=s, d=d, p=p), branch_priorities=(s, d, p))
+            for s, d, p in itt.product(values, repeat=3)]
+
+
+def copy_params(source, target):
+    '''
+    Sets all parameters of the target model, that have a non-default value in the source model.
+    '''
+    for param in dir(grb.GRB.Param):
+        if param.startswith('_'):
+            continue
+
+        try:
+            _, _, value, _, _, default = source.getParamInfo(param)
+            if not value == default:
+                target.setParam(param, value)
+        except grb.GurobiError:
+            # parameters, that can't be read or set per model
+            pass
+
+
+def copy_model(model):
+    # separate environment for every thread, as models in the same environment are not thread-safe
+    # (copying to another environment is only supported by newer gurobi versions)
+    try:
+        env = grb.Env()
+        m = model.copy(env)
+    except (TypeError, grb.GurobiError):
+        return model.copy()
+
+    # the parameters of the model are those of its environment, which are not copied to the new one
+    copy_params(model, m)
+    return m
+
+
+def solve_portfolio(model, configs=None, threads=None, obj_stop=None, time_limit=None, printing=True):
+    '''
+    :param model: gurobi model with objective set
+    :param configs: list of SolverConfigs, default_configs() if None
+    :param threads: total number of threads shared by all configurations, number of cpus if None
+    :param obj_stop: all configurations are stopped, if a solution with objective >= obj_stop (for maximization,
+        <= obj_stop for minimization) is found, e.g. a counterexample violating equivalence
+    :param time_limit: time limit in seconds for each configuration
+    :param printing: if True, the results of the configurations are printed
+    :return: tuple (winning config, model solved by the winning config, list of result dicts for all configs)
+        the winner is the first config, that proved optimality or found a solution reaching obj_stop,
+        if no config finished, the winner is the config with the best objective
+    '''
+    if configs is None:
+        configs = default_configs()
+
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+
+    model.update()
+    maximize = model.ModelSense == grb.GRB.MAXIMIZE
+
+    threads_per_config = max(1, threads // len(configs))
+
+    copies = []
+    for config in configs:
+        m = copy_model(model)
+        config.apply(m)
+        m.setParam('Threads', threads_per_config)
+        if time_limit is not None:
+            m.setParam('TimeLimit', time_limit)
+        copies.append(m)
+
+    stop = threading.Event()
+    lock = threading.Lock()
+    winner = []
+
+    def reached_obj_stop(obj):
+        if obj_stop is None:
+            return False
+        return obj >= obj_stop if maximize else obj <= obj_stop
+
+    def set_winner(idx):
+        with lock:
+            if not winner:
+                winner.append(idx)
+        stop.set()
+
+    def make_callback(idx):
+        def callback(m, where):
+            if stop.is_set():
+                m.terminate()
+            elif where == grb.GRB.Callback.MIPSOL:
+                if reached_obj_stop(m.cbGet(grb.GRB.Callback.MIPSOL_OBJ)):
+                    set_winner(idx)
+                    m.terminate()
+
+        return callback
+
+    results = [None] * len(configs)
+
+    def run(idx):
+        m = copies[idx]
+        start = timer()
+        m.optimize(make_callback(idx))
+        now = timer()
+
+        if m.Status == grb.GRB.OPTIMAL:
+            set_winner(idx)
+
+        obj = m.ObjVal if m.SolCount > 0 else None
+        results[idx] = {'config': configs[idx].name, 'status': m.Status, 'obj': obj, 'bound': m.ObjBound,
+                        'time': now - start, 'nodes': m.NodeCount}
+
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(len(configs))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    if winner:
+        win_idx = winner[0]
+    else:
+        solved = [i for i, r in enumerate(results) if r['obj'] is not None]
+        if solved:
+            key = lambda i: results[i]['obj']
+            win_idx = max(solved, key=key) if maximize else min(solved, key=key)
+        else:
+            win_idx = 0
+
+    for i, r in enumerate(results):
+        r['winner'] = i == win_idx
+
+    if printing:
+        for r in results:
+            print('### {w}{c}: status={s}, (val, bound) = ({v}, {bd}), time={t}'.format(
+                w='* ' if r['winner'] else '', c=r['config'], s=r['status'], v=r['obj'], bd=r['bound'],
+                t=r['time']))
+
+    return configs[win_idx], copies[win_idx], results
@@ -0,0 +1,241 @@
+'''
+Search for the largest radius around a center, for which two NNs are equivalent, by fixed-radius queries.
+
+Instead of minimizing the radius of a counterexample in one variable-radius MILP, the radius is bracketed by
+queries "is there a counterexample within radius r?" on one EquivalenceTemplate, that is encoded and tightened once
+for the largest radius and only re-parameterized for every query. As balls of smaller radius are contained in
+balls of larger radius, the results carry over between queries:
+    - equivalent within r:          equivalent within every radius <= r, r is the new lower end of the bracket
+    - counterexample x within r:    counterexample within every radius >= |x - center|, so the upper end of the
+                                    bracket is the distance of x (which may be smaller than r)
+    - unknown (time limit):         nothing is certified, but the search continues below r
+The bracket is first found by galloping (doubling the radius up from r_init until a counterexample is found,
+halving it down from the counterexample until equivalence is proven) and then narrowed by bisection until it is
+smaller than the precision. With probes > 1, several radii are queried in parallel in every round by worker
+processes, that each keep their own template for all rounds.
+'''
+import flags_constants as fc
+from model_template import EquivalenceTemplate
+from falsification import set_input_start
+from termination import TerminationPolicy
+from timeit import default_timer as timer
+import numpy as np
+from queue import Empty
+import multiprocessing
+import traceback
+
+
+def distance(inputs, center, metric):
+    diff = np.abs(np.array(inputs, dtype=float) - np.array(center, dtype=float))
+    return float(diff.sum() if metric == 'manhattan' else diff.max())
+
+
+def probe_radius(template, radius, metric, tolerance, time_limit, counterexample=None, bound_tol=1e-6):
+    '''
+    Checks for a counterexample within the radius around the center of the template.
+
+    :param template: EquivalenceTemplate, whose enclosing region contains the ball
+    :param counterexample: inputs of a counterexample outside of the ball, its projection onto the ball
+        (scaled towards the center) is used as MIP start, if the template has no previous solution in the ball
+    :param bound_tol: bounds <= bound_tol prove equivalence (the maximum diff is often 0 up to numerical noise)
+    :return: dict with fields radius, result (equivalent, not_equivalent or unknown), obj, bound, inputs and
+        distance of the counterexample, termination and time
+    '''
+    start = timer()
+    template.set_region(template.center, radius, metric)
+
+    if counterexample is not None and not any(template.contains(inc[1]) for inc in template.incumbents):
+        dist = distance(counterexample, template.center, metric)
+        scale = min(1, radius / dist) if dist > 0 else 1
+        set_input_start(template.model, template.center + (np.array(counterexample) - template.center) * scale)
+
+    policy = TerminationPolicy.for_equivalence(tolerance, time_limit)
+    template.encoder.set_termination_policy(policy)
+    template.optimize()
+    model = template.model
+
+    res = {'radius': radius, 'result': 'unknown', 'obj': None, 'bound': model.ObjBound, 'inputs': None,
+           'distance': None, 'termination': policy.finalize(model), 'time': timer() - start}
+    if model.SolCount > 0:
+        res['obj'] = model.ObjVal
+
+    if model.SolCount > 0 and model.ObjVal >= tolerance:
+        inputs = template.get_inputs()
+        res.update({'result': 'not_equivalent', 'inputs': inputs,
+                    'distance': distance(inputs, template.center, metric)})
+    elif model.ObjBound <= bound_tol:
+        res['result'] = 'equivalent'
+
+    return res
+
+
+def build_template(path1, path2, lo, hi, mode, center, r_max, name, threads=None):
+    template_lo = np.maximum(lo, np.array(center, dtype=float) - r_max)
+    template_hi = np.minimum(hi, np.array(center, dtype=float) + r_max)
+
+    template = EquivalenceTemplate(path1, path2, template_lo, template_hi, mode, name)
+    template.model.setParam('OutputFlag', 0)
+    if threads is not None:
+        template.model.setParam('Threads', threads)
+
+    # center is kept by every later set_region
+    template.set_region(center, r_max, 'chebyshev')
+
+    return template
+
+
+def worker_loop(template_args, config, tasks, results, stop):
+    template = build_template(*template_args)
+
+    while not stop.is_set():
+        radius, counterexample = tasks.get()
+        start = timer()
+        try:
+            res = probe_radius(template, radius, config['metric'], config['tolerance'], config['time_limit'],
+                               counterexample, config['bound_tol'])
+        except Exception:
+            # reported as unknown, otherwise the round would wait for the result forever
+            res = {'radius': radius, 'result': 'unknown', 'obj': None, 'bound': None, 'inputs': None,
+                   'distance': None, 'termination': 'error', 'time': timer() - start, 'error': traceback.format_exc()}
+        results.put(res)
+
+
+def next_radii(lo, hi, certified, r_init, r_max, probes):
+    '''
+    :param lo: largest radius proven equivalent
+    :param hi: upper end of the search interval (counterexample or unknown radius), None if there is none
+    :param certified: True, if lo was proven equivalent by a query (and not just the initial 0)
+    :return: radii to query in the next round
+    '''
+    if hi is None:
+        # gallop up
+        r = r_init if not certified else 2 * lo
+        radii = [r * 2 ** i for i in range(probes)]
+        return sorted(set(min(r, r_max) for r in radii))
+    elif not certified:
+        # gallop down
+        return [hi / 2 ** (i + 1) for i in range(probes)]
+
+    # bisection (or splitting into probes + 1 parts)
+    return [lo + (hi - lo) * (i + 1) / (probes + 1) for i in range(probes)]
+
+
+def search_radius(path1, path2, lo, hi, mode, center, metric='manhattan', r_init=1, r_max=16, precision=0.1,
+                  probes=1, time_limit=60*30, tolerance=None, bound_tol=1e-6, max_rounds=50, threads=None,
+                  name='radius_search', poll_interval=1, printing=True):
+    '''
+    Brackets the largest radius, for which the NNs are equivalent, up to the precision.
+
+    :param path1: path to the reference NN
+    :param path2: path to the NN to compare against
+    :param lo: lower bounds of the inputs
+    :param hi: upper bounds of the inputs
+    :param mode: one_hot_partial_top_k
+    :param center: center of the balls
+    :param metric: manhattan or chebyshev
+    :param r_init: first radius queried
+    :param r_max: largest radius queried, the template is encoded for the ball with this radius
+    :param precision: the search stops, when the bracket is smaller than precision
+    :param probes: number of radii queried in parallel in every round, each by its own worker process and
+        template (if probes == 1, the queries are run in this process)
+    :param time_limit: time limit in seconds for every query
+    :param tolerance: diff >= tolerance is a counterexample, fc.not_equiv_tolerance if None
+    :param bound_tol: bounds <= bound_tol prove equivalence
+    :param max_rounds: maximum number of rounds of queries
+    :param threads: gurobi threads of every template, gurobi default if None (with probes > 1, pass the available
+        threads divided by probes, as the templates are optimized at the same time)
+    :param name: name of the gurobi models
+    :param poll_interval: time in seconds between checks, whether the workers are still alive
+    :param printing: if True, the result of every query is printed
+    :return: dict with fields radius_lo (largest radius proven equivalent, 0 if none), radius_hi (distance of
+        the closest counterexample, None if none was found), inputs of that counterexample, unknown (radii, for
+        which the query reached the time limit or failed), queries (list of results of probe_radius, failed
+        queries of workers have termination error and the traceback in field error), rounds and time
+    '''
+    if tolerance is None:
+        tolerance = fc.not_equiv_tolerance
+
+    start = timer()
+    center = np.array(center, dtype=float)
+    template_args = (path1, path2, np.array(lo, dtype=float), np.array(hi, dtype=float), mode, center, r_max, name,
+                     threads)
+    config = {'metric': metric, 'tolerance': tolerance, 'time_limit': time_limit, 'bound_tol': bound_tol}
+
+    procs = []
+    if probes == 1:
+        template = build_template(*template_args)
+    else:
+        tasks = multiprocessing.Queue()
+        results = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        procs = [multiprocessing.Process(target=worker_loop, args=(template_args, config, tasks, results, stop),
+                                         daemon=True) for i in range(probes)]
+        for p in procs:
+            p.start()
+
+    radius_lo = 0
+    certified = False
+    radius_hi = None
+    inputs = None
+    unknown = []
+    queries = []
+    rounds = 0
+
+    try:
+        while rounds < max_rounds:
+            # unknown radii above the certified radius limit the search, but are no counterexamples
+            search_hi = min([r for r in [radius_hi] + unknown if r is not None and r > radius_lo], default=None)
+            if search_hi is not None and search_hi - radius_lo <= precision:
+                break
+            if search_hi is None and radius_lo >= r_max:
+                break
+
+            radii = next_radii(radius_lo, search_hi, certified, r_init, r_max, probes)
+            rounds += 1
+
+            if probes == 1:
+                round_results = [probe_radius(template, radii[0], metric, tolerance, time_limit, inputs,
+                                                bound_tol)]
+            else:
+                for r in radii:
+                    tasks.put((r, inputs))
+
+                round_results = []
+                while len(round_results) < len(radii):
+                    try:
+                        round_results.append(results.get(timeout=poll_interval))
+                    except Empty:
+                        if not any(p.is_alive() for p in procs):
+                            raise RuntimeError('All workers of the radius search terminated unexpectedly!')
+
+            for res in sorted(round_results, key=lambda res: res['radius']):
+                queries.append(res)
+                if res['result'] == 'equivalent' and res['radius'] > radius_lo:
+                    radius_lo = res['radius']
+                    certified = True
+                elif res['result'] == 'not_equivalent' and (radius_hi is None or res['distance'] < radius_hi):
+                    radius_hi = res['distance']
+                    inputs = res['inputs']
+                elif res['result'] == 'unknown':
+                    unknown.append(res['radius'])
+
+                if printing:
+                    print('### radius {r}: {res} (obj, bound) = ({o}, {b}), time = {t}'.format(
+                        r=res['radius'], res=res['result'], o=res['obj'], b=res['bound'], t=res['time']))
+                    if 'error' in res:
+                        print(res['error'])
+    finally:
+        if procs:
+            stop.set()
+            for p in procs:
+                p.terminate()
+                p.join()
+
+    result = {'radius_lo': radius_lo, 'radius_hi': radius_hi, 'inputs': inputs, 'unknown': sorted(unknown),
+              'queries': queries, 'rounds': rounds, 'time': timer() - start}
+
+    if printing:
+        print('### radius in [{lo}, {hi}] after {n} rounds, time = {t}'.format(lo=radius_lo, hi=radius_hi, n=rounds,
+                                                                             t=result['time']))
+
+    return result
@@ -0,0 +1,400 @@
+'''
+Branch and bound on the phases of the unstable ReLUs of both NNs.
+
+Instead of letting gurobi branch on all binaries, the search branches only on the deltas A_d_i_j, B_d_i_j of ReLUs,
+whose input bounds (from interval arithmetic / optimize_constraints) contain 0. Every node is bounded by
+    - bound propagation: interval arithmetic through both NNs respecting the fixed phases, which detects
+      infeasible nodes and ReLUs, whose phase is implied by the fixed ones
+    - the LP relaxation of the model with the propagated bounds, warm started from the basis of the parent node
+The solution of the LP is evaluated by forward evaluation of both NNs, giving valid incumbents. Nodes, in which
+all ReLUs are fixed, are solved as MILP (only the binaries of the comparison layers remain).
+
+Open nodes are kept in a priority queue (best bound first) and processed by worker processes, each with its own
+copy of the LP and the MILP. The search stops according to a TerminationPolicy on the global incumbent and bound.
+'''
+import milp_backend as mb
+from forward_evaluation import load_layers, forward
+from gradient_attack import objective
+from termination import TerminationPolicy
+from timeit import default_timer as timer
+from queue import Empty
+import numpy as np
+import multiprocessing
+import traceback
+import tempfile
+import heapq
+import shutil
+import os
+
+
+def get_relu_layers(model, layers1, layers2):
+    '''
+    :return: dict of net prefix (A or B) and list of (layer index, number of neurons) of all relu layers
+    '''
+    relu_layers = {}
+    for net, layers in [('A', layers1), ('B', layers2)]:
+        relu_layers[net] = [(l, num_neurons) for l, (activation, num_neurons, weights) in enumerate(layers)
+                            if activation == 'relu']
+
+        for l, num_neurons in relu_layers[net]:
+            if model.getVarByName('{n}_d_{l}_0'.format(n=net, l=l)) is None:
+                raise ValueError('ReLUs must be encoded with delta variables (fc.use_grb_native = False)!')
+
+    return relu_layers
+
+
+class NodeSolver:
+    '''
+    LP and MILP of one worker process, both read from the same model file.
+    '''
+
+    def __init__(self, model_file, layers, relu_layers, mode, leaf_time):
+        grb = mb.grb
+        self.env = grb.Env(empty=True)
+        self.env.setParam('OutputFlag', 0)
+        self.env.start()
+
+        self.milp = grb.read(model_file, self.env)
+        self.milp.setParam('Threads', 1)
+        self.milp.setParam('TimeLimit', leaf_time)
+        self.lp = self.milp.relax()
+        self.lp.setParam('Threads', 1)
+        # dual simplex profits most from the basis of the parent
+        self.lp.setParam('Method', 1)
+
+        self.layers = layers
+        self.relu_layers = relu_layers
+        self.mode = mode
+
+        self.num_inputs = len(layers['A'][0][2]) - 1
+        self.inputs = {}
+        self.vars = {}
+        self.root_bounds = {}
+        for name, model in [('lp', self.lp), ('milp', self.milp)]:
+            self.inputs[name] = [model.getVarByName('i_0_{j}'.format(j=j)) for j in range(self.num_inputs)]
+            for net, relus in relu_layers.items():
+                for l, num_neurons in relus:
+                    self.vars[(name, net, l)] = [[model.getVarByName('{n}_{p}_{l}_{r}'.format(n=net, p=p, l=l, r=r))
+                                                  for r in range(num_neurons)] for p in ['x', 'o', 'd']]
+
+        for net, relus in relu_layers.items():
+            for l, num_neurons in relus:
+                x_vars = self.vars[('lp', net, l)][0]
+                self.root_bounds[(net, l)] = (np.array(self.lp.getAttr('LB', x_vars)),
+                                              np.array(self.lp.getAttr('UB', x_vars)))
+
+        self.input_lo = np.array(self.lp.getAttr('LB', self.inputs['lp']))
+        self.input_hi = np.array(self.lp.getAttr('UB', self.inputs['lp']))
+
+    def propagate(self, fixed):
+        '''
+        Interval arithmetic through both NNs respecting the fixed phases.
+
+        :param fixed: dict of (net, layer, row) and phase (0 inactive, 1 active)
+        :return: dict of (net, layer) and (lower bounds, upper bounds, phases) of the relu inputs (phase -1 for
+            unstable ReLUs), None if the phases are infeasible
+        '''
+        bounds = {}
+        for net, layers in self.layers.items():
+            lo = self.input_lo
+            hi = self.input_hi
+            for l, (activation, num_neurons, weights) in enumerate(layers):
+                W = weights[:-1]
+                W_pos = np.maximum(W, 0)
+                W_neg = np.minimum(W, 0)
+                lo, hi = lo @ W_pos + hi @ W_neg + weights[-1], hi @ W_pos + lo @ W_neg + weights[-1]
+
+                if not activation == 'relu':
+                    continue
+
+                root_lo, root_hi = self.root_bounds[(net, l)]
+                lo = np.maximum(lo, root_lo)
+                hi = np.minimum(hi, root_hi)
+
+                phases = np.full(num_neurons, -1)
+                for r in range(num_neurons):
+                    phases[r] = fixed.get((net, l, r), -1)
+                lo = np.where(phases == 1, np.maximum(lo, 0), lo)
+                hi = np.where(phases == 0, np.minimum(hi, 0), hi)
+                if np.any(lo > hi + 1e-9):
+                    return None
+
+                phases = np.where(lo >= 0, 1, np.where(hi <= 0, 0, phases))
+                bounds[(net, l)] = (lo, hi, phases)
+
+                lo = np.maximum(lo, 0)
+                hi = np.maximum(hi, 0)
+
+        return bounds
+
+    def set_bounds(self, name, bounds):
+        model = self.lp if name == 'lp' else self.milp
+        for (net, l), (lo, hi, phases) in bounds.items():
+            x_vars, o_vars, d_vars = self.vars[(name, net, l)]
+            model.setAttr('LB', x_vars, lo.tolist())
+            model.setAttr('UB', x_vars, hi.tolist())
+            model.setAttr('LB', o_vars, np.maximum(lo, 0).tolist())
+            model.setAttr('UB', o_vars, np.maximum(hi, 0).tolist())
+            model.setAttr('LB', d_vars, np.maximum(phases, 0).tolist())
+            model.setAttr('UB', d_vars, np.where(phases == 0, 0, 1).tolist())
+
+    def evaluate(self, name):
+        '''
+        :return: tuple (objective by forward evaluation, inputs) of the current solution of the model
+        '''
+        model = self.lp if name == 'lp' else self.milp
+        inputs = model.getAttr('X', self.inputs[name])
+        values, _, _ = objective(forward(self.layers['A'], [inputs]), forward(self.layers['B'], [inputs]),
+                                 self.mode)
+        return float(values[0]), inputs
+
+    def choose_branch(self, bounds):
+        '''
+        :return: (net, layer, row) of the unstable ReLU with the largest score:
+            violation of the ReLU by the LP solution (output - max(input, 0)) plus the area of the triangle
+            relaxation (-lo * hi / (hi - lo)) as tie breaker
+        '''
+        best = None
+        best_score = -np.inf
+        for (net, l), (lo, hi, phases) in bounds.items():
+            unstable = phases == -1
+            if not np.any(unstable):
+                continue
+
+            x_vars, o_vars, _ = self.vars[('lp', net, l)]
+            x = np.array(self.lp.getAttr('X', x_vars))
+            o = np.array(self.lp.getAttr('X', o_vars))
+            area = -lo * hi / np.maximum(hi - lo, 1e-12)
+            score = np.where(unstable, o - np.maximum(x, 0) + 1e-3 * area, -np.inf)
+
+            r = int(np.argmax(score))
+            if score[r] > best_score:
+                best_score = score[r]
+                best = (net, l, r)
+
+        return best
+
+    def process(self, node, prune_level):
+        '''
+        :param node: dict with fields fixed (dict of fixed phases) and basis (tuple (VBasis, CBasis) of the parent)
+        :param prune_level: nodes with bound <= prune_level are not branched on
+        :return: dict with fields status (infeasible, pruned, leaf or branch), bound, value and inputs of the
+            best solution found in the node, children (list of fixed phases) and basis for branched nodes
+        '''
+        result = {'status': None, 'bound': -np.inf, 'value': None, 'inputs': None}
+
+        bounds = self.propagate(node['fixed'])
+        if bounds is None:
+            result['status'] = 'infeasible'
+            return result
+
+        self.set_bounds('lp', bounds)
+        if node['basis'] is not None:
+            self.lp.setAttr('VBasis', self.lp.getVars(), node['basis'][0])
+            self.lp.setAttr('CBasis', self.lp.getConstrs(), node['basis'][1])
+        self.lp.optimize()
+
+        if self.lp.Status in [mb.INFEASIBLE, mb.INF_OR_UNBD]:
+            result['status'] = 'infeasible'
+            return result
+
+        branch = None
+        if self.lp.Status == mb.OPTIMAL:
+            result['bound'] = self.lp.ObjVal
+            result['value'], result['inputs'] = self.evaluate('lp')
+
+            if result['bound'] <= prune_level:
+                result['status'] = 'pruned'
+                return result
+
+            branch = self.choose_branch(bounds)
+        else:
+            # numerical trouble in the LP, the node is solved as MILP instead
+            result['bound'] = np.inf
+
+        if branch is None:
+            # all phases are fixed, only the binaries of the comparison layers remain
+            self.set_bounds('milp', bounds)
+            self.milp.optimize()
+            result['status'] = 'leaf'
+            result['bound'] = min(result['bound'], self.milp.ObjBound)
+            if self.milp.SolCount > 0:
+                value, inputs = self.evaluate('milp')
+                if result['value'] is None or value > result['value']:
+                    result['value'], result['inputs'] = value, inputs
+            return result
+
+        result['status'] = 'branch'
+        result['basis'] = (self.lp.getAttr('VBasis', self.lp.getVars()),
+                           self.lp.getAttr('CBasis', self.lp.getConstrs()))
+        result['children'] = []
+        for phase in [0, 1]:
+            fixed = dict(node['fixed'])
+            fixed[branch] = phase
+            result['children'].append(fixed)
+
+        return result
+
+
+def worker_loop(model_file, paths, relu_layers, mode, leaf_time, tasks, results, stop):
+    layers = {'A': load_layers(paths[0]), 'B': load_layers(paths[1])}
+    solver = NodeSolver(model_file, layers, relu_layers, mode, leaf_time)
+
+    while not stop.is_set():
+        idx, node, prune_level = tasks.get()
+        try:
+            res = solver.process(node, prune_level)
+        except Exception:
+            # reported, otherwise the node stays in flight forever
+            res = {'status': 'error', 'bound': np.inf, 'value': None, 'inputs': None, 'error': traceback.format_exc()}
+        results.put((idx, res))
+
+
+def relu_bab(model, path1, path2, mode, policy=None, workers=None, leaf_time=60, max_nodes=None, bound_tol=1e-6,
+             poll_interval=1, printing=True):
+    '''
+    Maximizes the objective of an equivalence encoding by branch and bound on the phases of the unstable ReLUs.
+
+    :param model: gurobi model created by Encoder.create_gurobi_model (maximization, ReLUs encoded with deltas)
+    :param path1: path to the reference NN encoded in the model
+    :param path2: path to the NN to compare against
+    :param mode: one_hot_partial_top_k or optimize_diff_[manhattan | chebyshev]
+    :param policy: TerminationPolicy checked on the global incumbent and bound,
+        TerminationPolicy.for_equivalence() if None
+    :param workers: number of worker processes, number of cpus if None
+    :param leaf_time: time limit in seconds for the MILPs of nodes with all ReLUs fixed
+    :param max_nodes: maximum number of processed nodes, unlimited if None
+    :param bound_tol: LP bounds are only accurate up to the tolerances of the solver, nodes with bound <= incumbent
+        (or equivalence bound of the policy) + bound_tol are pruned
+    :param poll_interval: time in seconds between checks, whether the workers are still alive
+    :param printing: if True, progress is printed
+    :return: dict with fields reason (reason of the policy, optimal if the search finished, node_limit, error if
+        the search finished, but nodes failed with an exception), incumbent and inputs (best solution by forward
+        evaluation), bound (global upper bound), nodes, leaves, pruned, errors (tracebacks of the failed nodes)
+        and time
+    '''
+    model.update()
+    if not model.ModelSense == mb.MAXIMIZE:
+        raise ValueError('Only maximization of the diff is supported by the ReLU branch and bound!')
+
+    if policy is None:
+        policy = TerminationPolicy.for_equivalence()
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    layers1 = load_layers(path1)
+    layers2 = load_layers(path2)
+    relu_layers = get_relu_layers(model, layers1, layers2)
+
+    tmpdir = tempfile.mkdtemp()
+    model_file = os.path.join(tmpdir, 'model.mps')
+    model.write(model_file)
+
+    start = timer()
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    procs = [multiprocessing.Process(target=worker_loop, daemon=True,
+                                     args=(model_file, (path1, path2), relu_layers, mode, leaf_time, tasks,
+                                           results, stop)) for i in range(workers)]
+    for p in procs:
+        p.start()
+
+    # heap of (-bound, idx, node) for best first search
+    heap = [(-np.inf, 0, {'fixed': {}, 'basis': None})]
+    in_flight = {}
+    closed_bound = -np.inf
+    incumbent = None
+    inputs = None
+    stats = {'nodes': 0, 'leaves': 0, 'pruned': 0}
+    errors = []
+    count = 1
+    reason = None
+
+    try:
+        while heap or in_flight:
+            prune_level = -np.inf if incumbent is None else incumbent
+            if policy.equivalence_bound is not None:
+                prune_level = max(prune_level, policy.equivalence_bound)
+            prune_level += bound_tol
+
+            while heap and len(in_flight) < 2 * workers:
+                neg_bound, idx, node = heapq.heappop(heap)
+                if -neg_bound <= prune_level:
+                    stats['pruned'] += 1
+                    closed_bound = max(closed_bound, -neg_bound)
+                    continue
+
+                tasks.put((idx, node, prune_level))
+                in_flight[idx] = -neg_bound
+
+            if not in_flight:
+                continue
+
+            try:
+                idx, res = results.get(timeout=poll_interval)
+            except Empty:
+                if not any(p.is_alive() for p in procs):
+                    raise RuntimeError('All workers of the ReLU branch and bound terminated unexpectedly!')
+                res = None
+
+            if res is not None:
+                parent_bound = in_flight.pop(idx)
+                stats['nodes'] += 1
+
+                if res['status'] == 'error':
+                    # the subtree of the node is not searched, its bound is the one of the parent
+                    errors.append(res['error'])
+                    res['bound'] = parent_bound
+                    if printing:
+                        print('### node {i} failed:\n{e}'.format(i=idx, e=res['error']))
+
+                if res['value'] is not None and (incumbent is None or res['value'] > incumbent):
+                    incumbent = res['value']
+                    inputs = res['inputs']
+
+                if res['status'] == 'branch':
+                    for fixed in res['children']:
+                        heapq.heappush(heap, (-res['bound'], count, {'fixed': fixed, 'basis': res['basis']}))
+                        count += 1
+                else:
+                    stats['leaves'] += res['status'] == 'leaf'
+                    stats['pruned'] += res['status'] == 'pruned'
+                    closed_bound = max(closed_bound, res['bound'])
+
+            open_bounds = [-heap[0][0]] if heap else []
+            bound = max(open_bounds + list(in_flight.values()) + [closed_bound] +
+                        ([] if incumbent is None else [incumbent]))
+            reason = policy.check(incumbent, bound - bound_tol, timer() - start)
+
+            if printing and res is not None and stats['nodes'] % 100 == 0:
+                print('### nodes = {n}, open = {o}, incumbent = {i}, bound = {b}'.format(
+                    n=stats['nodes'], o=len(heap) + len(in_flight), i=incumbent, b=bound))
+
+            if reason is not None:
+                break
+            if max_nodes is not None and stats['nodes'] >= max_nodes:
+                reason = 'node_limit'
+                break
+    finally:
+        stop.set()
+        for p in procs:
+            p.terminate()
+            p.join()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if reason is None:
+        bound = closed_bound if incumbent is None else max(closed_bound, incumbent)
+        reason = policy.check(incumbent, bound - bound_tol, timer() - start) or ('error' if errors else 'optimal')
+
+    now = timer()
+    result = {'reason': reason, 'incumbent': incumbent, 'inputs': inputs, 'bound': bound, 'errors': errors,
+              'time': now - start}
+    result.update(stats)
+
+    if printing:
+        print('### ReLU branch and bound: {r}, incumbent = {i}, bound = {b}, nodes = {n}, time = {t}'.format(
+            r=reason, i=incumbent, b=bound, n=stats['nodes'], t=now - start))
+
+    return result
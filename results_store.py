@@ -0,0 +1,239 @@
+'''
+Append-only store for evaluation results in one sqlite database.
+
+Every evaluation dict (as built by the drivers in run_equivalence and FinalEvaluation) becomes one row with a fixed
+schema: job and spec hash, testname split into nn1, nn2 and mode, cluster, step and radius, timings, objective and
+bound, the termination reason, the model statistics (BoundVio, ..., MinCoeff), the paths of log and input file and
+the counterexample as float64 vector. All other fields (e.g. telemetry, falsification) are kept as json in extra.
+
+The database is opened in WAL mode, s.t. several processes (e.g. jobs of the scheduler) can append concurrently
+while analysis notebooks read. Rows are identified by a hash of their content, appending the same row twice (e.g.
+when migrating the same pickles again) has no effect.
+'''
+from ledger import canonical
+import pandas as pd
+import numpy as np
+import hashlib
+import sqlite3
+import pickle
+import json
+import glob
+import time
+import os
+import re
+
+
+MODEL_STATS = ['BoundVio', 'BoundVioIndex', 'ConstrVio', 'ConstrVioIndex', 'ConstrVioSum', 'IntVio', 'IntVioIndex',
+               'IntVioSum', 'MaxBound', 'MaxCoeff', 'MaxRHS', 'MinBound', 'MinCoeff']
+
+COLUMNS = [('job', 'TEXT'), ('spec_hash', 'TEXT'), ('source', 'TEXT'), ('testname', 'TEXT'), ('nn1', 'TEXT'),
+           ('nn2', 'TEXT'), ('mode', 'TEXT'), ('cluster', 'INTEGER'), ('step', 'REAL'), ('radius', 'REAL'),
+           ('obj', 'REAL'), ('bound', 'REAL'), ('time', 'REAL'), ('termination', 'TEXT'), ('model_name', 'TEXT')] + \
+          [(stat, 'REAL') for stat in MODEL_STATS] + \
+          [('logfile', 'TEXT'), ('inputfile', 'TEXT'), ('inputs', 'BLOB'), ('extra', 'TEXT'), ('created', 'REAL')]
+
+TESTNAME_PATTERN = re.compile(r'^(?:r_opt_)?(.+)_vs_(.+?)_(one_hot_partial_top_\d+|optimize_diff_\w+)$')
+
+
+def split_testname(testname):
+    '''
+    :return: tuple (nn1, nn2, mode) for testnames of the form [r_opt_]nn1_vs_nn2_mode, (None, None, None) otherwise
+    '''
+    match = TESTNAME_PATTERN.match(testname) if isinstance(testname, str) else None
+    if match is None:
+        return None, None, None
+
+    return match.groups()
+
+
+def encode_inputs(inputs):
+    '''
+    :return: inputs as float64 bytes or None, if inputs is not a vector of numbers (e.g. 'No Solution found ...')
+    '''
+    if inputs is None or isinstance(inputs, str):
+        return None
+
+    try:
+        return np.asarray(inputs, dtype=np.float64).tobytes()
+    except (TypeError, ValueError):
+        return None
+
+
+def decode_inputs(blob):
+    return None if blob is None else np.frombuffer(blob, dtype=np.float64)
+
+
+class ResultsStore:
+
+    def __init__(self, db_file='results.sqlite', timeout=60):
+        '''
+        :param db_file: path to the sqlite database, created if it doesn't exist
+        :param timeout: time in seconds a writer waits for the lock held by another writer
+        '''
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+
+        columns = ', '.join('{c} {t}'.format(c=c, t=t) for c, t in COLUMNS)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, row_hash TEXT UNIQUE, '
+                          '{cols})'.format(cols=columns))
+        for column in ['testname', 'mode', 'nn1, nn2', 'cluster']:
+            self.conn.execute('CREATE INDEX IF NOT EXISTS idx_{n} ON results ({c})'.format(
+                n=column.replace(', ', '_'), c=column))
+        self.conn.commit()
+
+    def make_row(self, eval_dict, job=None, spec_hash=None, source=None, inputs=None):
+        d = dict(eval_dict)
+        nn1, nn2, mode = split_testname(d.get('testname'))
+        row = {'job': job, 'spec_hash': spec_hash, 'source': source, 'nn1': nn1, 'nn2': nn2, 'mode': mode,
+               'inputs': encode_inputs(inputs), 'created': time.time()}
+
+        for column, _ in COLUMNS:
+            if column in d and column not in ['inputs', 'created']:
+                value = d.pop(column)
+                if isinstance(value, (np.integer, np.floating)):
+                    value = value.item()
+                row[column] = None if isinstance(value, float) and np.isnan(value) else value
+
+        row['extra'] = json.dumps(canonical(d), sort_keys=True) if d else None
+
+        content = {c: row.get(c) for c, _ in COLUMNS if c not in ['job', 'spec_hash', 'source', 'created']}
+        content['inputs'] = None if row['inputs'] is None else hashlib.sha256(row['inputs']).hexdigest()
+        row['row_hash'] = hashlib.sha256(json.dumps(canonical(content), sort_keys=True).encode()).hexdigest()
+
+        return row
+
+    def append(self, eval_dicts, job=None, spec_hash=None, source=None, inputs=None):
+        '''
+        Appends evaluation dicts in one transaction.
+
+        :param eval_dicts: evaluation dict or list of evaluation dicts
+        :param job: name of the job, that produced the results
+        :param spec_hash: spec hash of the job (see ledger.spec_hash)
+        :param source: file the results were migrated from
+        :param inputs: list of counterexamples (one per dict), if None the pickle at inputfile is loaded if it exists
+        :return: number of rows added (rows already in the store are ignored)
+        '''
+        if isinstance(eval_dicts, dict):
+            eval_dicts = [eval_dicts]
+            inputs = None if inputs is None else [inputs]
+
+        if inputs is None:
+            inputs = [load_inputs(d.get('inputfile')) for d in eval_dicts]
+
+        rows = [self.make_row(d, job, spec_hash, source, ins) for d, ins in zip(eval_dicts, inputs)]
+        columns = ['row_hash'] + [c for c, _ in COLUMNS]
+
+        with self.conn:
+            cursor = self.conn.executemany('INSERT OR IGNORE INTO results ({cols}) VALUES ({vals})'.format(
+                cols=', '.join(columns), vals=', '.join('?' for c in columns)),
+                [[row.get(c) for c in columns] for row in rows])
+
+        return cursor.rowcount
+
+    def query(self, columns=None, with_inputs=False, with_extra=False, **filters):
+        '''
+        :param columns: list of columns, all fixed columns except inputs and extra if None
+        :param with_inputs: if True, the counterexamples are decoded into numpy vectors in column inputs
+        :param with_extra: if True, the json in column extra is decoded
+        :param filters: column=value, column=None, column=[values] or column=(lo, hi) for lo <= column <= hi
+        :return: DataFrame of the matching rows
+        '''
+        if columns is None:
+            columns = [c for c, _ in COLUMNS if c not in ['inputs', 'extra']]
+        columns = list(columns) + (['inputs'] if with_inputs else []) + (['extra'] if with_extra else [])
+
+        conditions = []
+        params = []
+        for column, value in filters.items():
+            if column not in [c for c, _ in COLUMNS]:
+                raise ValueError('Column {c} is not in the results store!'.format(c=column))
+
+            if value is None:
+                conditions.append('{c} IS NULL'.format(c=column))
+            elif isinstance(value, tuple):
+                conditions.append('{c} BETWEEN ? AND ?'.format(c=column))
+                params += list(value)
+            elif isinstance(value, list):
+                conditions.append('{c} IN ({v})'.format(c=column, v=', '.join('?' for v in value)))
+                params += value
+            else:
+                conditions.append('{c} = ?'.format(c=column))
+                params.append(value)
+
+        sql = 'SELECT {cols} FROM results'.format(cols=', '.join(columns))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+
+        df = pd.read_sql_query(sql, self.conn, params=params)
+        if with_inputs:
+            df['inputs'] = df['inputs'].apply(decode_inputs)
+        if with_extra:
+            df['extra'] = df['extra'].apply(lambda e: None if e is None else json.loads(e))
+
+        return df
+
+    def close(self):
+        self.conn.close()
+
+
+def load_inputs(inputfile, search_dirs=()):
+    '''
+    :param inputfile: path of the pickled inputs as stored in the evaluation dicts
+    :param search_dirs: directories, where the file is looked for by its basename, if it doesn't exist at inputfile
+        (e.g. the inputs were moved to FinalEvaluation/FixedRadius/inputs after the run)
+    :return: the pickled inputs or None, if the file can't be found
+    '''
+    if not isinstance(inputfile, str):
+        return None
+
+    for fname in [inputfile] + [os.path.join(d, os.path.basename(inputfile)) for d in search_dirs]:
+        if os.path.exists(fname):
+            with open(fname, 'rb') as fp:
+                return pickle.load(fp)
+
+    return None
+
+
+def dataframe_to_dicts(df):
+    # some dataframes were saved with one evaluation dict per cell (from a list of lists of dicts)
+    if len(df) > 0 and not any(isinstance(c, str) for c in df.columns):
+        return [cell for row in df.itertuples(index=False) for cell in row if isinstance(cell, dict)]
+
+    return df.to_dict('records')
+
+
+def migrate_pickles(store, root='FinalEvaluation', printing=True):
+    '''
+    One-shot migration of the dataframes df_*.pickle and dict_*.pickle below root into the store. The counterexamples
+    are loaded from inputfile or by basename from the inputs directories next to the dataframes. Dataframes without
+    testname column (e.g. the model statistics in df_k3_vio) are skipped.
+
+    :return: tuple (number of rows added, list of skipped files)
+    '''
+    added = 0
+    skipped = []
+    for fname in sorted(glob.glob(os.path.join(root, '**', 'df_*.pickle'), recursive=True) +
+                        glob.glob(os.path.join(root, '**', 'dict_*.pickle'), recursive=True)):
+        try:
+            data = pd.read_pickle(fname)
+        except Exception:
+            skipped.append(fname)
+            continue
+
+        dicts = [data] if isinstance(data, dict) else dataframe_to_dicts(data)
+        dicts = [d for d in dicts if isinstance(d, dict) and 'testname' in d]
+        if not dicts:
+            skipped.append(fname)
+            continue
+
+        directory = os.path.dirname(fname)
+        search_dirs = [os.path.join(directory, 'inputs'), os.path.join(os.path.dirname(directory), 'inputs'),
+                       directory]
+        inputs = [load_inputs(d.get('inputfile'), search_dirs) for d in dicts]
+        added += store.append(dicts, source=fname, inputs=inputs)
+
+    if printing:
+        print('### migrated {n} rows, skipped {s} files'.format(n=added, s=len(skipped)))
+
+    return added, skipped
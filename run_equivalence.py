@@ -2,6 +2,15 @@
 from performance import Encoder
 import expression
 from expression_encoding import pretty_print, interval_arithmetic, create_gurobi_model
+from smt_portfolio import run_smt_portfolio, counterexample_assertion
+from telemetry import optimize_with_telemetry, SolverTelemetry
+from forward_evaluation import load_layers
+from validation import validated_optimize
+from empirical_equivalence import empirical_report, load_digits_data, LogitCache
+from termination import TerminationPolicy
+from portfolio import solve_portfolio, set_branch_priorities, branching_configs
+from input_splitting import verify_region
+from relu_bab import relu_bab
 import gurobipy as grb
 import sys
 import flags_constants as fc
@@ -13,6 +22,16 @@ import pandas as pd
 
 examples = 'ExampleNNs/'
 
+
+def optimize_logged(model, name, logdir='Evaluation', callback=None):
+    # optimizes the model with telemetry, which is saved as logdir/name_telemetry.pickle next to the log
+    telemetry = optimize_with_telemetry(model, callback)
+    with open(logdir + '/' + name + '_telemetry.pickle', 'wb') as fp:
+        pickle.dump(telemetry.to_dict(), fp)
+
+    return telemetry
+
+
 def balance_scale_eqiv_top_2():
     path = examples + 'balance_scale_lin.h5'
     inl = [1,1,1,1]
@@ -218,20 +237,6 @@ def all_combinations(base, digits, c_num):
     return array
 
 
-def set_branch_priorities(model, s, delta, pi):
-    for v in model.getVars():
-        if 's' in v.varName:
-            v.setAttr('BranchPriority', s)
-        elif 'pi' in v.varName:
-            v.setAttr('BranchPriority', pi)
-        elif 'd' in v.varName and 'diff' not in v.varName:
-            v.setAttr('BranchPriority', delta)
-        else:
-            v.setAttr('BranchPriority', 0)
-
-    model.update()
-
-
 def evaluate_branching(limit_minutes):
     fc.use_grb_native = False
 
@@ -273,7 +278,7 @@ def evaluate_branching(limit_minutes):
         set_branch_priorities(model, s, delta, pi)
         model.setParam('TimeLimit', limit_minutes * 60)
 
-        model.optimize()
+        optimize_logged(model, 'mnist_eqiv_branch_s={set}_delta={d}_pi={p}'.format(set=s, d=delta, p=pi))
         end = timer()
         models.append(model)
         print('### Total Time elapsed: {t}'.format(t=end - start))
@@ -285,8 +290,41 @@ def evaluate_branching(limit_minutes):
     return models
 
 
-def encode_equiv_radius(path1, path2, input_los, input_his, equiv_mode, center, radius, metric, name):
+def run_portfolio_evaluation(name, model, configs=None, limit_minutes=30, threads=None, obj_stop=None,
+                             logdir='Evaluation'):
+    # solves the model with all configs in parallel, stops as soon as one config finishes
+    stdout = sys.stdout
+    sys.stdout = open(logdir + '/' + name + '_portfolio.txt', 'w')
+
+    start = timer()
+    config, winner, results = solve_portfolio(model, configs, threads, obj_stop, limit_minutes * 60)
+    end = timer()
+    print('### Total Time elapsed: {t}'.format(t=end - start))
+
+    sys.stdout = stdout
+    print('### {name} finished. Winning config: {c}, time={t}'.format(name=name, c=config, t=end - start))
+    print('    (val, bound) = ({v}, {bd})'.format(v=winner.ObjVal if winner.SolCount > 0 else None,
+                                                  bd=winner.ObjBound))
+
+    df = pd.DataFrame(results)
+    df.to_pickle(logdir + '/df_' + name + '_portfolio.pickle')
+
+    return winner, config, results
+
+
+def evaluate_branching_portfolio(limit_minutes, threads=None):
+    # parallel version of evaluate_branching, a counterexample (diff > 0) stops all configs
+    fc.use_grb_native = False
+
+    model = mnist_eqiv('one_hot_partial_top_3')
+    return run_portfolio_evaluation('mnist_eqiv_branch', model, branching_configs(), limit_minutes, threads,
+                                    obj_stop=fc.not_equiv_tolerance)
+
+
+def encode_equiv_radius(path1, path2, input_los, input_his, equiv_mode, center, radius, metric, name,
+                        return_encoder=False):
     # accepts one_hot_partial_top_k, one_hot_diff as mode
+    # if return_encoder is True, the tuple (encoder, model) is returned (e.g. to optimize via its termination policy)
 
     fc.use_asymmetric_bounds = True
     fc.use_context_groups = True
@@ -324,11 +362,16 @@ def encode_equiv_radius(path1, path2, input_los, input_his, equiv_mode, center,
     model.setObjective(diff, grb.GRB.MAXIMIZE)
     model.setParam('TimeLimit', 30 * 60)
 
+    if return_encoder:
+        return enc, model
+
     # maximum for diff should be greater 0
     return model
 
-def encode_optimize_radius(path1, path2, input_los, input_his, equiv_mode, center, radius_lo, radius_hi, metric, name):
+def encode_optimize_radius(path1, path2, input_los, input_his, equiv_mode, center, radius_lo, radius_hi, metric, name,
+                           return_encoder=False):
     # accepts one_hot_partial_top_k as mode
+    # if return_encoder is True, the tuple (encoder, model) is returned
     # also one_hot_diff ???
 
     fc.use_asymmetric_bounds = True
@@ -353,6 +396,9 @@ def encode_optimize_radius(path1, path2, input_los, input_his, equiv_mode, cente
     model.setObjective(r, grb.GRB.MINIMIZE)
     model.setParam('TimeLimit', 30 * 60)
 
+    if return_encoder:
+        return enc, model
+
     # for obj val of r -> NNs are different
     # for (bound val - eps) of r -> NNs are equivalent
     return model
@@ -387,7 +433,7 @@ def run_radius_optimization(testname, path1='mnist8x8_70p_retrain.h5', path2='mn
 
     model = encode_optimize_radius(path1, path2, inl, inh, mode, cluster.center, radius_lo, radius_hi, metric, name)
     models.append(model)
-    model.optimize()
+    optimize_logged(model, name)
 
     sys.stdout = stdout
     inputs = [model.getVarByName('i_0_{idx}'.format(idx=j)).X for j in range(64)]
@@ -410,7 +456,7 @@ def run_radius_optimization(testname, path1='mnist8x8_70p_retrain.h5', path2='mn
     sys.stdout = open('Evaluation/' + name + '.txt', 'w')
     model = encode_equiv_radius(path1, path2, inl, inh, mode, cluster.center, radius, metric, name)
     models.append(model)
-    model.optimize()
+    optimize_logged(model, name)
 
     sys.stdout = stdout
     inputs = [model.getVarByName('i_0_{idx}'.format(idx=j)).X for j in range(64)]
@@ -477,7 +523,7 @@ def run_radius_evaluation():
 
             model = encode_equiv_radius(path70, path80, inl, inh, mode, center, r, metric, name)
             models.append(model)
-            model.optimize()
+            optimize_logged(model, name)
 
             sys.stdout = stdout
             inputs = [model.getVarByName('i_0_{idx}'.format(idx=j)).X for j in range(64)]
@@ -506,6 +552,7 @@ def run_hierarchical_cluster_evaluation(testname, path1='mnist8x8_70p_retrain.h5
 
     # 10 most dense clusters in hierarchical manhattan clustering of mnist8x8 training data
     clusters_to_verify = pickle.load(open("to_verify.pickle", "rb"))
+    layers = (load_layers(path1), load_layers(path2))
 
     dims = 64
     steps = [1/20, 1/10, 1/5]
@@ -530,11 +577,15 @@ def run_hierarchical_cluster_evaluation(testname, path1='mnist8x8_70p_retrain.h5
             logfile = 'Evaluation/' + name + '.txt'
             sys.stdout = open(logfile, 'w')
 
-            model = encode_equiv_radius(path1, path2, inl, inh, mode, cluster.center, r, metric, name)
-            # stop optimization, if counterexample with at least 10 difference is found
-            model.setParam('BestObjStop', 10.0)
+            enc, model = encode_equiv_radius(path1, path2, inl, inh, mode, cluster.center, r, metric, name,
+                                             return_encoder=True)
+            # stop optimization, if counterexample with at least 10 difference is found or equivalence is proven
+            policy = TerminationPolicy.for_equivalence(10.0)
+            enc.set_termination_policy(policy)
             models.append(model)
-            model.optimize()
+            telemetry = SolverTelemetry(model)
+            validation = validated_optimize(model, layers, mode, 64, callback=telemetry, optimize=enc.optimize)
+            telemetry.finalize(model)
 
             sys.stdout = stdout
             inputs = [model.getVarByName('i_0_{idx}'.format(idx=j)).X for j in range(64)]
@@ -551,8 +602,10 @@ def run_hierarchical_cluster_evaluation(testname, path1='mnist8x8_70p_retrain.h5
             print('    ins = {i}'.format(i=str(inputs)))
 
             eval_dict = {'testname': testname, 'cluster': clno, 'step': s, 'radius': r, 'obj': model.ObjVal,
-                         'bound': model.ObjBound, 'time': now - teststart, 'logfile': logfile, 'inputfile': fname}
+                         'bound': model.ObjBound, 'time': now - teststart, 'logfile': logfile, 'inputfile': fname,
+                         'termination': policy.finalize(model), 'validation': validation}
 
+            eval_dict['telemetry'] = telemetry.to_dict()
             dict_list.append(eval_dict)
 
     df = pd.DataFrame(dict_list)
@@ -572,6 +625,7 @@ def run_radius_k_optimization(testname, path1=None, path2=None, ks=None, no_clus
 
     clusters_to_verify = pickle.load(open("to_verify.pickle", "rb"))
     cluster_centers = [cl.center for cl in clusters_to_verify[:no_clusters]]
+    layers = (load_layers(path1), load_layers(path2))
 
     inl = [0 for i in range(64)]
     inh = [16 for i in range(64)]
@@ -596,17 +650,20 @@ def run_radius_k_optimization(testname, path1=None, path2=None, ks=None, no_clus
             logfile = 'Evaluation/' + name + '.txt'
             sys.stdout = open(logfile, 'w')
 
-            model = encode_optimize_radius(path1, path2, inl, inh, mode, center, radius_lo, 50, metric, name)
+            enc, model = encode_optimize_radius(path1, path2, inl, inh, mode, center, radius_lo, 50, metric, name,
+                                                return_encoder=True)
             models.append(model)
 
-            # somehow gurobi has numerical problems and sets E_pi indicator variables not close enough to zero
-            if k == 1:
-                model.setParam('IntFeasTol', 1e-8)
+            # stop optimization, if radius is known up to epsilon
+            policy = TerminationPolicy.for_radius(fc.epsilon, test_time)
+            enc.set_termination_policy(policy)
 
-            if not test_time is None:
-                model.setParam('TimeLimit', test_time)
-
-            model.optimize()
+            # somehow gurobi has numerical problems and sets E_pi indicator variables not close enough to zero,
+            # therefore solutions are checked by forward evaluation and tolerances are tightened for spurious ones
+            telemetry = SolverTelemetry(model)
+            validation = validated_optimize(model, layers, mode, 64, radius_mode=True, callback=telemetry,
+                                            optimize=enc.optimize)
+            telemetry.finalize(model)
 
             sys.stdout = stdout
             inputs = [model.getVarByName('i_0_{idx}'.format(idx=j)).X for j in range(64)]
@@ -616,7 +673,9 @@ def run_radius_k_optimization(testname, path1=None, path2=None, ks=None, no_clus
             with open(fname, 'wb') as fp:
                 pickle.dump(inputs, fp)
 
-            radius_lo = model.ObjBound - fc.epsilon
+            # the bound is only a valid lower radius for the next k, if no activation pattern was cut off
+            if validation['cuts'] == 0:
+                radius_lo = model.ObjBound - fc.epsilon
 
             now = timer()
             print('### {name} finished. Total time elapsed: {t}'.format(name=name, t=now - teststart))
@@ -624,8 +683,10 @@ def run_radius_k_optimization(testname, path1=None, path2=None, ks=None, no_clus
             print('    ins = {i}'.format(i=str(inputs)))
 
             eval_dict = {'testname': testname, 'cluster': clno, 'radius_obj': model.ObjVal,
-                         'radius_bound': model.ObjBound, 'time': now - teststart, 'logfile': logfile, 'inputfile': fname}
+                         'radius_bound': model.ObjBound, 'time': now - teststart, 'logfile': logfile, 'inputfile': fname,
+                         'termination': policy.finalize(model), 'validation': validation}
 
+            eval_dict['telemetry'] = telemetry.to_dict()
             dict_list.append(eval_dict)
 
     df = pd.DataFrame(dict_list)
@@ -634,7 +695,8 @@ def run_radius_k_optimization(testname, path1=None, path2=None, ks=None, no_clus
     return models, ins, dict_list
 
 
-def run_student_evaluation():
+def run_student_evaluation(configs=None, threads=None):
+    # if configs are given, the model is solved with a portfolio of these configs instead of MIPFocus=3
     fc.use_asymmetric_bounds = True
     fc.use_context_groups = True
     fc.use_grb_native = False
@@ -651,13 +713,19 @@ def run_student_evaluation():
     teststart = timer()
 
     name = 'mnist8x8_50p_student_equiv'
+
+    if configs is not None:
+        model = encode_equiv(path, path, inl, inh, mode, name)
+        model, _, _ = run_portfolio_evaluation(name, model, configs, 60, threads, fc.not_equiv_tolerance)
+        return model
+
     sys.stdout = open('Evaluation/' + name + '.txt', 'w')
 
     model = encode_equiv(path, path, inl, inh, mode, name)
     model.setParam('TimeLimit', 60*60)
     model.setParam('MIPFocus', 3)
     model.update()
-    model.optimize()
+    optimize_logged(model, name)
 
     sys.stdout = stdout
     now = timer()
@@ -855,7 +923,7 @@ def run_evaluation():
         inh = [16 for i in range(64)]
         mode = 'one_hot_partial_top_3'
         model = encode_equiv(path1, path2, inl, inh, mode, name)
-        model.optimize()
+        optimize_logged(model, name[:-4])
         end = timer()
         models.append(model)
         print('### Total Time elapsed: {t}'.format(t=end - start))
@@ -873,7 +941,7 @@ def run_evaluation():
         inh = [16 for i in range(64)]
         mode = 'one_hot_partial_top_3'
         model = encode_equiv(path, path, inl, inh, mode, name)
-        model.optimize()
+        optimize_logged(model, name[:-4])
         end = timer()
         models.append(model)
         print('### Total Time elapsed: {t}'.format(t=end - start))
@@ -888,4 +956,128 @@ def run_evaluation():
     models[-2].optimize()
     '''
 
-    return models
\ No newline at end of file
+    return models
+
+def run_smt_portfolio_radius(testname, path1='mnist8x8_70p_retrain.h5', path2='mnist8x8_80p_retrain.h5', center=None,
+                             radius=1, metric='manhattan', mode='one_hot_partial_top_3', solvers=None,
+                             timeout=30 * 60, logdir='Evaluation'):
+    # checks top-k equivalence around center with local smt solvers instead of gurobi
+    path1 = examples + path1
+    path2 = examples + path2
+    inl = [0 for i in range(64)]
+    inh = [16 for i in range(64)]
+
+    if center is None:
+        center = [8 for i in range(64)]
+
+    fc.use_asymmetric_bounds = True
+    fc.use_context_groups = True
+    fc.use_eps_maximum = True
+    fc.epsilon = 1e-4
+
+    teststart = timer()
+
+    enc = Encoder()
+    enc.encode_equivalence_from_file(path1, path2, inl, inh, mode, mode)
+    enc.add_input_radius(center, radius, metric)
+    enc.optimize_constraints()
+
+    smt_file = logdir + '/' + testname + '.smt2'
+    res = run_smt_portfolio(enc.get_vars(), enc.get_constraints(), smt_file, solvers,
+                            [counterexample_assertion(mode)], timeout, len(inl),
+                            layers=(load_layers(path1), load_layers(path2)), mode=mode)
+
+    now = timer()
+    print('### {name} finished. Total time elapsed: {t}'.format(name=testname, t=now - teststart))
+    print('    result = {r} ({s})'.format(r=res['result'], s=res['solver']))
+    print('    times = {t}'.format(t=res['times']))
+    print('    ins = {i}'.format(i=str(res['inputs'])))
+
+    if res['result'] == 'sat':
+        with open(logdir + '/' + testname + '.pickle', 'wb') as fp:
+            pickle.dump(res['inputs'], fp)
+
+    return res
+
+
+def run_empirical_evaluation(nns=None, top_k=1, no_clusters=10, logdir='Evaluation'):
+    # forward evaluation of all nns on the digits dataset to find pairs and clusters worth formal verification
+    if nns is None:
+        nns = ['mnist8x8_{p}0p_retrain.h5'.format(p=p) for p in range(1, 10)]
+
+    X, y = load_digits_data()
+    clusters_to_verify = pickle.load(open("to_verify.pickle", "rb"))
+
+    report = empirical_report([examples + nn for nn in nns], X, y, top_k, clusters_to_verify[:no_clusters],
+                              LogitCache())
+
+    report['disagreement'].to_pickle(logdir + '/df_empirical_top_{k}_disagreement.pickle'.format(k=top_k))
+    report['clusters'].to_pickle(logdir + '/df_empirical_top_{k}_clusters.pickle'.format(k=top_k))
+
+    return report
+
+
+def run_input_splitting(testname, path1='mnist8x8_70p_retrain.h5', path2='mnist8x8_80p_retrain.h5', center=None,
+                        radius=1, metric='manhattan', mode='one_hot_partial_top_3', workers=None, max_depth=16,
+                        milp_time=60, logdir='Evaluation'):
+    # checks top-k equivalence around center by splitting the input region instead of one monolithic milp
+    path1 = examples + path1
+    path2 = examples + path2
+    inl = [0 for i in range(64)]
+    inh = [16 for i in range(64)]
+
+    if center is None:
+        center = [8 for i in range(64)]
+
+    fc.use_asymmetric_bounds = True
+    fc.use_context_groups = True
+    fc.use_eps_maximum = True
+    fc.epsilon = 1e-4
+
+    res = verify_region(path1, path2, inl, inh, mode, center, radius, metric, workers=workers, max_depth=max_depth,
+                        milp_time=milp_time)
+
+    print('### {name} finished. result = {r}'.format(name=testname, r=res['result']))
+    print('    ins = {i}'.format(i=str(res['inputs'])))
+
+    if res['inputs'] is not None:
+        with open(logdir + '/' + testname + '.pickle', 'wb') as fp:
+            pickle.dump(res['inputs'], fp)
+
+    return res
+
+
+def run_relu_bab(testname, path1='mnist8x8_70p_retrain.h5', path2='mnist8x8_80p_retrain.h5', center=None, radius=1,
+                 metric='manhattan', mode='one_hot_partial_top_3', workers=None, time_limit=30 * 60,
+                 logdir='Evaluation'):
+    # checks top-k equivalence around center by branching on the relu phases instead of all binaries
+    path1 = examples + path1
+    path2 = examples + path2
+    inl = [0 for i in range(64)]
+    inh = [16 for i in range(64)]
+
+    if center is None:
+        center = [8 for i in range(64)]
+
+    fc.use_asymmetric_bounds = True
+    fc.use_context_groups = True
+    fc.use_eps_maximum = True
+    fc.epsilon = 1e-4
+
+    enc = Encoder()
+    enc.encode_equivalence_from_file(path1, path2, inl, inh, mode, mode)
+    enc.add_input_radius(center, radius, metric)
+    enc.optimize_constraints()
+
+    model = enc.create_gurobi_model(backend='gurobi')
+    policy = TerminationPolicy.for_equivalence(time_budget=time_limit)
+    res = relu_bab(model, path1, path2, mode, policy, workers)
+
+    print('### {name} finished. result = {r}'.format(name=testname, r=res['reason']))
+    print('    ins = {i}'.format(i=str(res['inputs'])))
+
+    if res['reason'] == 'counterexample':
+        with open(logdir + '/' + testname + '.pickle', 'wb') as fp:
+            pickle.dump(res['inputs'], fp)
+
+    return res
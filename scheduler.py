@@ -0,0 +1,178 @@
+'''
+Scheduler for evaluation sweeps.
+
+The evaluation drivers redirect sys.stdout to their own log files and create gurobi models in the default
+environment, so they can't run in threads. Instead every Job runs in its own process with
+    - sys.stdout redirected to logdir/name.out
+    - gurobi parameters Threads and LogFile set on the default environment (inherited by all models of the job)
+Jobs are started as soon as their dependencies finished and enough cores are free (the sum of Threads of running
+jobs never exceeds the number of cores), results are yielded in the order the jobs finish. With a Ledger, runs of
+the same jobs can be resumed after a crash or preemption.
+'''
+from ledger import find_artifacts
+from timeit import default_timer as timer
+from queue import Empty
+import multiprocessing
+import traceback
+import sys
+import os
+
+
+class Job:
+
+    def __init__(self, name, func, kwargs=None, threads=1, depends=None, timeout=None):
+        '''
+        :param name: unique name of the job, used for the log files
+        :param func: module level function called with kwargs, if it returns a tuple (as the evaluation drivers),
+            only the last element (the evaluation dicts) is passed back, as gurobi models can't be pickled
+        :param kwargs: dict of keyword arguments for func
+        :param threads: number of threads for gurobi and number of cores reserved for the job
+        :param depends: names of jobs, that have to finish successfully before this job is started
+        :param timeout: time in seconds, after which the job is killed, unlimited if None
+        '''
+        self.name = name
+        self.func = func
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.threads = threads
+        self.depends = depends if depends is not None else []
+        self.timeout = timeout
+
+    def __repr__(self):
+        return self.name
+
+
+def run_job(job, logdir, results):
+    import gurobipy as grb
+
+    start = timer()
+    sys.stdout = open(os.path.join(logdir, job.name + '.out'), 'w')
+    grb.setParam('Threads', job.threads)
+    grb.setParam('LogFile', os.path.join(logdir, job.name + '.grb.log'))
+
+    try:
+        result = job.func(**job.kwargs)
+        if isinstance(result, tuple):
+            result = result[-1]
+        status = 'finished'
+    except Exception:
+        result = traceback.format_exc()
+        status = 'failed'
+        print(result)
+
+    sys.stdout.flush()
+    results.put((job.name, status, result, timer() - start))
+
+
+def run_jobs(jobs, cores=None, logdir='Evaluation/Jobs', poll_interval=1, printing=True, ledger=None):
+    '''
+    Runs the jobs in separate processes, respecting dependencies and the number of cores.
+
+    :param jobs: list of Jobs
+    :param cores: number of cores to use, number of cpus if None
+    :param logdir: directory for the logs of the jobs
+    :param poll_interval: time in seconds between checks for killed and timed out jobs
+    :param printing: if True, every finished job is printed
+    :param ledger: Ledger, jobs are recorded in it and jobs, that shouldn't run according to its RetryPolicy
+        (e.g. finished in a previous run), are not run again, but their recorded result is yielded
+    :return: generator of dicts with fields name, status (finished, failed, timed_out, skipped if a dependency
+        didn't finish, or the status recorded in the ledger), result (returned by the job or error), time and
+        cached (True, if the result is taken from the ledger), in the order the jobs finish
+    '''
+    if cores is None:
+        cores = multiprocessing.cpu_count()
+
+    names = [job.name for job in jobs]
+    if not len(set(names)) == len(names):
+        raise ValueError('Names of jobs have to be unique!')
+
+    for job in jobs:
+        if job.threads > cores:
+            raise ValueError('Job {j} needs {t} threads, but only {c} cores are available!'.format(
+                j=job.name, t=job.threads, c=cores))
+        for dep in job.depends:
+            if dep not in names:
+                raise ValueError('Dependency {d} of job {j} is not a job!'.format(d=dep, j=job.name))
+
+    os.makedirs(logdir, exist_ok=True)
+
+    results = multiprocessing.Queue()
+    pending = list(jobs)
+    running = {}
+    status = {}
+    free = cores
+
+    if ledger is not None:
+        for job in list(pending):
+            if not ledger.should_run(job):
+                entry = ledger.get(job)
+                pending.remove(job)
+                status[job.name] = entry['status']
+                if printing:
+                    print('### job {n} {s} in previous run'.format(n=job.name, s=entry['status']))
+                yield {'name': job.name, 'status': entry['status'],
+                       'result': entry['result'] if entry['status'] == 'finished' else entry['error'],
+                       'time': entry['finished'] - entry['started'] if entry['finished'] else None, 'cached': True}
+
+    while pending or running:
+        # skip jobs with unfinished dependencies (repeated, as skipped jobs may be dependencies of earlier jobs)
+        skipped = True
+        while skipped:
+            skipped = [job for job in pending
+                       if any(dep in status and not status[dep] == 'finished' for dep in job.depends)]
+            for job in skipped:
+                pending.remove(job)
+                status[job.name] = 'skipped'
+                if printing:
+                    print('### job {n} skipped, as a dependency did not finish'.format(n=job.name))
+                yield {'name': job.name, 'status': 'skipped', 'result': None, 'time': 0, 'cached': False}
+
+        # start the ready jobs in the given order while cores are free
+        for job in list(pending):
+            if all(status.get(dep) == 'finished' for dep in job.depends) and job.threads <= free:
+                pending.remove(job)
+                if ledger is not None:
+                    ledger.start(job)
+                proc = multiprocessing.Process(target=run_job, args=(job, logdir, results))
+                proc.start()
+                running[job.name] = (job, proc, timer())
+                free -= job.threads
+
+        if not running:
+            if pending:
+                raise ValueError('Dependencies of jobs {j} are cyclic!'.format(j=pending))
+            break
+
+        finished = []
+        try:
+            finished.append(results.get(timeout=poll_interval))
+        except Empty:
+            # jobs killed without reporting a result (e.g. out of memory)
+            for name, (job, proc, start) in running.items():
+                if not proc.is_alive() and results.empty():
+                    finished.append((name, 'failed', 'Process terminated with exit code {c}'.format(
+                        c=proc.exitcode), timer() - start))
+
+        for name, (job, proc, start) in running.items():
+            if job.timeout is not None and timer() - start > job.timeout and \
+                    not any(name == f[0] for f in finished):
+                proc.terminate()
+                finished.append((name, 'timed_out', 'Job exceeded timeout of {t} s'.format(t=job.timeout),
+                                 timer() - start))
+
+        for name, job_status, result, time in finished:
+            job, proc, start = running.pop(name)
+            proc.join()
+            free += job.threads
+            status[name] = job_status
+
+            if ledger is not None:
+                artifacts = [os.path.join(logdir, name + '.out'), os.path.join(logdir, name + '.grb.log')]
+                if job_status == 'finished':
+                    artifacts += find_artifacts(result)
+                ledger.finish(job, job_status, result, artifacts)
+
+            if printing:
+                print('### job {n} {s} after {t} s, running = {r}, pending = {p}'.format(
+                    n=name, s=job_status, t=time, r=len(running), p=len(pending)))
+
+            yield {'name': name, 'status': job_status, 'result': result, 'time': time, 'cached': False}
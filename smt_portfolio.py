@@ -0,0 +1,219 @@
+'''
+Runs several local SMT solvers in parallel on the SMT-LIB representation of an encoding.
+
+The encoding is written once, every solver is started as a subprocess on that file. The first solver to
+answer sat or unsat wins, all other solvers are killed. Counterexamples of sat answers are checked by forward
+evaluation of both NNs, if their layers are given.
+'''
+from expression_encoding import write_smtlib
+from forward_evaluation import forward, top_k_violation
+from fractions import Fraction
+from timeit import default_timer as timer
+import subprocess
+import shutil
+import time
+
+
+# command lines of the solver configurations, the path of the SMT-LIB file is appended
+default_solvers = {
+    'z3': ['z3', '-smt2'],
+    'cvc4': ['cvc4', '--lang', 'smt2', '--produce-models'],
+    'cvc5': ['cvc5', '--lang', 'smt2', '--produce-models'],
+}
+
+
+def counterexample_assertion(mode):
+    '''
+    :param mode: one_hot_partial_top_k
+    :return: SMT-LIB assert, that is satisfiable iff the NNs are not top-k equivalent
+    '''
+    if not mode.startswith('one_hot_partial_top_'):
+        raise ValueError('Mode {} is not supported!\nSupported mode is: \n\tone_hot_partial_top_[k]'.format(mode))
+
+    k = int(mode.split('_')[-1])
+    return '(assert (> E_diff_0_{num} 0))'.format(num=k)
+
+
+def tokenize(s):
+    return s.replace('(', ' ( ').replace(')', ' ) ').split()
+
+
+def parse_sexpr(tokens, pos=0):
+    # returns parsed s-expression (nested lists of strings) starting at pos and position after it
+    if tokens[pos] == '(':
+        expr = []
+        pos += 1
+        while not tokens[pos] == ')':
+            sub, pos = parse_sexpr(tokens, pos)
+            expr.append(sub)
+        return expr, pos + 1
+    else:
+        return tokens[pos], pos + 1
+
+
+def eval_value(term):
+    # numeric values are of form 1.5, (- 1.5), (/ 3 2), (/ (- 3) 2), true, false
+    if isinstance(term, str):
+        if term == 'true':
+            return 1
+        elif term == 'false':
+            return 0
+        return Fraction(term)
+
+    op = term[0]
+    args = [eval_value(t) for t in term[1:]]
+    if op == '-':
+        return -args[0] if len(args) == 1 else args[0] - sum(args[1:])
+    elif op == '/':
+        return args[0] / args[1]
+    elif op == '+':
+        return sum(args)
+    elif op == '*':
+        prod = Fraction(1)
+        for a in args:
+            prod *= a
+        return prod
+    else:
+        raise ValueError('Unable to evaluate model value {}'.format(term))
+
+
+def parse_model(output):
+    '''
+    :param output: output of an SMT solver after (get-model)
+    :return: dict of variable names and their (float) values
+    '''
+    start = output.find('(model')
+    if start < 0:
+        start = output.find('(')
+    if start < 0:
+        return {}
+
+    tokens = tokenize(output[start:])
+    model, _ = parse_sexpr(tokens)
+
+    values = {}
+    for entry in model:
+        # (define-fun name () Sort value)
+        if isinstance(entry, list) and len(entry) == 5 and entry[0] == 'define-fun' and entry[2] == []:
+            values[entry[1]] = float(eval_value(entry[4]))
+
+    return values
+
+
+def run_smt_portfolio(vars, constraints, path, solvers=None, assertions=None, timeout=30 * 60, num_inputs=None,
+                      poll_interval=0.05, printing=True, layers=None, mode=None):
+    '''
+    Writes the encoding to an SMT-LIB file and runs all specified solvers in parallel on it.
+
+    :param vars: variables of the encoding
+    :param constraints: constraints of the encoding
+    :param path: path of the SMT-LIB file, the output of each solver is written to path_solvername.txt
+        (not compressed, as the solvers can't read .gz files)
+    :param solvers: dict of solver names and command lines, default_solvers if None
+        (solvers not installed are skipped)
+    :param assertions: additional asserts, e.g. [counterexample_assertion(mode)]
+    :param timeout: time in seconds after which all solvers are killed
+    :param num_inputs: number of input variables i_0_j to extract from the model, all i_0_j if None
+    :param poll_interval: time in seconds between checks for finished solvers
+    :param printing: if True, progress is printed
+    :param layers: tuple of layer lists of both NNs, if given the counterexample of a sat answer is checked by
+        forward evaluation
+    :param mode: one_hot_partial_top_k, needed to check counterexamples
+    :return: dict with fields result (sat, unsat or unknown), solver (name of the winner), inputs, model,
+        times (runtime of each solver), status (sat, unsat, unknown, error, killed or timeout for each solver),
+        write_time, violation (forward evaluation of the counterexample, if checked) and spurious (True, if the
+        forward evaluation doesn't confirm the counterexample, the result is unknown then)
+    '''
+    if path.endswith('.gz'):
+        raise ValueError('SMT solvers can\'t read compressed files, {} must not end with .gz!'.format(path))
+
+    if layers is not None and (mode is None or not mode.startswith('one_hot_partial_top_')):
+        raise ValueError('Counterexamples can only be checked for mode one_hot_partial_top_[k]!')
+
+    if solvers is None:
+        solvers = default_solvers
+
+    available = {name: cmd for name, cmd in solvers.items() if shutil.which(cmd[0])}
+    if not available:
+        raise ValueError('None of the solvers {} is installed!'.format(list(solvers.keys())))
+
+    _, write_time = write_smtlib(vars, constraints, path, printing=printing, assertions=assertions)
+
+    prefix = path[:-len('.smt2')] if path.endswith('.smt2') else path
+
+    procs = {}
+    outfiles = {}
+    starts = {}
+    for name, cmd in available.items():
+        outfiles[name] = prefix + '_' + name + '.txt'
+        out = open(outfiles[name], 'w')
+        starts[name] = timer()
+        procs[name] = (subprocess.Popen(cmd + [path], stdout=out, stderr=subprocess.STDOUT), out)
+
+    times = {}
+    status = {}
+    winner = None
+    start = timer()
+
+    while procs:
+        for name in list(procs.keys()):
+            proc, out = procs[name]
+            if proc.poll() is None:
+                continue
+
+            times[name] = timer() - starts[name]
+            out.close()
+            del procs[name]
+
+            with open(outfiles[name]) as f:
+                first = f.readline().strip()
+
+            status[name] = first if first in ['sat', 'unsat', 'unknown'] else 'error'
+            if printing:
+                print('### {n} finished with {s} after {t} s'.format(n=name, s=status[name], t=times[name]))
+
+            if status[name] in ['sat', 'unsat'] and winner is None:
+                winner = name
+
+        if winner is not None or timer() - start > timeout:
+            for name, (proc, out) in procs.items():
+                proc.kill()
+                proc.wait()
+                out.close()
+                times[name] = timer() - starts[name]
+                status[name] = 'killed' if winner is not None else 'timeout'
+            procs = {}
+        else:
+            time.sleep(poll_interval)
+
+    result = {'result': 'unknown', 'solver': winner, 'inputs': None, 'model': {}, 'times': times,
+              'status': status, 'write_time': write_time, 'violation': None, 'spurious': False}
+
+    if winner is not None:
+        result['result'] = status[winner]
+
+        if status[winner] == 'sat':
+            with open(outfiles[winner]) as f:
+                model = parse_model(f.read())
+
+            if num_inputs is None:
+                num_inputs = len([v for v in model.keys() if v.startswith('i_0_')])
+
+            result['model'] = model
+            result['inputs'] = [model.get('i_0_{idx}'.format(idx=j)) for j in range(num_inputs)]
+
+            if layers is not None:
+                # inputs missing in the model can't be checked
+                if all(x is not None for x in result['inputs']):
+                    result['violation'] = float(top_k_violation(forward(layers[0], [result['inputs']]),
+                                                                forward(layers[1], [result['inputs']]),
+                                                                int(mode.split('_')[-1]))[0])
+
+                if result['violation'] is None or not result['violation'] > 0:
+                    result['result'] = 'unknown'
+                    result['spurious'] = True
+                    if printing:
+                        print('### spurious counterexample of {n}: forward evaluation = {v}'.format(
+                            n=winner, v=result['violation']))
+
+    return result
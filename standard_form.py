@@ -0,0 +1,186 @@
+'''
+Compiles an encoding to standard form
+
+    min/max c * x + obj_constant
+    s.t.    row_lo <= A * x <= row_hi
+            lb <= x <= ub
+            x_i binary for integrality_i = 1
+
+with A as scipy.sparse CSR matrix and a stable mapping of variable names to column indices.
+'''
+from expression_encoding import create_gurobi_model
+import milp_backend as mb
+import numpy as np
+import gzip
+
+
+class StandardForm:
+
+    def __init__(self, c, A, row_lo, row_hi, lb, ub, integrality, var_names, row_names, sense=mb.MINIMIZE,
+                 obj_constant=0.0, name='NN_model'):
+        self.c = c
+        self.A = A
+        self.row_lo = row_lo
+        self.row_hi = row_hi
+        self.lb = lb
+        self.ub = ub
+        self.integrality = integrality
+        self.var_names = var_names
+        self.row_names = row_names
+        self.sense = sense
+        self.obj_constant = obj_constant
+        self.name = name
+
+        self.var_index = {vname: i for i, vname in enumerate(var_names)}
+
+    @classmethod
+    def from_model(cls, model):
+        '''
+        :param model: HighsModel
+        :return: standard form of the model
+        '''
+        c, A, row_lo, row_hi, lb, ub, integrality = model.get_matrices()
+
+        # names need to be unique, e.g. for mps files
+        row_names = []
+        seen = set()
+        for i, rname in enumerate(model.get_row_names()):
+            if rname in seen:
+                rname = '{n}_r{i}'.format(n=rname, i=i)
+            seen.add(rname)
+            row_names.append(rname)
+
+        return cls(c, A, row_lo, row_hi, lb, ub, integrality, list(model.names), row_names, model.ModelSense,
+                   model.objective.constant, model.ModelName)
+
+    @classmethod
+    def from_encoding(cls, vars, constraints, name='NN_model'):
+        '''
+        Compiles variables and constraints of an encoding (without objective) to standard form.
+        '''
+        return cls.from_model(create_gurobi_model(vars, constraints, name, backend='highs'))
+
+    @classmethod
+    def from_encoder(cls, encoder):
+        '''
+        Compiles the encoding of an Encoder including the objective set by Encoder.create_gurobi_model to
+        standard form.
+        '''
+        return cls.from_model(encoder.create_gurobi_model(backend='highs'))
+
+    def get_index(self, vname):
+        return self.var_index[vname]
+
+    def get_values(self, x, vnames):
+        '''
+        :param x: solution vector
+        :param vnames: list of variable names
+        :return: values of the specified variables in x
+        '''
+        return [x[self.var_index[vname]] for vname in vnames]
+
+    def to_scipy(self):
+        '''
+        :return: dict of keyword arguments for scipy.optimize.milp (always minimizes, therefore c is negated for
+            maximization problems)
+        '''
+        from scipy.optimize import Bounds, LinearConstraint
+
+        return {'c': self.sense * self.c, 'integrality': self.integrality, 'bounds': Bounds(self.lb, self.ub),
+                'constraints': [LinearConstraint(self.A, self.row_lo, self.row_hi)]}
+
+    def write_mps(self, path):
+        '''
+        Writes the standard form as free MPS file, if path ends with .gz the file is compressed.
+
+        Rows with both finite bounds are written as ranged rows, binary variables with bounds [0, 1] as BV.
+        The objective constant is written as negative rhs of the objective row.
+        '''
+        lines = ['NAME {}'.format(self.name)]
+        if self.sense == mb.MAXIMIZE:
+            lines += ['OBJSENSE', '    MAX']
+
+        row_types = []
+        rhs = []
+        ranges = []
+        for i, (lo, hi) in enumerate(zip(self.row_lo, self.row_hi)):
+            if lo == hi:
+                row_types.append('E')
+                rhs.append(hi)
+            elif np.isinf(lo) and np.isinf(hi):
+                row_types.append('N')
+                rhs.append(0)
+            elif np.isinf(lo):
+                row_types.append('L')
+                rhs.append(hi)
+            elif np.isinf(hi):
+                row_types.append('G')
+                rhs.append(lo)
+            else:
+                row_types.append('G')
+                rhs.append(lo)
+                ranges.append((i, hi - lo))
+
+        lines.append('ROWS')
+        lines.append(' N OBJ')
+        lines += [' {t} {n}'.format(t=t, n=n) for t, n in zip(row_types, self.row_names)]
+
+        lines.append('COLUMNS')
+        A = self.A.tocsc()
+        in_int_block = False
+        for j, vname in enumerate(self.var_names):
+            is_int = self.integrality[j] == 1
+            if is_int and not in_int_block:
+                lines.append("    MARKER 'MARKER' 'INTORG'")
+                in_int_block = True
+            elif not is_int and in_int_block:
+                lines.append("    MARKER 'MARKER' 'INTEND'")
+                in_int_block = False
+
+            start, end = A.indptr[j], A.indptr[j + 1]
+            # empty columns are declared by a zero objective entry, otherwise readers drop them from BOUNDS
+            if not self.c[j] == 0 or start == end:
+                lines.append('    {v} OBJ {val!r}'.format(v=vname, val=float(self.c[j])))
+
+            lines += ['    {v} {r} {val!r}'.format(v=vname, r=self.row_names[r], val=float(val))
+                      for r, val in zip(A.indices[start:end], A.data[start:end])]
+
+        if in_int_block:
+            lines.append("    MARKER 'MARKER' 'INTEND'")
+
+        lines.append('RHS')
+        if not self.obj_constant == 0:
+            lines.append('    RHS OBJ {val!r}'.format(val=float(-self.obj_constant)))
+        lines += ['    RHS {r} {val!r}'.format(r=self.row_names[i], val=float(val))
+                  for i, val in enumerate(rhs) if not val == 0]
+
+        if ranges:
+            lines.append('RANGES')
+            lines += ['    RNG {r} {val!r}'.format(r=self.row_names[i], val=float(val)) for i, val in ranges]
+
+        lines.append('BOUNDS')
+        for vname, lo, hi, is_int in zip(self.var_names, self.lb, self.ub, self.integrality):
+            if is_int == 1 and lo == 0 and hi == 1:
+                lines.append(' BV BND {v}'.format(v=vname))
+            elif lo == hi:
+                lines.append(' FX BND {v} {val!r}'.format(v=vname, val=float(lo)))
+            elif np.isinf(lo) and np.isinf(hi):
+                lines.append(' FR BND {v}'.format(v=vname))
+            else:
+                if np.isinf(lo):
+                    lines.append(' MI BND {v}'.format(v=vname))
+                elif not lo == 0:
+                    lines.append(' LO BND {v} {val!r}'.format(v=vname, val=float(lo)))
+
+                if not np.isinf(hi):
+                    lines.append(' UP BND {v} {val!r}'.format(v=vname, val=float(hi)))
+
+        lines.append('ENDATA')
+
+        content = '\n'.join(lines) + '\n'
+        if path.endswith('.gz'):
+            with gzip.open(path, 'wt') as f:
+                f.write(content)
+        else:
+            with open(path, 'w') as f:
+                f.write(content)
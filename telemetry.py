@@ -0,0 +1,142 @@
+'''
+Collects the progress of gurobi solves via callbacks instead of parsing the solver log.
+
+A SolverTelemetry object is passed as callback to model.optimize and records a time series of
+incumbent, bound, gap, node count and number of solutions together with the reductions of presolve.
+The time series is stored as dict of lists, s.t. it can be pickled with the results of a run and converted to a
+DataFrame for analysis.
+'''
+import milp_backend as mb
+import math
+
+
+def chain_callbacks(*callbacks):
+    '''
+    :param callbacks: gurobi callbacks (None entries are ignored)
+    :return: callback calling all of the given callbacks in order, None if no callback is given
+    '''
+    callbacks = [cb for cb in callbacks if cb is not None]
+    if not callbacks:
+        return None
+    elif len(callbacks) == 1:
+        return callbacks[0]
+
+    def callback(model, where):
+        for cb in callbacks:
+            cb(model, where)
+
+    return callback
+
+
+def calc_gap(incumbent, bound):
+    # same definition of the relative gap as used by gurobi
+    if incumbent is None or bound is None or math.isinf(incumbent) or math.isinf(bound):
+        return float('inf')
+    elif incumbent == 0:
+        return 0.0 if bound == 0 else float('inf')
+    return abs(bound - incumbent) / abs(incumbent)
+
+
+class SolverTelemetry:
+
+    columns = ['time', 'incumbent', 'bound', 'gap', 'nodes', 'solutions']
+
+    def __init__(self, model, min_interval=1.0):
+        '''
+        :param model: gurobi or HiGHS model that is going to be optimized with this telemetry as callback (only
+            for gurobi), its size is recorded immediately
+        :param min_interval: minimum time in seconds between two recorded MIP progress entries, new incumbents
+            are always recorded
+        '''
+        self.min_interval = min_interval
+        self.series = {c: [] for c in self.columns}
+        self.last_time = -float('inf')
+
+        model.update()
+        self.sense = model.ModelSense
+        self.info = {'model_name': model.getAttr('ModelName'), 'raw_rows': model.NumConstrs,
+                     'raw_columns': model.NumVars, 'raw_binary': model.NumBinVars,
+                     'raw_nonzeros': model.NumNZs, 'raw_general': model.NumGenConstrs}
+
+    def record(self, time, incumbent, bound, nodes, solutions):
+        incumbent = None if abs(incumbent) >= mb.INFINITY else incumbent
+        bound = None if abs(bound) >= mb.INFINITY else bound
+
+        self.series['time'].append(time)
+        self.series['incumbent'].append(incumbent)
+        self.series['bound'].append(bound)
+        self.series['gap'].append(calc_gap(incumbent, bound))
+        self.series['nodes'].append(nodes)
+        self.series['solutions'].append(solutions)
+        self.last_time = time
+
+    def __call__(self, model, where):
+        grb = mb.grb
+        if where == grb.GRB.Callback.PRESOLVE:
+            self.info['presolve_rows_removed'] = model.cbGet(grb.GRB.Callback.PRE_ROWDEL)
+            self.info['presolve_columns_removed'] = model.cbGet(grb.GRB.Callback.PRE_COLDEL)
+        elif where == grb.GRB.Callback.MIP:
+            time = model.cbGet(grb.GRB.Callback.RUNTIME)
+            if time - self.last_time >= self.min_interval:
+                self.record(time, model.cbGet(grb.GRB.Callback.MIP_OBJBST), model.cbGet(grb.GRB.Callback.MIP_OBJBND),
+                            model.cbGet(grb.GRB.Callback.MIP_NODCNT), model.cbGet(grb.GRB.Callback.MIP_SOLCNT))
+        elif where == grb.GRB.Callback.MIPSOL:
+            # new solution, MIPSOL_OBJBST and MIPSOL_SOLCNT don't include it yet
+            obj = model.cbGet(grb.GRB.Callback.MIPSOL_OBJ)
+            best = model.cbGet(grb.GRB.Callback.MIPSOL_OBJBST)
+            incumbent = min(obj, best) if self.sense == mb.MINIMIZE else max(obj, best)
+
+            self.record(model.cbGet(grb.GRB.Callback.RUNTIME), incumbent, model.cbGet(grb.GRB.Callback.MIPSOL_OBJBND),
+                        model.cbGet(grb.GRB.Callback.MIPSOL_NODCNT), model.cbGet(grb.GRB.Callback.MIPSOL_SOLCNT) + 1)
+
+    def finalize(self, model):
+        '''
+        Records the final state of the optimized model.
+        '''
+        incumbent = model.ObjVal if model.SolCount > 0 else mb.INFINITY
+        self.record(model.Runtime, incumbent, model.ObjBound, model.NodeCount, model.SolCount)
+
+        self.info['status'] = model.Status
+        self.info['grbTime'] = model.Runtime
+        self.info['obj'] = self.series['incumbent'][-1]
+        self.info['bound'] = self.series['bound'][-1]
+        self.info['gap'] = self.series['gap'][-1]
+        self.info['nodes'] = model.NodeCount
+
+        if 'presolve_rows_removed' in self.info:
+            self.info['rows'] = self.info['raw_rows'] - self.info['presolve_rows_removed']
+            self.info['columns'] = self.info['raw_columns'] - self.info['presolve_columns_removed']
+
+    def to_dict(self):
+        '''
+        :return: dict with the recorded time series (dict of lists) in field series and the sizes and final
+            results of the solve in field info
+        '''
+        return {'series': self.series, 'info': self.info}
+
+
+def optimize_with_telemetry(model, callback=None, min_interval=1.0):
+    '''
+    Optimizes the model and records its progress.
+
+    HiGHS models don't support callbacks, for them only the sizes and the final state of the solve are recorded.
+    A TerminationPolicy as callback is then only applied via its parameters (time budget).
+
+    :param model: gurobi or HiGHS model
+    :param callback: additional callback, called after the telemetry callback
+    :param min_interval: minimum time in seconds between two recorded MIP progress entries
+    :return: the SolverTelemetry of the solve
+    '''
+    telemetry = SolverTelemetry(model, min_interval)
+    if isinstance(model, mb.HighsModel):
+        from termination import TerminationPolicy
+        if callback is not None and not isinstance(callback, TerminationPolicy):
+            raise ValueError('Callbacks are not supported by the HiGHS backend!')
+        if callback is not None:
+            callback.apply(model)
+        model.optimize()
+    else:
+        model.optimize(chain_callbacks(telemetry, callback))
+    telemetry.finalize(model)
+
+    return telemetry
@@ -0,0 +1,140 @@
+'''
+Declarative termination policies for equivalence and radius solves.
+
+A TerminationPolicy stops the optimization via callback as soon as the answer to the question asked is decided:
+    - counterexample:  a solution with objective >= counterexample_tol (maximization of diff) was found
+    - equivalent:      the bound proves objective <= equivalence_bound (maximization of diff)
+    - radius_bracket:  incumbent and bound of the radius (minimization) are less than radius_delta apart
+    - time_budget:     the optimization ran for time_budget seconds
+'''
+import flags_constants as fc
+import milp_backend as mb
+from telemetry import chain_callbacks, SolverTelemetry
+
+
+class TerminationPolicy:
+
+    def __init__(self, counterexample_tol=None, equivalence_bound=None, radius_delta=None, time_budget=None,
+                 params=None):
+        '''
+        :param counterexample_tol: stop, if a solution with objective >= counterexample_tol is found
+        :param equivalence_bound: stop, if the bound proves that the objective is <= equivalence_bound
+        :param radius_delta: stop, if incumbent - bound <= radius_delta (for minimization of the radius)
+        :param time_budget: stop after time_budget seconds of optimization
+        :param params: dict of additional gurobi parameters set on the model (e.g. IntFeasTol)
+        '''
+        self.counterexample_tol = counterexample_tol
+        self.equivalence_bound = equivalence_bound
+        self.radius_delta = radius_delta
+        self.time_budget = time_budget
+        self.params = params if params is not None else {}
+
+        # set by apply, read from the model on the first callback otherwise
+        self.sense = None
+        self.reason = None
+
+    @classmethod
+    def for_equivalence(cls, counterexample_tol=None, time_budget=None, params=None):
+        '''
+        :return: policy for maximization of the diff of an equivalence encoding, stops as soon as a counterexample
+            with diff >= counterexample_tol (fc.not_equiv_tolerance if None) is found or the bound proves diff <= 0
+        '''
+        if counterexample_tol is None:
+            counterexample_tol = fc.not_equiv_tolerance
+
+        return cls(counterexample_tol=counterexample_tol, equivalence_bound=0, time_budget=time_budget,
+                   params=params)
+
+    @classmethod
+    def for_radius(cls, radius_delta, time_budget=None, params=None):
+        '''
+        :return: policy for minimization of the radius, stops as soon as the radius is known up to radius_delta
+        '''
+        return cls(radius_delta=radius_delta, time_budget=time_budget, params=params)
+
+    def apply(self, model):
+        '''
+        Sets the parameters of the policy on the model and resets the termination reason.
+        The time budget is also set as TimeLimit, s.t. it is respected, even if callbacks are not available.
+        '''
+        for param, value in self.params.items():
+            model.setParam(param, value)
+
+        if self.time_budget is not None:
+            model.setParam('TimeLimit', self.time_budget)
+
+        model.update()
+        self.sense = model.ModelSense
+        self.reason = None
+
+    def check(self, incumbent, bound, time):
+        '''
+        :param incumbent: objective of the best solution, None if no solution was found
+        :param bound: best bound of the objective
+        :param time: optimization time in seconds
+        :return: reason for termination or None, if the optimization should continue
+        '''
+        if incumbent is not None and self.counterexample_tol is not None and incumbent >= self.counterexample_tol:
+            return 'counterexample'
+        elif self.equivalence_bound is not None and bound <= self.equivalence_bound:
+            return 'equivalent'
+        elif incumbent is not None and self.radius_delta is not None and incumbent - bound <= self.radius_delta:
+            return 'radius_bracket'
+        elif self.time_budget is not None and time >= self.time_budget:
+            return 'time_budget'
+
+        return None
+
+    def __call__(self, model, where):
+        grb = mb.grb
+        if self.sense is None:
+            self.sense = model.ModelSense
+
+        if where == grb.GRB.Callback.MIP:
+            incumbent = model.cbGet(grb.GRB.Callback.MIP_OBJBST)
+            bound = model.cbGet(grb.GRB.Callback.MIP_OBJBND)
+        elif where == grb.GRB.Callback.MIPSOL:
+            obj = model.cbGet(grb.GRB.Callback.MIPSOL_OBJ)
+            best = model.cbGet(grb.GRB.Callback.MIPSOL_OBJBST)
+            incumbent = min(obj, best) if self.sense == mb.MINIMIZE else max(obj, best)
+            bound = model.cbGet(grb.GRB.Callback.MIPSOL_OBJBND)
+        else:
+            return
+
+        if abs(incumbent) >= mb.INFINITY:
+            incumbent = None
+
+        reason = self.check(incumbent, bound, model.cbGet(grb.GRB.Callback.RUNTIME))
+        if reason is not None:
+            self.reason = reason
+            model.terminate()
+
+    def finalize(self, model):
+        '''
+        :param model: the optimized model
+        :return: reason for termination, None if the optimization terminated on its own
+        '''
+        if self.reason is None and model.Status == mb.TIME_LIMIT:
+            self.reason = 'time_budget'
+
+        return self.reason
+
+    def optimize(self, model, callback=None):
+        '''
+        Applies the policy to the model and optimizes it.
+
+        :param model: gurobi or HiGHS model (for HiGHS only the parameters and the time budget are applied)
+        :param callback: additional gurobi callback, for HiGHS only a SolverTelemetry is accepted (which then
+            only records the final state, when finalized)
+        :return: reason for termination, None if the optimization terminated on its own
+        '''
+        self.apply(model)
+
+        if isinstance(model, mb.HighsModel):
+            if callback is not None and not isinstance(callback, SolverTelemetry):
+                raise ValueError('Callbacks are not supported by the HiGHS backend!')
+            model.optimize()
+        else:
+            model.optimize(chain_callbacks(self, callback))
+
+        return self.finalize(model)
@@ -0,0 +1,63 @@
+import multiprocessing
+import threading
+import signal
+import time
+import os
+
+from scheduler import Job
+from fs_queue import submit, collect, run_worker, list_names
+
+
+def work(x, sleep=0.5):
+    time.sleep(sleep)
+    return [{'testname': 'j{}'.format(x), 'obj': x}]
+
+
+def boom():
+    raise ValueError('boom')
+
+
+def test_workers_run_every_job_once(tmp_path):
+    queue_dir = str(tmp_path / 'queue')
+    jobs = [Job('a{}'.format(i), work, {'x': i}) for i in range(6)] + \
+           [Job('b', work, {'x': 99}, depends=['a0', 'a1']), Job('c', boom), Job('d', work, {'x': 1}, depends=['c']),
+            Job('long', work, {'x': 7, 'sleep': 5})]
+    submit(queue_dir, jobs)
+
+    workers = [multiprocessing.Process(target=run_worker, args=(queue_dir,),
+                                       kwargs={'cores': 2, 'poll_interval': 0.5, 'heartbeat_timeout': 2,
+                                               'printing': False})
+               for _ in range(3)]
+    for w in workers:
+        w.start()
+
+    try:
+        # the worker running 'long' stops sending heartbeats for a while (e.g. a hanging node), the job is requeued
+        # and run by another worker, the result of the stopped worker has to be discarded
+        hb = os.path.join(queue_dir, 'claimed', 'long.hb')
+        while not os.path.exists(hb):
+            time.sleep(0.1)
+        time.sleep(0.2)
+        with open(hb) as fp:
+            pid = int(fp.read().split('_')[-1])
+        os.kill(pid, signal.SIGSTOP)
+        resume = threading.Timer(6, os.kill, (pid, signal.SIGCONT))
+        resume.start()
+
+        results = {res['name']: res for res in collect(queue_dir, [job.name for job in jobs], heartbeat_timeout=2)}
+        resume.join()
+    finally:
+        for w in workers:
+            w.join(timeout=30)
+            if w.is_alive():
+                w.kill()
+
+    assert sorted(results) == sorted(job.name for job in jobs)
+    for name in ['a{}'.format(i) for i in range(6)] + ['b', 'long']:
+        assert results[name]['status'] == 'finished'
+    assert results['long']['result'][0]['obj'] == 7
+    assert not results['c']['status'] == 'finished'
+    assert not results['d']['status'] == 'finished'
+
+    assert list_names(queue_dir, 'pending') == []
+    assert os.listdir(os.path.join(queue_dir, 'claimed')) == []
@@ -0,0 +1,56 @@
+import flags_constants as fc
+from performance import Encoder
+from expression_encoding import interval_arithmetic
+from smt_portfolio import run_smt_portfolio, counterexample_assertion
+import numpy as np
+import shutil
+import pytest
+
+
+def random_layers(rng, sizes):
+    # layers of form (activation, num_neurons, weights), the last row of weights is the bias
+    layers = []
+    for l, (n_in, n_out) in enumerate(zip(sizes[:-1], sizes[1:])):
+        activation = 'linear' if l == len(sizes) - 2 else 'relu'
+        layers.append((activation, n_out, rng.normal(size=(n_in + 1, n_out))))
+    return layers
+
+
+@pytest.mark.skipif(shutil.which('z3') is None, reason='z3 is not installed')
+def test_smt_counterexample_within_manhattan_radius(tmp_path, monkeypatch):
+    monkeypatch.setattr(fc, 'manhattan_use_split_variables', True)
+    monkeypatch.setattr(fc, 'hide_non_deltas', True)
+
+    rng = np.random.default_rng(0)
+    mode = 'one_hot_partial_top_1'
+    center = [2, 3, 2.5, 4]
+    radius = 1.5
+
+    found = 0
+    for seed in range(5):
+        layers = (random_layers(rng, [4, 6, 3]), random_layers(rng, [4, 6, 3]))
+        enc = Encoder()
+        # encode_equivalence appends the comparison layers to the lists
+        enc.encode_equivalence(list(layers[0]), list(layers[1]), [1] * 4, [5] * 4, mode, mode)
+        enc.add_input_radius(center, radius, 'manhattan')
+        interval_arithmetic(enc.get_constraints())
+
+        res = run_smt_portfolio(enc.get_vars(), enc.get_constraints(), str(tmp_path / 'm{}.smt2'.format(seed)),
+                                {'z3': ['z3', '-smt2']}, [counterexample_assertion(mode)], 60, 4, printing=False,
+                                layers=layers, mode=mode)
+        if res['inputs'] is not None:
+            found += 1
+            assert np.abs(np.array(res['inputs']) - center).sum() <= radius + 1e-6
+
+        # models not confirmed by forward evaluation are no counterexamples
+        if res['spurious']:
+            assert res['result'] == 'unknown'
+        elif res['result'] == 'sat':
+            assert res['violation'] > 0
+
+    assert found > 0
+
+
+def test_smt_portfolio_rejects_compressed_files(tmp_path):
+    with pytest.raises(ValueError):
+        run_smt_portfolio([], [], str(tmp_path / 'm.smt2.gz'), {'z3': ['z3', '-smt2']})
@@ -0,0 +1,29 @@
+from standard_form import StandardForm
+import milp_backend as mb
+import scipy.sparse as sp
+import numpy as np
+import pytest
+
+
+def test_write_mps_keeps_empty_columns(tmp_path):
+    grb = pytest.importorskip('gurobipy')
+
+    # y has no nonzeros and no objective coefficient, z is a binary only bounded
+    A = sp.csr_matrix(np.array([[1.0, 0.0, 0.0]]))
+    form = StandardForm(np.array([1.0, 0.0, 0.0]), A, np.array([-np.inf]), np.array([4.0]),
+                        np.array([0.0, -1.0, 0.0]), np.array([np.inf, 2.0, 1.0]), np.array([0, 0, 1]),
+                        ['x', 'y', 'z'], ['c0'], sense=mb.MAXIMIZE)
+
+    path = str(tmp_path / 'm.mps')
+    form.write_mps(path)
+
+    env = grb.Env(empty=True)
+    env.setParam('OutputFlag', 0)
+    env.start()
+    model = grb.read(path, env)
+    assert [v.VarName for v in model.getVars()] == form.var_names
+    assert model.getVarByName('y').LB == -1 and model.getVarByName('y').UB == 2
+    assert model.getVarByName('z').VType == grb.GRB.BINARY
+
+    model.optimize()
+    assert model.ObjVal == pytest.approx(4.0)
@@ -0,0 +1,114 @@
+'''
+Validation of solutions returned by the MILP solver by exact forward evaluation of both NNs.
+
+Within its tolerances gurobi may return spurious counterexamples, e.g. indicator variables that are not close
+enough to zero (see fc.use_eps_maximum). validated_optimize re-checks every returned solution and, if it is
+spurious, tightens the tolerances and optionally excludes the activation pattern of the spurious solution by a
+no-good cut before optimizing again.
+'''
+from forward_evaluation import forward
+from gradient_attack import objective
+import milp_backend as mb
+
+
+def validate_solution(model, layers, mode, num_inputs, radius_mode=False):
+    '''
+    :param model: optimized model with at least one solution
+    :param layers: tuple of layer lists of both NNs
+    :param mode: one_hot_partial_top_k or optimize_diff_[manhattan | chebyshev]
+    :param num_inputs: number of input variables i_0_j
+    :param radius_mode: True, if the radius is minimized (every solution is a counterexample then)
+    :return: tuple (valid, inputs, value of the objective calculated by forward evaluation)
+        for top-k modes a solution is valid, if it doesn't claim a counterexample or the forward evaluation
+        confirms a violation > 0, for the diff modes, if the objective matches the forward evaluation
+    '''
+    inputs = [model.getVarByName('i_0_{idx}'.format(idx=j)).X for j in range(num_inputs)]
+    values, _, _ = objective(forward(layers[0], [inputs]), forward(layers[1], [inputs]), mode)
+    value = float(values[0])
+
+    if mode.startswith('one_hot_partial_top_'):
+        claimed = radius_mode or model.ObjVal > 0
+        valid = not claimed or value > 0
+    else:
+        valid = abs(model.ObjVal - value) <= 1e-3 * max(1, abs(value))
+
+    return valid, inputs, value
+
+
+def add_no_good_cut(model, name):
+    '''
+    Adds a constraint excluding the assignment of the binary variables in the current solution.
+    '''
+    binaries = [v for v in model.getVars() if v.VType == mb.BINARY]
+    terms = [1 - v if v.X > 0.5 else v for v in binaries]
+    model.addConstr(model.quicksum(terms) >= 1, name=name)
+    model.update()
+
+
+def validated_optimize(model, layers, mode, num_inputs, radius_mode=False, max_rounds=3, min_tol=1e-9,
+                       callback=None, optimize=None, cut=None, printing=True):
+    '''
+    Optimizes the model and re-checks the solution by forward evaluation. If the solution is spurious,
+    IntFeasTol and FeasibilityTol are divided by 10 (down to min_tol) and, if cut is True, the activation pattern
+    of the spurious solution is excluded by a no-good cut, then the model is optimized again (from scratch, if no
+    cut was added).
+
+    As the no-good cut excludes the activation pattern for all inputs, it may also exclude genuine
+    counterexamples with the same pattern. A bound calculated after a cut therefore doesn't prove equivalence
+    (or a lower bound on the radius) by itself (cuts > 0 in the result).
+
+    :param model: gurobi model
+    :param layers: tuple of layer lists of both NNs
+    :param mode: one_hot_partial_top_k or optimize_diff_[manhattan | chebyshev]
+    :param num_inputs: number of input variables i_0_j
+    :param radius_mode: True, if the radius is minimized
+    :param max_rounds: maximum number of re-optimizations
+    :param min_tol: smallest value the tolerances are tightened to
+    :param callback: gurobi callback passed on to model.optimize
+    :param optimize: function optimize(model, callback) used instead of model.optimize, e.g. encoder.optimize or
+        policy.optimize to apply a termination policy
+    :param cut: if True, spurious activation patterns are excluded by no-good cuts, if None only outside of
+        radius mode (the cuts stay in the model, don't use them for models that are optimized again later)
+    :param printing: if True, spurious solutions are printed
+    :return: dict with fields valid (False, if the last solution is still spurious), inputs, value (forward
+        evaluation of the last solution), rounds, cuts and spurious (list of (objective, forward value) of the
+        spurious solutions)
+    '''
+    if cut is None:
+        cut = not radius_mode
+
+    result = {'valid': True, 'inputs': None, 'value': None, 'rounds': 0, 'cuts': 0, 'spurious': []}
+
+    for r in range(max_rounds + 1):
+        result['rounds'] = r
+        if optimize is None:
+            model.optimize(callback)
+        else:
+            optimize(model, callback)
+
+        if model.SolCount == 0:
+            break
+
+        valid, inputs, value = validate_solution(model, layers, mode, num_inputs, radius_mode)
+        result.update({'valid': valid, 'inputs': inputs, 'value': value})
+        if valid:
+            break
+
+        result['spurious'].append((model.ObjVal, value))
+        if printing:
+            print('### spurious solution: objective = {o}, forward evaluation = {v}'.format(o=model.ObjVal, v=value))
+
+        if r == max_rounds:
+            break
+
+        for param in ['IntFeasTol', 'FeasibilityTol']:
+            model.setParam(param, max(min_tol, model.getParamInfo(param)[2] / 10))
+
+        if cut:
+            add_no_good_cut(model, 'nogood_{r}'.format(r=r))
+            result['cuts'] += 1
+        else:
+            # otherwise the spurious solution would be returned again
+            model.reset()
+
+    return result